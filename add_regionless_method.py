@@ -1,11 +1,15 @@
 import logging
 
+import numpy as np
 import pandas as pd
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
+import metrics_functions
+import transfer_functions
 
-class RuntimeSchema(Schema):
+
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -14,7 +18,6 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     environment = fields.Str(required=True)
     region_column = fields.Str(required=True)
     regionless_code = fields.Int(required=True)
@@ -37,6 +40,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -48,11 +52,14 @@ def lambda_handler(event, context):
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         environment = runtime_variables['environment']
-        json_data = runtime_variables["data"]
+        input_data = transfer_functions.load_data(runtime_variables)
         regionless_code = runtime_variables["regionless_code"]
         region_column = runtime_variables["region_column"]
         survey = runtime_variables['environment']
 
+        # Check the data the calculation needs, as a whole.
+        transfer_functions.check_data(input_data, columns=[region_column])
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -68,18 +75,16 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
 
-        # Get 2 copies of the data
-        original_dataframe = pd.DataFrame(json_data)
-        regionless_dataframe = pd.DataFrame(json_data)
-
-        # Replace region in one of the sets
-        regionless_dataframe[region_column] = regionless_code
-
-        # Combine the original and region replaced data for output
-        final_dataframe = pd.concat([original_dataframe, regionless_dataframe])
+        final_dataframe = add_regionless(input_data, region_column, regionless_code)
 
-        final_output = {"data": final_dataframe.to_json(orient="records")}
+        metrics.record("compute", final_dataframe)
+        final_output = transfer_functions.method_output(
+            final_dataframe, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -91,5 +96,36 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
+
+
+def add_regionless(input_data, region_column, regionless_code):
+    """
+    Appends a copy of the data with its region replaced by the regionless code.
+    :param input_data: The data. - Type: DataFrame
+    :param region_column: Name of the region column. - Type: String
+    :param regionless_code: Region code for all of GB. - Type: Int
+    :return: The data followed by its regionless copy. - Type: DataFrame
+    """
+    # Build each output column in one go, taking every row twice, rather than
+    # copying the whole frame and then concatenating both copies into a third.
+    rows = len(input_data.index)
+    positions = np.tile(np.arange(rows), 2)
+    output_columns = {}
+    for column in input_data.columns:
+        if column == region_column:
+            # Replace the region of the second set of rows
+            output_columns[column] = pd.concat([
+                input_data[column],
+                pd.Series(regionless_code, index=input_data.index)
+            ]).to_numpy()
+        elif pd.api.types.is_extension_array_dtype(input_data[column].dtype):
+            output_columns[column] = input_data[column].array.take(positions)
+        else:
+            output_columns[column] = input_data[column].to_numpy().take(positions)
+
+    return pd.DataFrame(output_columns, index=input_data.index.take(positions),
+                        columns=input_data.columns, copy=False)
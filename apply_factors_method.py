@@ -1,16 +1,20 @@
 import logging
 
-import pandas as pd
+import numpy as np
 from es_aws_functions import general_functions
 from marshmallow import EXCLUDE, Schema, fields
 
+import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
+
 
 class SumSchema(Schema):
     column_name = fields.Str(required=True)
     data = fields.Dict(required=True)
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -19,7 +23,6 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     environment = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
     sum_columns = fields.Nested(SumSchema, many=True, required=True)
@@ -41,6 +44,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -52,11 +56,16 @@ def lambda_handler(event, context):
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         environment = runtime_variables["environment"]
-        json_data = runtime_variables["data"]
+        input_data = transfer_functions.load_data(runtime_variables)
         questions_list = runtime_variables["questions_list"]
         sum_columns = runtime_variables["sum_columns"]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        transfer_functions.check_data(
+            input_data, imp_func.produce_columns("prev_", questions_list) +
+            imp_func.produce_columns("imputation_factor_", questions_list))
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -72,25 +81,17 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
 
-        working_dataframe = pd.DataFrame(json_data)
-
-        for question in questions_list:
-            # Loop through each question value, impute based on factor and previous value
-            # then drop the previous value and the imp factor
-            working_dataframe[question] = working_dataframe.apply(
-                lambda x:
-                general_functions.sas_round(x["prev_" + question] *
-                                            x["imputation_factor_" + question]),
-                axis=1,
-            )
-
-            logger.info("Completed imputation of " + str(question))
+        working_dataframe = apply_factors(input_data, questions_list, sum_columns)
+        logger.info("Completed imputation of " + str(questions_list))
 
-        working_dataframe = working_dataframe.apply(
-            lambda x: sum_data_columns(x, sum_columns), axis=1)
-
-        final_output = {"data": working_dataframe.to_json(orient="records")}
+        metrics.record("compute", working_dataframe)
+        final_output = transfer_functions.method_output(
+            working_dataframe, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -102,10 +103,31 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
 
 
+def apply_factors(working_dataframe, questions_list, sum_columns):
+    """
+    Imputes each question from its previous period value and imputation factor,
+    then produces the sum columns.
+    :param working_dataframe: Non-responders with previous values and imputation
+                              factors. - Type: DataFrame
+    :param questions_list: List of question names. - Type: List
+    :param sum_columns: Definitions of the sum columns. - Type: List
+    :return: Imputed data. - Type: DataFrame
+    """
+    for question in questions_list:
+        # Loop through each question value, impute based on factor and previous value
+        working_dataframe[question] = imp_func.sas_round_array(
+            working_dataframe["prev_" + question] *
+            working_dataframe["imputation_factor_" + question])
+
+    return sum_data_columns_frame(working_dataframe, sum_columns)
+
+
 def sum_data_columns(input_row, sum_columns):
     # Calculate all sum columns.
     for sum_column in sum_columns:
@@ -118,3 +140,69 @@ def sum_data_columns(input_row, sum_columns):
         input_row[sum_column["column_name"]] = int(new_sum)
 
     return input_row
+
+
+def sum_data_columns_frame(input_table, sum_columns):
+    """
+    Calculates all sum columns for the whole DataFrame at once, giving the same
+    results as applying sum_data_columns to every row.
+    :param input_table: DataFrame containing the data columns. - Type: DataFrame
+    :param sum_columns: Sum column definitions. - Type: List
+    :return input_table: With the sum columns populated. - Type: DataFrame
+    """
+    data_columns, coefficients = sum_coefficients(sum_columns)
+    if len(data_columns) == 0:
+        for sum_column in sum_columns:
+            input_table[sum_column["column_name"]] = 0
+        return input_table
+
+    totals = input_table[data_columns].to_numpy(dtype=float) @ coefficients.T
+    if np.isnan(totals).any():
+        raise ValueError("Cannot sum data columns containing missing values.")
+
+    for i in range(0, len(sum_columns)):
+        input_table[sum_columns[i]["column_name"]] = totals[:, i].astype(np.int64)
+
+    return input_table
+
+
+def sum_coefficients(sum_columns):
+    """
+    Compiles each sum column definition into a vector of +1/-1 coefficients over
+    the data columns. A sum column built from an earlier sum column is expanded
+    into that column's coefficients, as sum_data_columns works through them in order.
+    :param sum_columns: Sum column definitions. - Type: List
+    :return: The data columns and a (sum columns x data columns) coefficient
+             matrix. - Type: Tuple(List, Array)
+    """
+    compiled = {}
+    data_columns = []
+    for sum_column in sum_columns:
+        weights = {}
+        for data_column in sum_column["data"]:
+            if sum_column["data"][data_column] == "+":
+                sign = 1
+            elif sum_column["data"][data_column] == "-":
+                sign = -1
+            else:
+                continue
+
+            if data_column in compiled:
+                for inner_column, inner_weight in compiled[data_column].items():
+                    weights[inner_column] = \
+                        weights.get(inner_column, 0) + sign * inner_weight
+            else:
+                weights[data_column] = weights.get(data_column, 0) + sign
+
+        for data_column in weights:
+            if data_column not in data_columns:
+                data_columns.append(data_column)
+        compiled[sum_column["column_name"]] = weights
+
+    coefficients = np.zeros((len(sum_columns), len(data_columns)))
+    for i in range(0, len(sum_columns)):
+        weights = compiled[sum_columns[i]["column_name"]]
+        for j in range(0, len(data_columns)):
+            coefficients[i, j] = weights.get(data_columns[j], 0)
+
+    return data_columns, coefficients
@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 
@@ -6,9 +5,13 @@ import boto3
 import pandas as pd
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
-from marshmallow.validate import Equal
+from marshmallow.validate import Equal, OneOf, Range
 
-from imputation_functions import produce_columns
+import execution_functions
+import metrics_functions
+import storage_functions
+import transfer_functions
+from imputation_functions import FactorsLookup, partition_groups, produce_columns
 
 
 class EnvironmentSchema(Schema):
@@ -20,9 +23,13 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    execution_backend = fields.Str(
+        missing="lambda", validate=OneOf(execution_functions.BACKENDS))
     method_name = fields.Str(required=True)
     response_type = fields.Str(required=True)
     run_environment = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
 
 
 class FactorsSchema(Schema):
@@ -42,7 +49,10 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
+    chunk_size = fields.Int(missing=None, allow_none=True, validate=Range(min=1))
     current_data = fields.Str(required=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
     factors_parameters = fields.Dict(
@@ -50,6 +60,10 @@ class RuntimeSchema(Schema):
         values=fields.Nested(FactorsSchema, required=True))
     in_file_name = fields.Str(required=True)
     out_file_name = fields.Str(required=True)
+    partitions = fields.Int(missing=1, validate=Range(min=1))
+    pass_by_reference = fields.Bool(missing=False)
+    payload_encoding = fields.Str(
+        missing="records", validate=OneOf(transfer_functions.AVAILABLE_ENCODINGS))
     previous_data = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
     unique_identifier = fields.List(fields.String, required=True)
@@ -75,6 +89,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
     current_step_num = 4
 
     try:
@@ -82,11 +97,14 @@ def lambda_handler(event, context):
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        # Set up clients
-        lambda_client = boto3.client("lambda", region_name="eu-west-2")
-
         environment_variables = EnvironmentSchema().load(os.environ)
 
+        # Set up clients
+        if environment_variables["execution_backend"] == "local":
+            lambda_client = execution_functions.LocalLambdaClient()
+        else:
+            lambda_client = boto3.client("lambda", region_name="eu-west-2")
+
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Environment Variables
@@ -94,15 +112,21 @@ def lambda_handler(event, context):
         method_name = environment_variables["method_name"]
         response_type = environment_variables["response_type"]
         run_environment = environment_variables["run_environment"]
+        storage_backend = environment_variables["storage_backend"]
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        chunk_size = runtime_variables["chunk_size"]
         current_data = runtime_variables["current_data"]
+        data_format = runtime_variables["data_format"]
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
         factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
         in_file_name = runtime_variables["in_file_name"]
         out_file_name = runtime_variables["out_file_name"]
+        partitions = runtime_variables["partitions"]
+        pass_by_reference = runtime_variables["pass_by_reference"]
+        payload_encoding = runtime_variables["payload_encoding"]
         previous_data = runtime_variables["previous_data"]
         questions_list = runtime_variables["questions_list"]
         reference = runtime_variables["unique_identifier"][0]
@@ -130,149 +154,111 @@ def lambda_handler(event, context):
         logger.info("Started - retrieved configuration variables.")
 
         # Get factors data from calculate_factors
-        factors_dataframe = aws_functions.read_dataframe_from_s3(
-            bucket_name, in_file_name)
+        factors_dataframe = storage_functions.read_dataframe(bucket_name, in_file_name,
+                                                             data_format, storage_backend)
         logger.info("Successfully retrieved factors data from s3")
 
         # Get data from module that preceded imputation
-        input_data = aws_functions.read_dataframe_from_s3(bucket_name, current_data)
+        input_data = storage_functions.read_dataframe(bucket_name, current_data,
+                                                      data_format, storage_backend)
 
         # Split out non responder data from input
         non_responder_dataframe = input_data[input_data[response_type] == 1]
         logger.info("Successfully retrieved raw-input data from s3")
 
         # Read in previous period data for current period non-responders
-        prev_period_data = aws_functions.read_dataframe_from_s3(bucket_name,
-                                                                previous_data)
+        prev_period_data = storage_functions.read_dataframe(bucket_name, previous_data,
+                                                            data_format, storage_backend)
         logger.info("Successfully retrieved previous period data from s3")
-        # Filter so we only have those that responded in prev
-        prev_period_data = prev_period_data[prev_period_data[response_type] == 2]
-
-        prev_questions_list = produce_columns(
-            "prev_",
-            questions_list,
-            [reference]
-        )
-
-        for question in questions_list:
-            prev_period_data = prev_period_data.rename(
-                index=str, columns={question: "prev_" + question}
-            )
-        logger.info("Successfully renamed previous period data")
-
-        non_responder_dataframe_with_prev = pd.merge(
-            non_responder_dataframe,
-            prev_period_data[prev_questions_list],
-            on=reference,
-        )
-        logger.info("Successfully merged previous period data with non-responder df")
-
-        # Merge the factors onto the non responders
-        non_responders_with_factors = pd.merge(
-            non_responder_dataframe_with_prev,
-            factors_dataframe[
-                produce_columns(
-                    "imputation_factor_",
-                    questions_list,
-                    distinct_values
-                )
-            ],
-            on=distinct_values,
-            how="inner",
-        )
-        logger.info("Successfully merged non-responders with factors")
-
-        # Collects all rows where an imputation factor doesn't exist.
-        dropped_rows = non_responder_dataframe_with_prev[
-            ~non_responder_dataframe_with_prev[reference].isin(
-                non_responders_with_factors[reference])].dropna()
-
-        if len(dropped_rows) > 0:
-            merge_values = distinct_values
-            merge_values.remove(region_column)
-
-            # Collect the GB region imputation factors if they exist.
-            regionless_factors = \
-                factors_dataframe[
-                    produce_columns("imputation_factor_",
-                                    questions_list,
-                                    distinct_values)
-                ][factors_dataframe[region_column] == regionless_code]
-
-            if len(merge_values) != 0:
-                # Basic merge where we have values to merge on.
-                dropped_rows_with_factors = \
-                    pd.merge(dropped_rows, regionless_factors,
-                             on=merge_values, how="inner")
-            else:
-                # Added a column to both dataframes to use for the merge.
-                dropped_rows["Temp_Key"] = 0
-                regionless_factors["Temp_Key"] = 0
-
-                dropped_rows_with_factors = \
-                    pd.merge(dropped_rows, regionless_factors,
-                             on="Temp_Key", how="inner")
-
-                dropped_rows_with_factors = dropped_rows_with_factors.drop("Temp_Key",
-                                                                           axis=1)
-
-            non_responders_with_factors = \
-                pd.concat([non_responders_with_factors, dropped_rows_with_factors])
-            logger.info("Successfully merged missing rows with non_responders")
-
-        payload = {
-            "RuntimeVariables": {
-                "bpm_queue_url": bpm_queue_url,
-                "data": json.loads(
-                    non_responders_with_factors.to_json(orient="records")),
-                "environment": environment,
-                "questions_list": questions_list,
-                "run_id": run_id,
-                "sum_columns": sum_columns,
-                "survey": survey
-            }
+        metrics.record("read", input_data)
+
+        method_variables = {
+            "bpm_queue_url": bpm_queue_url,
+            "environment": environment,
+            "questions_list": questions_list,
+            "run_id": run_id,
+            "sum_columns": sum_columns,
+            "survey": survey
         }
 
-        # Non responder data should now contain all previous values
-        #   and the imputation columns
-        imputed_data = lambda_client.invoke(
-            FunctionName=method_name,
-            Payload=json.dumps(payload),
-        )
-        logger.info("Successfully invoked method.")
-
-        json_response = json.loads(imputed_data.get("Payload").read().decode("UTF-8"))
-        logger.info("JSON extracted from method response.")
-
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
-
-        imputed_non_responders = pd.read_json(json_response["data"], dtype=False)
-
-        # retrieve current responders from input data..
-        current_responders = input_data[
-            input_data[response_type] == 2
-            ]
-
-        # Joining Datasets Together.
-        final_imputed = pd.concat([current_responders, imputed_non_responders])
-        logger.info("Successfully joined imputed data with responder data")
+        if chunk_size is None:
+            non_responders_with_factors = merge_factors(
+                non_responder_dataframe, prev_period_data, factors_dataframe,
+                questions_list, distinct_values, reference, response_type,
+                region_column, regionless_code)
+            logger.info("Successfully merged non-responders with previous data and " +
+                        "factors")
+            metrics.record("prepare", non_responders_with_factors)
+
+            data_reference = None
+            if pass_by_reference:
+                data_reference = transfer_functions.reference_payload(
+                    bucket_name, out_file_name, data_format, storage_backend,
+                    result_suffix="_method_output")
+
+            # Non responder data should now contain all previous values
+            #   and the imputation columns
+            imputed_non_responders = execution_functions.invoke_partitions(
+                lambda_client, method_name, method_variables,
+                non_responders_with_factors, None, partitions, payload_encoding,
+                data_reference, metrics)
+            logger.info("Successfully invoked method.")
+
+            filtered_data = combine_imputed(input_data, imputed_non_responders,
+                                            questions_list, response_type)
+            logger.info("Successfully joined imputed data with responder data")
+
+            storage_functions.save_dataframe(bucket_name, out_file_name, filtered_data,
+                                             data_format, storage_backend)
+            metrics.record("save", filtered_data)
+        else:
+            # Factors are per cell, so each chunk of whole cells is imputed on its
+            # own and written out before the next is merged.
+            chunks = partition_groups(non_responder_dataframe, distinct_values,
+                                      chunk_size)
+            logger.info(f"Split non-responders into {len(chunks)} chunks.")
+
+            # The responders are written first, so the types are set from all of
+            # the data, with the imputed questions as floats.
+            with storage_functions.open_dataframe_writer(
+                    bucket_name, out_file_name, data_format, storage_backend,
+                    input_data.astype(dict.fromkeys(questions_list, float))) as output:
+                output.write(input_data[input_data[response_type] == 2])
+
+                for chunk_number, chunk in enumerate(chunks):
+                    chunk_with_factors = merge_factors(
+                        chunk, prev_period_data, factors_dataframe, questions_list,
+                        distinct_values, reference, response_type, region_column,
+                        regionless_code)
+                    metrics.record("prepare", chunk_with_factors)
+
+                    data_reference = None
+                    if pass_by_reference:
+                        data_reference = transfer_functions.reference_payload(
+                            bucket_name, chunk_file_name(out_file_name, chunk_number),
+                            data_format, storage_backend,
+                            result_suffix="_method_output")
+
+                    imputed_chunk = execution_functions.invoke_partitions(
+                        lambda_client, method_name, method_variables,
+                        chunk_with_factors, None, partitions, payload_encoding,
+                        data_reference, metrics)
+
+                    output.write(combine_imputed(
+                        input_data.iloc[0:0], imputed_chunk, questions_list,
+                        response_type).reindex(columns=input_data.columns))
+                    metrics.record("save", imputed_chunk)
+            logger.info(f"Successfully imputed {len(chunks)} chunks.")
 
-        # Create A List Of Factor Columns To Drop
-        cols_to_drop = produce_columns("imputation_factor_", questions_list,
-                                       produce_columns("prev_", questions_list))
-
-        filtered_data = final_imputed.drop(cols_to_drop, axis=1)
-
-        message = filtered_data.to_json(orient="records")
-
-        aws_functions.save_to_s3(bucket_name, out_file_name, message)
         logger.info("Successfully sent data to s3.")
 
         if run_environment != "development":
-            logger.info(aws_functions.delete_data(bucket_name, current_data))
-            logger.info(aws_functions.delete_data(bucket_name, previous_data))
-            logger.info(aws_functions.delete_data(bucket_name, in_file_name))
+            logger.info(storage_functions.delete_data(bucket_name, current_data,
+                                                      storage_backend))
+            logger.info(storage_functions.delete_data(bucket_name, previous_data,
+                                                      storage_backend))
+            logger.info(storage_functions.delete_data(bucket_name, in_file_name,
+                                                      storage_backend))
             logger.info("Successfully deleted input data.")
 
         aws_functions.send_sns_message(sns_topic_arn, "Imputation - Apply Factors.")
@@ -294,4 +280,114 @@ def lambda_handler(event, context):
     aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
                                   current_step_num, total_steps)
 
-    return {"success": True}
+    metrics.emit(run_id, survey)
+    return {"success": True, "metrics": metrics.summary()}
+
+
+def chunk_file_name(file_name, chunk_number):
+    """
+    Names a chunk's files after the output file, keeping its extension.
+    :param file_name: Name of the output file. - Type: String
+    :param chunk_number: Number of the chunk. - Type: Int
+    :return: Name of the chunk's file. - Type: String
+    """
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}_chunk_{chunk_number}{extension}"
+
+
+def merge_factors(non_responder_dataframe, prev_period_data, factors_dataframe,
+                  questions_list, distinct_values, reference, response_type,
+                  region_column, regionless_code):
+    """
+    Joins the previous period values and the imputation factors onto the
+    non-responders. Non-responders in a cell without factors use the GB factors.
+    :param non_responder_dataframe: Current period non-responders. - Type: DataFrame
+    :param prev_period_data: Previous period data. - Type: DataFrame
+    :param factors_dataframe: Output of calculate factors. - Type: DataFrame
+    :param questions_list: List of question names. - Type: List
+    :param distinct_values: Columns the factors are grouped by. - Type: List
+    :param reference: Column which uniquely identifies a contributor. - Type: String
+    :param response_type: Name of the response type column. - Type: String
+    :param region_column: Name of the region column. - Type: String
+    :param regionless_code: Region code for all of GB. - Type: Int
+    :return: Non-responders with prev_ and imputation_factor_ columns. - Type: DataFrame
+    """
+    # Filter so we only have those that responded in prev
+    prev_period_data = prev_period_data[prev_period_data[response_type] == 2]
+
+    prev_questions_list = produce_columns(
+        "prev_",
+        questions_list,
+        [reference]
+    )
+
+    for question in questions_list:
+        prev_period_data = prev_period_data.rename(
+            index=str, columns={question: "prev_" + question}
+        )
+
+    non_responder_dataframe_with_prev = pd.merge(
+        non_responder_dataframe,
+        prev_period_data[prev_questions_list],
+        on=reference,
+    )
+
+    # Merge the factors onto the non responders
+    non_responders_with_factors = pd.merge(
+        non_responder_dataframe_with_prev,
+        factors_dataframe[
+            produce_columns(
+                "imputation_factor_",
+                questions_list,
+                distinct_values
+            )
+        ],
+        on=distinct_values,
+        how="inner",
+    )
+
+    # Collects all rows where an imputation factor doesn't exist.
+    dropped_rows = non_responder_dataframe_with_prev[
+        ~non_responder_dataframe_with_prev[reference].isin(
+            non_responders_with_factors[reference])].dropna()
+
+    if len(dropped_rows) > 0:
+        # Collect the GB region imputation factors if they exist.
+        regionless_factors = FactorsLookup(
+            factors_dataframe[factors_dataframe[region_column] == regionless_code],
+            questions_list, distinct_values, region_column)
+
+        dropped_rows = dropped_rows[regionless_factors.positions(dropped_rows) >= 0]\
+            .reset_index(drop=True)
+        dropped_rows_with_factors = dropped_rows.join(
+            regionless_factors.lookup(dropped_rows))
+
+        non_responders_with_factors = \
+            pd.concat([non_responders_with_factors, dropped_rows_with_factors])
+
+    return non_responders_with_factors
+
+
+def combine_imputed(input_data, imputed_non_responders, questions_list, response_type):
+    """
+    Joins the imputed non-responders back onto the responders and drops the
+    columns only needed for imputation.
+    :param input_data: Current period data. - Type: DataFrame
+    :param imputed_non_responders: Output of the apply factors method. - Type: DataFrame
+    :param questions_list: List of question names. - Type: List
+    :param response_type: Name of the response type column. - Type: String
+    :return: Imputed current period data. - Type: DataFrame
+    """
+    # retrieve current responders from input data..
+    current_responders = input_data[
+        input_data[response_type] == 2
+        ]
+
+    # Joining Datasets Together.
+    final_imputed = pd.concat([current_responders, imputed_non_responders])
+
+    # Create A List Of Factor Columns To Drop
+    cols_to_drop = produce_columns("imputation_factor_", questions_list,
+                                   produce_columns("prev_", questions_list))
+
+    return final_imputed.drop(cols_to_drop, axis=1)
@@ -1,14 +1,15 @@
 import logging
 
 import numpy as np
-import pandas as pd
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
 import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -17,9 +18,9 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     environment = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
+    rollup = fields.Nested(imp_func.RollupSchema, missing=None, allow_none=True)
     survey = fields.Str(required=True)
 
 
@@ -38,6 +39,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -49,10 +51,21 @@ def lambda_handler(event, context):
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         environment = runtime_variables["environment"]
-        input_data = pd.DataFrame(runtime_variables["data"])
+        input_data = transfer_functions.load_data(runtime_variables)
         questions_list = runtime_variables["questions_list"]
+        rollup = runtime_variables["rollup"]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        statistics_columns = imp_func.produce_columns("mean_", questions_list) + \
+            imp_func.produce_columns("iqrs_", questions_list)
+        if rollup is not None:
+            statistics_columns += imp_func.produce_columns(imp_func.REGIONLESS_PREFIX,
+                                                           statistics_columns)
+        transfer_functions.check_data(
+            input_data, imp_func.produce_columns("movement_", questions_list) +
+            statistics_columns)
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -68,6 +81,8 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
 
         # Produce columns
         atypical_columns = imp_func.produce_columns("atyp_", questions_list)
@@ -80,13 +95,15 @@ def lambda_handler(event, context):
             atypical_columns,
             movement_columns,
             iqrs_columns,
-            mean_columns
+            mean_columns,
+            rollup
         )
         logger.info("Successfully finished calculations of atypicals.")
 
-        json_out = atypicals_df.to_json(orient="records")
-
-        final_output = {"data": json_out}
+        metrics.record("compute", atypicals_df)
+        final_output = transfer_functions.method_output(atypicals_df, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -98,11 +115,14 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
 
 
-def calc_atypicals(input_table, atyp_col, move_col, iqrs_col, mean_col):
+def calc_atypicals(input_table, atyp_col, move_col, iqrs_col, mean_col, rollup=None,
+                   statistics=None, regionless_statistics=None):
     """
     Calculates the atypical values for each column like so:
         atypical_value = (movement_value - mean_value) - 2 * iqrs_value
@@ -112,12 +132,53 @@ def calc_atypicals(input_table, atyp_col, move_col, iqrs_col, mean_col):
     :param move_col: String containing movement column names - Type: String
     :param irqs_col: String containing iqrs column names - Type: String
     :param mean_col: String containing means column names - Type: String
+    :param rollup: Set for rolled up data, without all-GB rows. The all-GB
+                   atypicals are then found from the regionless_ means and IQRS,
+                   and kept in regionless_ atypical columns, with the IQRS, for the
+                   all-GB rows. The regionless_ means are dropped. The movements
+                   left once the atypicals are removed are kept in regionless_
+                   movement columns. - Type: Dict
+    :param statistics: The sums and counts of the cells, which the atypical
+                       movements are removed from. - Type: CellStatistics
+    :param regionless_statistics: The sums and counts of the all-GB cells of rolled
+                                  up data, which the all-GB atypical movements are
+                                  removed from. - Type: CellStatistics
     :return input_table: with the atypicals that have been calculated appended.
     """
+    if rollup is not None:
+        # The all-GB atypicals use the movements before the regional ones are
+        # removed, so are calculated first.
+        prefix = imp_func.REGIONLESS_PREFIX
+        removed = np.full((len(input_table.index), len(iqrs_col)), np.nan)
+        for i in range(0, len(iqrs_col)):
+            regionless_atypicals = (abs(
+                input_table[move_col[i]] - input_table[prefix + mean_col[i]]) -
+                2 * input_table[prefix + iqrs_col[i]]).round(8)
+            input_table[prefix + atyp_col[i]] = regionless_atypicals
+            input_table[prefix + move_col[i]] = np.where(
+                (regionless_atypicals > 0),
+                None,
+                input_table[move_col[i]]
+            )
+            if regionless_statistics is not None:
+                removed[:, i] = np.where(regionless_atypicals > 0,
+                                         input_table[move_col[i]], np.nan)
+        if regionless_statistics is not None:
+            regionless_statistics.update(input_table, removed, sign=-1)
+        input_table = input_table.drop(imp_func.produce_columns(prefix, mean_col),
+                                       axis=1)
+
     for i in range(0, len(iqrs_col)):
         input_table[atyp_col[i]] = abs(input_table[move_col[i]] - input_table[mean_col[i]]) - 2 * input_table[iqrs_col[i]]  # noqa: E501
         input_table[atyp_col[i]] = input_table[atyp_col[i]].round(8)
 
+    if statistics is not None:
+        removed = np.full((len(input_table.index), len(iqrs_col)), np.nan)
+        for i in range(0, len(iqrs_col)):
+            removed[:, i] = np.where(input_table[atyp_col[i]] > 0,
+                                     input_table[move_col[i]], np.nan)
+        statistics.update(input_table, removed, sign=-1)
+
     for j in range(0, len(iqrs_col)):
         input_table[move_col[j]] = np.where(
             (input_table[atyp_col[j]] > 0),
@@ -0,0 +1,309 @@
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+import pandas as pd
+from es_aws_functions import general_functions
+
+import add_regionless_method
+import apply_factors_method
+import apply_factors_wrangler
+import atypicals_method
+import calculate_imputation_factors_method
+import calculate_means_method
+import calculate_movement_method
+import calculate_movement_wrangler
+import imputation_pipeline
+import iqrs_method
+import transfer_functions
+from benchmarks import survey_generator
+from imputation_functions import produce_columns
+
+RESPONSE_TYPE = "response_type"
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description="Times the imputation methods and wrangler data preparation on a "
+                    "synthetic survey.")
+    parser.add_argument("--survey-type", default="sand_gravel",
+                        choices=sorted(survey_generator.SURVEY_TYPES))
+    parser.add_argument("--references", type=int, default=10000)
+    parser.add_argument("--regions", type=int, default=12)
+    parser.add_argument("--strata", type=int, default=5)
+    parser.add_argument("--questions", type=int, default=None)
+    parser.add_argument("--non-response-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--payload-encoding", default="records",
+                        choices=transfer_functions.ENCODINGS)
+    parser.add_argument("--cases", nargs="*", default=None,
+                        help="Only run the named cases.")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", default=None,
+                        help="A previous results file to compare against.")
+    options = parser.parse_args(arguments)
+
+    parameters = {
+        "non_response_rate": options.non_response_rate,
+        "payload_encoding": options.payload_encoding,
+        "questions": options.questions,
+        "references": options.references,
+        "regions": options.regions,
+        "repeats": options.repeats,
+        "seed": options.seed,
+        "strata": options.strata,
+        "survey_type": options.survey_type
+    }
+    data = survey_generator.generate_survey(
+        options.survey_type, options.references, options.regions, options.strata,
+        options.questions, options.non_response_rate, seed=options.seed)
+    runtime_variables = survey_generator.runtime_variables(
+        options.survey_type, options.questions)
+
+    results = []
+    for name, rows, function in benchmark_cases(data, runtime_variables,
+                                                options.payload_encoding):
+        if options.cases and name not in options.cases:
+            continue
+        result = time_case(name, rows, function, options.repeats)
+        print(f"{name:<32}{result['rows']:>10} rows"
+              f"{result['rows_per_second']:>14.0f} rows/s"
+              f"{result['peak_memory_mb']:>10.1f} MB")
+        results.append(result)
+
+    report = {
+        "environment": {
+            "pandas": pd.__version__,
+            "python": platform.python_version()
+        },
+        "parameters": parameters,
+        "results": results
+    }
+    with open(options.output, "w") as file:
+        json.dump(report, file, indent=4)
+
+    if options.compare:
+        with open(options.compare) as file:
+            previous = json.load(file)
+        for name, change in compare_results(previous, report).items():
+            print(f"{name:<32}{change:>+9.1f}% rows/s")
+
+    return report
+
+
+def benchmark_cases(data, runtime_variables, payload_encoding="records"):
+    """
+    Prepares the input of every step, as run_imputation does, and produces a
+    benchmark case for each method, method handler and wrangler preparation.
+    :param data: Current and previous period data. - Type: DataFrame
+    :param runtime_variables: Loaded RuntimeVariables of the pipeline. - Type: Dict
+    :param payload_encoding: The encoding sent to the method handlers. - Type: String
+    :return: Name, input rows and function of each case. - Type: List
+    """
+    distinct_values = runtime_variables["distinct_values"]
+    factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
+    movement_type = runtime_variables["movement_type"]
+    period = runtime_variables["period"]
+    period_column = runtime_variables["period_column"]
+    questions_list = runtime_variables["questions_list"]
+    reference = runtime_variables["unique_identifier"][0]
+    region_column = factors_parameters["region_column"]
+    regionless_code = factors_parameters["regionless_code"]
+    sum_columns = runtime_variables["sum_columns"]
+
+    atypical_columns = produce_columns("atyp_", questions_list)
+    iqrs_columns = produce_columns("iqrs_", questions_list)
+    mean_columns = produce_columns("mean_", questions_list)
+    movement_columns = produce_columns("movement_", questions_list)
+    previous_period = general_functions.calculate_adjacent_periods(
+        period, runtime_variables["periodicity"])
+
+    current_data, previous_period_data = calculate_movement_wrangler.split_periods(
+        data, period_column, period, previous_period)
+    non_responders = current_data[current_data[RESPONSE_TYPE] == 1]
+    movement_input = calculate_movement_wrangler.prepare_movement_data(
+        current_data, previous_period_data, questions_list, reference, RESPONSE_TYPE)
+    movement_output = calculate_movement_method.calculate_aligned_movements(
+        movement_input.copy(), movement_type, questions_list)
+    regionless_output = add_regionless_method.add_regionless(
+        movement_output, region_column, regionless_code).reset_index(drop=True)
+
+    means_input = _with_columns(regionless_output, mean_columns, 0.0)
+    means_output = calculate_means_method.calculate_means(
+        means_input.copy(), questions_list, distinct_values)
+    iqrs_input = _with_columns(means_output, iqrs_columns, 0)
+    iqrs_output = iqrs_method.calc_iqrs(
+        iqrs_input.copy(), movement_columns, iqrs_columns, distinct_values)
+    atypicals_input = _with_columns(iqrs_output, atypical_columns, 0)
+    atypicals_output = atypicals_method.calc_atypicals(
+        atypicals_input.copy(), atypical_columns, movement_columns, iqrs_columns,
+        mean_columns)
+    atypicals_output[movement_columns] = atypicals_output[movement_columns]\
+        .astype(float)
+
+    recalculated_input = _with_columns(atypicals_output.drop(
+        produce_columns("movement_", questions_list, suffix="_count") +
+        produce_columns("movement_", questions_list, suffix="_sum") +
+        atypical_columns + iqrs_columns, axis=1), mean_columns, 0.0)
+    recalculated_output = calculate_means_method.calculate_means(
+        recalculated_input.copy(), questions_list, distinct_values)
+    factors_input = _with_columns(
+        recalculated_output, produce_columns("imputation_factor_", questions_list), 0)
+    factors_type, factors = calculate_imputation_factors_method.load_factors(
+        factors_parameters)
+    factors_output = calculate_imputation_factors_method.calculate_imputation_factors(
+        factors_input.copy(), factors_type, factors, questions_list, distinct_values)
+    factors_dataframe = factors_output[produce_columns(
+        "imputation_factor_", questions_list, distinct_values + [period_column]
+    )].drop_duplicates()
+
+    def merge_factors():
+        return apply_factors_wrangler.merge_factors(
+            non_responders, previous_period_data, factors_dataframe, questions_list,
+            distinct_values, reference, RESPONSE_TYPE, region_column, regionless_code)
+
+    apply_input = merge_factors().reset_index(drop=True)
+
+    def handler(method, dataframe, **variables):
+        event = {
+            "RuntimeVariables": {
+                "bpm_queue_url": "benchmark",
+                **transfer_functions.data_payload(dataframe, payload_encoding),
+                "environment": "benchmark",
+                "questions_list": questions_list,
+                "run_id": "benchmark",
+                "survey": "benchmark",
+                **variables
+            }
+        }
+
+        def run():
+            response = method.lambda_handler(event, None)
+            if not response["success"]:
+                raise RuntimeError(response["error"])
+            return response
+
+        return run
+
+    return [
+        ("wrangler_prepare_movements", len(data.index), lambda: (
+            calculate_movement_wrangler.prepare_movement_data(
+                *calculate_movement_wrangler.split_periods(
+                    data, period_column, period, previous_period),
+                questions_list, reference, RESPONSE_TYPE))),
+        ("movement_method", len(movement_input.index), handler(
+            calculate_movement_method, movement_input, aligned=True,
+            current_period=period, movement_type=movement_type,
+            period_column=period_column, previous_period=previous_period,
+            unique_identifier=[reference])),
+        ("add_regionless", len(movement_output.index), lambda: (
+            add_regionless_method.add_regionless(
+                movement_output, region_column, regionless_code))),
+        ("add_regionless_method", len(movement_output.index), handler(
+            add_regionless_method, movement_output, region_column=region_column,
+            regionless_code=regionless_code)),
+        ("calculate_means", len(means_input.index), lambda: (
+            calculate_means_method.calculate_means(
+                means_input.copy(), questions_list, distinct_values))),
+        ("means_method", len(means_input.index), handler(
+            calculate_means_method, means_input, distinct_values=distinct_values)),
+        ("calc_iqrs", len(iqrs_input.index), lambda: iqrs_method.calc_iqrs(
+            iqrs_input.copy(), movement_columns, iqrs_columns, distinct_values)),
+        ("iqrs_method", len(iqrs_input.index), handler(
+            iqrs_method, iqrs_input, distinct_values=distinct_values)),
+        ("calc_atypicals", len(atypicals_input.index), lambda: (
+            atypicals_method.calc_atypicals(
+                atypicals_input.copy(), atypical_columns, movement_columns,
+                iqrs_columns, mean_columns))),
+        ("atypicals_method", len(atypicals_input.index), handler(
+            atypicals_method, atypicals_input)),
+        ("calculate_imputation_factors", len(factors_input.index), lambda: (
+            calculate_imputation_factors_method.calculate_imputation_factors(
+                factors_input.copy(), factors_type, factors, questions_list,
+                distinct_values))),
+        ("factors_method", len(factors_input.index), handler(
+            calculate_imputation_factors_method, factors_input,
+            distinct_values=distinct_values,
+            factors_parameters=runtime_variables["factors_parameters"])),
+        ("wrangler_merge_factors", len(non_responders.index), merge_factors),
+        ("apply_factors", len(apply_input.index), lambda: (
+            apply_factors_method.apply_factors(
+                apply_input.copy(), questions_list, sum_columns))),
+        ("apply_factors_method", len(apply_input.index), handler(
+            apply_factors_method, apply_input, sum_columns=sum_columns)),
+        ("pipeline", len(data.index), lambda: imputation_pipeline.run_imputation(
+            data, runtime_variables, RESPONSE_TYPE)),
+        ("pipeline_rollup", len(data.index), lambda: imputation_pipeline.run_imputation(
+            data, {**runtime_variables, "rollup": True}, RESPONSE_TYPE)),
+        ("pipeline_prune", len(data.index), lambda: imputation_pipeline.run_imputation(
+            data, {**runtime_variables, "prune": True}, RESPONSE_TYPE))
+    ]
+
+
+def time_case(name, rows, function, repeats=3):
+    """
+    Times a benchmark case, then runs it once more to find its peak memory, so the
+    memory tracing does not slow down the timed runs.
+    :param name: Name of the case. - Type: String
+    :param rows: Number of input rows. - Type: Int
+    :param function: Runs the case. - Type: Function
+    :param repeats: Number of timed runs. The fastest is reported. - Type: Int
+    :return: The case's result. - Type: Dict
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(timings)
+    return {
+        "mean_seconds": sum(timings) / len(timings),
+        "name": name,
+        "peak_memory_mb": peak_memory / 1024 ** 2,
+        "rows": rows,
+        "rows_per_second": rows / seconds if seconds else float("inf"),
+        "seconds": seconds
+    }
+
+
+def compare_results(previous, current):
+    """
+    Compares the throughput of the cases in both reports.
+    :param previous: An earlier report. - Type: Dict
+    :param current: The new report. - Type: Dict
+    :return: Percentage change in rows/sec of each case in both. - Type: Dict
+    """
+    previous_results = {result["name"]: result for result in previous["results"]}
+    changes = {}
+    for result in current["results"]:
+        if result["name"] not in previous_results:
+            continue
+        previous_rate = previous_results[result["name"]]["rows_per_second"]
+        changes[result["name"]] = \
+            (result["rows_per_second"] / previous_rate - 1) * 100
+
+    return changes
+
+
+def _with_columns(df, columns, value):
+    # The wranglers add each method's output columns before invoking it.
+    df = df.copy()
+    for column in columns:
+        df[column] = value
+
+    return df
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+
+from imputation_functions import produce_columns
+
+SURVEY_TYPES = {
+    "sand_gravel": {
+        "distinct_values": ["region", "strata"],
+        "factors_parameters": {
+            "factors_type": "factors_calculation_a",
+            "first_imputation_factor": 0,
+            "first_threshold": 3,
+            "percentage_movement": True,
+            "region_column": "region",
+            "regional_mean": "third_imputation_factors",
+            "regionless_code": 14,
+            "second_imputation_factor": 1,
+            "second_threshold": 3,
+            "survey_column": "survey",
+            "third_threshold": 5
+        },
+        "movement_type": "movement_calculation_a",
+        "questions": [
+            "Q601_asphalting_sand",
+            "Q602_building_soft_sand",
+            "Q603_concreting_sand",
+            "Q604_bituminous_gravel",
+            "Q605_concreting_gravel",
+            "Q606_other_gravel",
+            "Q607_constructional_fill"
+        ],
+        "surveys": ["066", "076"],
+        "total_column": "Q608_total"
+    },
+    "bricks_blocks": {
+        "distinct_values": ["region", "strata"],
+        "factors_parameters": {
+            "factors_type": "factors_calculation_b",
+            "region_column": "region",
+            "regionless_code": 14,
+            "threshold": 7
+        },
+        "movement_type": "movement_calculation_b",
+        "questions": [
+            "Q501_clay_commons",
+            "Q502_clay_facings",
+            "Q503_clay_engineering",
+            "Q504_concrete",
+            "Q505_sandlime"
+        ],
+        "surveys": ["074"],
+        "total_column": "Q506_total"
+    }
+}
+
+
+def generate_survey(survey_type="sand_gravel", references=1000, regions=12, strata=5,
+                    questions=None, non_response_rate=0.1, period="201809",
+                    previous_period="201806", seed=0):
+    """
+    Generates a synthetic survey with a current and a previous period, laid out like
+    the input to the Calculate Movements Wrangler.
+    :param survey_type: One of SURVEY_TYPES. - Type: String
+    :param references: Number of contributors. - Type: Int
+    :param regions: Number of regions, numbered from 1. - Type: Int
+    :param strata: Number of strata, lettered from A. - Type: Int
+    :param questions: Number of questions, up to the survey type's. All if None.
+                      - Type: Int
+    :param non_response_rate: Share of current period non-responders. - Type: Float
+    :param period: The current period. - Type: String
+    :param previous_period: The previous period. - Type: String
+    :param seed: Seed for the random numbers. - Type: Int
+    :return: Survey data for both periods. - Type: DataFrame
+    """
+    settings = SURVEY_TYPES[survey_type]
+    questions_list = settings["questions"][:questions]
+    generator = np.random.default_rng(seed)
+
+    contributors = pd.DataFrame({
+        "responder_id": np.arange(references, dtype=np.int64) + 20000000000,
+        "region": generator.integers(1, regions + 1, references),
+        "strata": np.array([chr(ord("A") + value) for value in range(strata)])[
+            generator.integers(0, strata, references)],
+        "survey": np.array(settings["surveys"])[
+            generator.integers(0, len(settings["surveys"]), references)]
+    })
+
+    previous_values = np.where(
+        generator.random((references, len(questions_list))) < 0.3, 0,
+        generator.integers(1, 100000, (references, len(questions_list))))
+    growth = generator.normal(1.0, 0.2, (references, len(questions_list)))
+    current_values = np.where(
+        generator.random((references, len(questions_list))) < 0.05, 0,
+        np.round(previous_values * np.clip(growth, 0, None)).astype(np.int64))
+
+    periods = []
+    for period_value, values, response_type in [
+        (previous_period, previous_values, np.full(references, 2)),
+        (period, current_values,
+         np.where(generator.random(references) < non_response_rate, 1, 2))
+    ]:
+        period_data = contributors.copy()
+        period_data["period"] = int(period_value)
+        period_data["response_type"] = response_type
+        for index, question in enumerate(questions_list):
+            period_data[question] = np.where(response_type == 1, 0, values[:, index])
+        period_data[settings["total_column"]] = period_data[questions_list].sum(axis=1)
+        periods.append(period_data)
+
+    return pd.concat(periods, ignore_index=True)
+
+
+def runtime_variables(survey_type="sand_gravel", questions=None, period="201809"):
+    """
+    Produces the runtime variables for running a generated survey through the
+    imputation pipeline.
+    :param survey_type: One of SURVEY_TYPES. - Type: String
+    :param questions: Number of questions, as given to generate_survey. - Type: Int
+    :param period: The current period. - Type: String
+    :return: Loaded RuntimeVariables for imputation_pipeline.run_imputation.
+             - Type: Dict
+    """
+    settings = SURVEY_TYPES[survey_type]
+    questions_list = settings["questions"][:questions]
+
+    return {
+        "distinct_values": list(settings["distinct_values"]),
+        "factors_parameters": {"RuntimeVariables": dict(settings["factors_parameters"])},
+        "iqrs_engine": "groupby",
+        "movement_type": settings["movement_type"],
+        "period": period,
+        "period_column": "period",
+        "periodicity": "03",
+        "prune": False,
+        "questions_list": questions_list,
+        "rollup": False,
+        "sum_columns": [{
+            "column_name": settings["total_column"],
+            "data": dict.fromkeys(produce_columns("", questions_list), "+")
+        }],
+        "unique_identifier": ["responder_id"]
+    }
@@ -1,13 +1,14 @@
 import logging
 
-import pandas as pd
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
 import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -16,7 +17,6 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
     factors_parameters = fields.Dict(required=True)
@@ -40,6 +40,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -49,21 +50,22 @@ def lambda_handler(event, context):
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Pick Correct Schema
-        factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
-        factors_type = factors_parameters["factors_type"]
-        factors_name = ''.join(word.title() for word in factors_type.split('_'))
-        factors_schema = getattr(imp_func, factors_name + "Schema")
-
-        factors = factors_schema().load(factors_parameters)
+        factors_type, factors = load_factors(
+            runtime_variables["factors_parameters"]["RuntimeVariables"])
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
-        df = pd.DataFrame(runtime_variables["data"])
+        df = transfer_functions.load_data(runtime_variables)
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
         questions_list = runtime_variables["questions_list"]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        transfer_functions.check_data(
+            df, imp_func.produce_columns("movement_", questions_list, suffix="_count") +
+            imp_func.produce_columns("mean_", questions_list), distinct_values)
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -79,61 +81,22 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", df,
+                       event["RuntimeVariables"].get("encoded_data"))
 
-        # Get relative calculation function
-        calculation = getattr(imp_func, factors_type)
-
-        # Pass the distinct values to the factors function in its parameters
-        factors["distinct_values"] = distinct_values
-
-        # Some surveys will need to use the regional mean, extract them ahead of time
-        if "regional_mean" in factors:
-            region_column = factors["region_column"]
-            regional_mean = factors["regional_mean"]
-            regionless_code = factors["regionless_code"]
-            survey_column = factors["survey_column"]
-
-            # split to get only regionless data
-            gb_rows = df.loc[df[region_column] == regionless_code]
-
-            # produce column names
-            means_columns = imp_func.produce_columns("mean_", questions_list)
-            counts_columns = imp_func.\
-                produce_columns("movement_", questions_list, suffix="_count")
-            gb_columns = \
-                means_columns +\
-                counts_columns +\
-                distinct_values +\
-                [survey_column]
-
-            factor_columns = imp_func.\
-                produce_columns("imputation_factor_",
-                                questions_list,
-                                distinct_values+[survey_column])
-
-            # select only gb columns and then drop duplicates, leaving one row per strata
-            gb_rows = gb_rows[gb_columns].drop_duplicates()
-            factors[regional_mean] = ""
-
-            # calculate gb factors ahead of time
-            gb_rows = gb_rows.apply(
-                lambda x: calculation(x, questions_list, **factors), axis=1)
-
-            # reduce gb_rows to distinct_values, survey, and the factors
-            gb_factors = gb_rows[factor_columns]
-
-            # add gb_factors to factors parameters to send to calculation
-            factors[regional_mean] = gb_factors
-
-        df = df.apply(lambda x: calculation(x, questions_list, **factors),
-                      axis=1)
+        df = calculate_imputation_factors(df, factors_type, factors, questions_list,
+                                          distinct_values)
         logger.info("Calculated Factors for " + str(questions_list))
 
         factors_dataframe = df
 
         logger.info("Successfully finished calculations of factors")
 
-        final_output = {"data": factors_dataframe.to_json(orient="records")}
+        metrics.record("compute", factors_dataframe)
+        final_output = transfer_functions.method_output(
+            factors_dataframe, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -145,5 +108,101 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
+
+
+def load_factors(factors_parameters):
+    """
+    Validates the factors parameters with the schema matching their factors_type.
+    :param factors_parameters: Parameters for the factors calculation. - Type: Dict
+    :return: The factors_type and the loaded parameters. - Type: Tuple
+    """
+    factors_type = factors_parameters["factors_type"]
+    factors_name = ''.join(word.title() for word in factors_type.split('_'))
+    factors_schema = getattr(imp_func, factors_name + "Schema")
+
+    return factors_type, factors_schema().load(factors_parameters)
+
+
+def calculate_imputation_factors(df, factors_type, factors, questions_list,
+                                 distinct_values):
+    """
+    Calculates the imputation factors, working out the GB factors first for surveys
+    which use the regional mean.
+    :param df: Data with the means and counts of movements. - Type: DataFrame
+    :param factors_type: Name of the calculation function. - Type: String
+    :param factors: Parameters loaded by load_factors. - Type: Dict
+    :param questions_list: List of question names. - Type: List
+    :param distinct_values: Columns the factors are grouped by. - Type: List
+    :return: Data with the imputation factors populated. - Type: DataFrame
+    """
+    factors = dict(factors)
+
+    # Pass the distinct values to the factors function in its parameters
+    factors["distinct_values"] = distinct_values
+
+    # Some surveys will need to use the regional mean, extract them ahead of time
+    if "regional_mean" in factors:
+        region_column = factors["region_column"]
+        regional_mean = factors["regional_mean"]
+        regionless_code = factors["regionless_code"]
+        survey_column = factors["survey_column"]
+
+        # split to get only regionless data
+        gb_rows = df.loc[df[region_column] == regionless_code]
+
+        # produce column names
+        means_columns = imp_func.produce_columns("mean_", questions_list)
+        counts_columns = imp_func.\
+            produce_columns("movement_", questions_list, suffix="_count")
+        gb_columns = \
+            means_columns +\
+            counts_columns +\
+            distinct_values +\
+            [survey_column]
+
+        factor_columns = imp_func.\
+            produce_columns("imputation_factor_",
+                            questions_list,
+                            distinct_values+[survey_column])
+
+        # select only gb columns and then drop duplicates, leaving one row per strata
+        gb_rows = gb_rows[gb_columns].drop_duplicates()
+        factors[regional_mean] = ""
+
+        # calculate gb factors ahead of time
+        gb_rows = calculate_factors(gb_rows, factors_type, questions_list,
+                                    factors)
+
+        # reduce gb_rows to distinct_values, survey, and the factors
+        gb_factors = gb_rows[factor_columns]
+
+        # index gb_factors once, and add them to the factors parameters to send
+        # to calculation
+        factors[regional_mean] = imp_func.FactorsLookup(
+            gb_factors, questions_list, distinct_values, region_column)
+
+    return calculate_factors(df, factors_type, questions_list, factors)
+
+
+def calculate_factors(df, factors_type, questions_list, factors):
+    """
+    Calculates the imputation factors for every row of the DataFrame. Where the
+    imputation functions provide a whole-frame version of the calculation
+    (named <factors_type>_frame) it is used, otherwise the row-by-row
+    calculation is applied.
+    :param df: Data to calculate the factors for. - Type: DataFrame
+    :param factors_type: Name of the calculation function. - Type: String
+    :param questions_list: List of question names. - Type: List
+    :param factors: Parameters for the calculation function. - Type: Dict
+    :return: Data with the imputation factors populated. - Type: DataFrame
+    """
+    frame_calculation = getattr(imp_func, factors_type + "_frame", None)
+    if frame_calculation is not None:
+        return frame_calculation(df, questions_list, **factors)
+
+    calculation = getattr(imp_func, factors_type)
+    return df.apply(lambda x: calculation(x, questions_list, **factors), axis=1)
@@ -1,13 +1,16 @@
-import json
 import logging
 import os
 
 import boto3
-import pandas as pd
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf, Range
 
+import execution_functions
 import imputation_functions as imp_func
+import metrics_functions
+import storage_functions
+import transfer_functions
 
 
 class EnvironmentSchema(Schema):
@@ -19,8 +22,12 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    execution_backend = fields.Str(
+        missing="lambda", validate=OneOf(execution_functions.BACKENDS))
     method_name = fields.Str(required=True)
     run_environment = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
 
 
 class RuntimeSchema(Schema):
@@ -32,11 +39,18 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
+    cells = fields.Nested(imp_func.CellsSchema, missing=None, allow_none=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
     factors_parameters = fields.Dict(required=True)
     in_file_name = fields.Str(required=True)
     out_file_name = fields.Str(required=True)
+    partitions = fields.Int(missing=1, validate=Range(min=1))
+    pass_by_reference = fields.Bool(missing=False)
+    payload_encoding = fields.Str(
+        missing="records", validate=OneOf(transfer_functions.AVAILABLE_ENCODINGS))
     period_column = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
     sns_topic_arn = fields.Str(required=True)
@@ -59,31 +73,41 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        # Set up clients
-        lambda_client = boto3.client("lambda", region_name="eu-west-2")
-
         environment_variables = EnvironmentSchema().load(os.environ)
 
+        # Set up clients
+        if environment_variables["execution_backend"] == "local":
+            lambda_client = execution_functions.LocalLambdaClient()
+        else:
+            lambda_client = boto3.client("lambda", region_name="eu-west-2")
+
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
         method_name = environment_variables["method_name"]
         run_environment = environment_variables["run_environment"]
+        storage_backend = environment_variables["storage_backend"]
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        cells = runtime_variables["cells"]
+        data_format = runtime_variables["data_format"]
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
         factors_parameters = runtime_variables["factors_parameters"]
         in_file_name = runtime_variables["in_file_name"]
         out_file_name = runtime_variables["out_file_name"]
+        partitions = runtime_variables["partitions"]
+        pass_by_reference = runtime_variables["pass_by_reference"]
+        payload_encoding = runtime_variables["payload_encoding"]
         period_column = runtime_variables["period_column"]
         questions_list = runtime_variables["questions_list"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
@@ -105,10 +129,24 @@ def lambda_handler(event, context):
     try:
         logger.info("Started - retrieved configuration variables.")
 
-        data = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
+        data = storage_functions.read_dataframe(bucket_name, in_file_name,
+                                                data_format, storage_backend)
+        metrics.record("read", data)
 
         logger.info("Successfully retrieved data")
 
+        # Only the cells with non-responders, planned by the movement wrangler, and
+        # the all-GB cells they fall back to need factors.
+        if cells is not None:
+            data, report = imp_func.prune_cells(
+                data, storage_functions.read_dataframe(
+                    bucket_name, cells["file_name"], data_format, storage_backend),
+                cells["distinct_values"], cells["region_column"],
+                cells["regionless_code"], True)
+            metrics.record("prune", data, details=report)
+            logger.info(f"Pruned to the cells with non-responders, skipping "
+                        f"{report['skipped_rows']} of {report['input_rows']} rows.")
+
         factor_columns = imp_func.\
             produce_columns("imputation_factor_", questions_list)
 
@@ -116,33 +154,35 @@ def lambda_handler(event, context):
         for factor in factor_columns:
             data[factor] = 0
 
-        payload = {
-            "RuntimeVariables": {
-                "bpm_queue_url": bpm_queue_url,
-                "data": json.loads(data.to_json(orient="records")),
-                "environment": environment,
-                "questions_list": questions_list,
-                "distinct_values": distinct_values,
-                "factors_parameters": factors_parameters,
-                "run_id": run_id,
-                "survey": survey
-            }
+        # Regional factors can use the GB factors of the same group, so when they do
+        # every region of a group is kept in the same partition.
+        partition_columns = list(distinct_values)
+        if "regional_mean" in factors_parameters["RuntimeVariables"]:
+            region_column = factors_parameters["RuntimeVariables"]["region_column"]
+            partition_columns.remove(region_column)
+
+        metrics.record("prepare", data)
+        data_reference = None
+        if pass_by_reference:
+            data_reference = transfer_functions.reference_payload(
+                bucket_name, out_file_name, data_format, storage_backend,
+                result_suffix="_method_output")
+
+        method_variables = {
+            "bpm_queue_url": bpm_queue_url,
+            "environment": environment,
+            "questions_list": questions_list,
+            "distinct_values": distinct_values,
+            "factors_parameters": factors_parameters,
+            "run_id": run_id,
+            "survey": survey
         }
 
         # invoke the method to calculate the factors
-        calculate_factors = lambda_client.invoke(
-            FunctionName=method_name, Payload=json.dumps(payload)
-        )
+        output_df = execution_functions.invoke_partitions(
+            lambda_client, method_name, method_variables, data, partition_columns,
+            partitions, payload_encoding, data_reference, metrics)
         logger.info("Successfully invoked method.")
-
-        json_response = json.loads(
-            calculate_factors.get("Payload").read().decode("UTF-8"))
-        logger.info("JSON extracted from method response.")
-
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
-
-        output_df = pd.read_json(json_response["data"], dtype=False)
         distinct_values.append(period_column)
         columns_to_keep = imp_func.produce_columns(
                                              "imputation_factor_",
@@ -150,12 +190,15 @@ def lambda_handler(event, context):
                                              distinct_values
                                             )
 
-        final_df = output_df[columns_to_keep].drop_duplicates().to_json(orient="records")
-        aws_functions.save_to_s3(bucket_name, out_file_name, final_df)
+        final_df = output_df[columns_to_keep].drop_duplicates()
+        storage_functions.save_dataframe(bucket_name, out_file_name, final_df,
+                                         data_format, storage_backend)
+        metrics.record("save", final_df)
         logger.info("Successfully sent data to s3.")
 
         if run_environment != "development":
-            logger.info(aws_functions.delete_data(bucket_name, in_file_name))
+            logger.info(storage_functions.delete_data(bucket_name, in_file_name,
+                                                      storage_backend))
             logger.info("Successfully deleted input data.")
 
         aws_functions.send_sns_message(sns_topic_arn, "Imputation - Calculate Factors.")
@@ -172,4 +215,5 @@ def lambda_handler(event, context):
 
     logger.info("Successfully completed module: " + current_module)
 
-    return {"success": True}
+    metrics.emit(run_id, survey)
+    return {"success": True, "metrics": metrics.summary()}
@@ -1,13 +1,15 @@
 import logging
 
-import pandas as pd
+import numpy as np
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
 import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -16,10 +18,10 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
+    rollup = fields.Nested(imp_func.RollupSchema, missing=None, allow_none=True)
     survey = fields.Str(required=True)
 
 
@@ -41,6 +43,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -53,10 +56,16 @@ def lambda_handler(event, context):
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
-        json_data = runtime_variables["data"]
+        input_data = transfer_functions.load_data(runtime_variables)
         questions_list = runtime_variables["questions_list"]
+        rollup = runtime_variables["rollup"]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        transfer_functions.check_data(
+            input_data, imp_func.produce_columns("movement_", questions_list),
+            distinct_values)
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -72,60 +81,21 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
 
-        movement_columns = imp_func.produce_columns("movement_", questions_list)
-
-        df = pd.DataFrame(json_data)
+        df = input_data
 
         logger.info("Successfully retrieved data from event.")
 
-        workingdf = df[movement_columns+distinct_values]
-
-        counts = workingdf.groupby(distinct_values).count()
-        # Rename columns to fit naming standards
-        for column in movement_columns:
-            counts.rename(
-                columns={
-                    column: column + "_count"
-                },
-                inplace=True,
-            )
-
-        # Create DataFrame which sums the movements grouped by region and strata
-        sums = workingdf.groupby(distinct_values).sum()
-
-        # Rename columns to fit naming standards
-        for column in movement_columns:
-            sums.rename(
-                columns={
-                    column: column + "_sum"
-                },
-                inplace=True,
-            )
-
-        counts = counts.reset_index(level=distinct_values)
-        sums = sums.reset_index(level=distinct_values)
-        moves = sums.merge(
-            counts,
-            left_on=distinct_values,
-            right_on=distinct_values,
-            how="left",
-        )
-
-        # Join on movements and counts on region & strata to DataFrame
-        df = pd.merge(df, moves, on=distinct_values, how="left")
-
-        for question in questions_list:
-            df["mean_" + question] = df.apply(
-                lambda x: x["movement_" + question + "_sum"]
-                / x["movement_" + question + "_count"]
-                if x["movement_" + question + "_count"] > 0 else 0,
-                axis=1,
-            )
+        df = calculate_means(df, questions_list, distinct_values, rollup)
 
         logger.info("Successfully finished calculations of means.")
 
-        final_output = {"data": df.to_json(orient="records")}
+        metrics.record("compute", df)
+        final_output = transfer_functions.method_output(df, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -137,5 +107,97 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
+
+
+def calculate_means(df, questions_list, distinct_values, rollup=None, statistics=None,
+                    regionless_statistics=None):
+    """
+    Adds the sum, count and mean of each question's movements within its
+    region/strata group to every row.
+    :param df: Data containing the movement columns. - Type: DataFrame
+    :param questions_list: List of question names. - Type: List
+    :param distinct_values: Column names to group on. - Type: List
+    :param rollup: For rolled up data, without all-GB rows, the region_column and
+                   regionless_code. The mean of each row's all-GB cell is then added
+                   as a regionless_mean_ column. With emit_regionless, the all-GB
+                   rows are produced instead, with their own sums, counts and means.
+                   - Type: Dict
+    :param statistics: The sums and counts of the cells, to find the means from
+                       rather than grouping the data. - Type: CellStatistics
+    :param regionless_statistics: The sums and counts of the all-GB cells of rolled
+                                  up data. - Type: CellStatistics
+    :return: A copy of the data with movement_*_sum, movement_*_count and mean_*
+             columns. - Type: DataFrame
+    """
+    df = df.copy()
+    movement_columns = imp_func.produce_columns("movement_", questions_list)
+    if statistics is None:
+        results = _group_means(df, movement_columns, distinct_values)
+    else:
+        results = statistics.results(df)
+    _add_means(df, questions_list, results)
+
+    if rollup is not None:
+        # The all-GB cells are the regional cells without region. Their movements
+        # are in the regionless_ columns once atypicals have been removed.
+        prefix = imp_func.REGIONLESS_PREFIX
+        source_columns = [prefix + column if prefix + column in df.columns else column
+                          for column in movement_columns]
+        group_keys = imp_func.regionless_values(distinct_values,
+                                                rollup["region_column"])
+        if regionless_statistics is not None:
+            results = regionless_statistics.results(df)
+        else:
+            if len(group_keys) == 0:
+                group_keys = np.zeros(len(df.index), dtype=np.int64)
+            results = _group_means(df, source_columns, group_keys)
+
+        if rollup.get("emit_regionless"):
+            _add_means(df, questions_list, results, prefix)
+            df = imp_func.add_regionless_rows(df, rollup["region_column"],
+                                              rollup["regionless_code"])
+        else:
+            for question, (_, _, means) in zip(questions_list, results):
+                df[prefix + "mean_" + question] = means
+
+    return df
+
+
+def _group_means(df, movement_columns, group_keys):
+    # Aggregate every movement column in one pass, then broadcast each group's
+    # results back to its rows by group number.
+    grouped = df.groupby(group_keys)[movement_columns]
+    aggregated = grouped.agg(["sum", "count"])
+    if len(aggregated.index) == 0:
+        # Every row is missing a group value, so each is in no group.
+        return [(np.full(len(df.index), np.nan), np.zeros(len(df.index), dtype=np.int64),
+                 np.zeros(len(df.index))) for _ in movement_columns]
+
+    group_number = grouped.ngroup().to_numpy()
+    in_group = group_number >= 0
+    group_number = np.where(in_group, group_number, 0).astype(np.int64)
+
+    results = []
+    for column in movement_columns:
+        sums = np.where(
+            in_group, aggregated[(column, "sum")].to_numpy()[group_number], np.nan)
+        counts = np.where(
+            in_group, aggregated[(column, "count")].to_numpy()[group_number], 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = np.where(counts > 0, sums / counts, 0)
+        results.append((sums, counts, means))
+
+    return results
+
+
+def _add_means(df, questions_list, results, prefix=""):
+    for question, (sums, _, _) in zip(questions_list, results):
+        df[prefix + "movement_" + question + "_sum"] = sums
+    for question, (_, counts, _) in zip(questions_list, results):
+        df[prefix + "movement_" + question + "_count"] = counts
+    for question, (_, _, means) in zip(questions_list, results):
+        df[prefix + "mean_" + question] = means
@@ -1,13 +1,16 @@
 import logging
 
+import numpy as np
 import pandas as pd
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
 import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -15,15 +18,16 @@ class RuntimeSchema(Schema):
         logging.error(f"Error validating runtime params: {e}")
         raise ValueError(f"Error validating runtime params: {e}")
 
+    aligned = fields.Bool(missing=False)
     bpm_queue_url = fields.Str(required=True)
     current_period = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     environment = fields.Str(required=True)
     movement_type = fields.Str(required=True)
     period_column = fields.Str(required=True)
     previous_period = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
     survey = fields.Str(required=True)
+    unique_identifier = fields.List(fields.String, required=True)
 
 
 def lambda_handler(event, context):
@@ -44,6 +48,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -53,16 +58,26 @@ def lambda_handler(event, context):
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Runtime Variables
+        aligned = runtime_variables["aligned"]
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         current_period = runtime_variables["current_period"]
         environment = runtime_variables["environment"]
-        json_data = runtime_variables["data"]
+        input_data = transfer_functions.load_data(runtime_variables)
         movement_type = runtime_variables["movement_type"]
         period_column = runtime_variables["period_column"]
         previous_period = runtime_variables["previous_period"]
         questions_list = runtime_variables["questions_list"]
+        reference = runtime_variables["unique_identifier"][0]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        numeric_columns = questions_list
+        if aligned:
+            numeric_columns = questions_list + \
+                imp_func.produce_columns("prev_", questions_list)
+        transfer_functions.check_data(input_data, numeric_columns,
+                                      [period_column, reference])
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -78,40 +93,23 @@ def lambda_handler(event, context):
 
     try:
         logger.info("Started - retrieved configuration variables.")
-
-        # Get relative calculation function
-        calculation = getattr(imp_func, movement_type)
-
-        df = pd.DataFrame(json_data)
-
-        sorted_current = df[df[period_column].astype("str") == str(current_period)].copy()
-        sorted_previous = df[df[period_column].astype("str") == str(previous_period)]
-
-        for question in questions_list:
-
-            # Converted to list due to issues with Numpy dtypes and math operations.
-            current_list = sorted_current[question].tolist()
-            previous_list = sorted_previous[question].tolist()
-
-            result_list = []
-
-            # len is used so the correct amount of iterations for the loop.
-            for i in range(0, len(sorted_current)):
-
-                # This check is too prevent the DivdebyZeroError.
-                if previous_list[i] != 0:
-                    number = calculation(current_list[i], previous_list[i])
-                else:
-                    number = 0.0
-
-                result_list.append(number)
-
-            sorted_current["movement_" + question] = result_list
-
-        filled_dataframe = sorted_current.fillna(0.0)
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
+
+        if aligned:
+            filled_dataframe = calculate_aligned_movements(input_data, movement_type,
+                                                           questions_list)
+        else:
+            filled_dataframe = calculate_period_movements(
+                input_data, movement_type, period_column, current_period,
+                previous_period, questions_list, reference)
         logger.info("Successfully finished calculations of movement.")
 
-        final_output = {"data": filled_dataframe.to_json(orient="records")}
+        metrics.record("compute", filled_dataframe)
+        final_output = transfer_functions.method_output(
+            filled_dataframe, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -123,5 +121,92 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
+
+
+def calculate_period_movements(df, movement_type, period_column, current_period,
+                               previous_period, questions_list, reference):
+    """
+    Calculates the movements for the current period rows of data holding both periods.
+    :param df: Current and previous period data. - Type: DataFrame
+    :param movement_type: Name of the movement function. - Type: String
+    :param period_column: Name of the period column. - Type: String
+    :param current_period: The current period. - Type: String
+    :param previous_period: The previous period. - Type: String
+    :param questions_list: Question columns to calculate movements for. - Type: List
+    :param reference: Column which uniquely identifies a contributor. - Type: String
+    :return: Current period data with the movement columns. - Type: DataFrame
+    """
+    # Get relative calculation function
+    calculation = getattr(imp_func, movement_type)
+
+    sorted_current = df[df[period_column].astype("str") == str(current_period)].copy()
+    sorted_previous = df[df[period_column].astype("str") == str(previous_period)]
+
+    movements = calculate_movements(sorted_current, sorted_previous, questions_list,
+                                    reference, calculation)
+    for question in questions_list:
+        sorted_current["movement_" + question] = movements[question]
+
+    return sorted_current.fillna(0.0)
+
+
+def calculate_aligned_movements(df, movement_type, questions_list):
+    """
+    Calculates the movements for data with the previous period's values alongside
+    the current period's, in prev_ columns.
+    :param df: Current period data with prev_ columns. - Type: DataFrame
+    :param movement_type: Name of the movement function. - Type: String
+    :param questions_list: Question columns to calculate movements for. - Type: List
+    :return: Current period data with the movement columns, without the prev_
+             columns. - Type: DataFrame
+    """
+    # Get relative calculation function
+    calculation = getattr(imp_func, movement_type)
+    previous_columns = imp_func.produce_columns("prev_", questions_list)
+
+    movements = movement_values(df[questions_list].to_numpy(dtype=float),
+                                df[previous_columns].to_numpy(dtype=float),
+                                calculation)
+    df = df.drop(previous_columns, axis=1)
+    for i in range(0, len(questions_list)):
+        df["movement_" + questions_list[i]] = movements[:, i]
+
+    return df.fillna(0.0)
+
+
+def calculate_movements(current, previous, questions_list, reference, calculation):
+    """
+    Calculates the movement of every question at once, matching each current period
+    row to the previous period row with the same reference.
+    :param current: Current period data. - Type: DataFrame
+    :param previous: Previous period data. - Type: DataFrame
+    :param questions_list: Question columns to calculate movements for. - Type: List
+    :param reference: Column which uniquely identifies a contributor. - Type: String
+    :param calculation: Movement function accepting arrays. - Type: Function
+    :return: Movements indexed like current, one column per question. - Type: DataFrame
+    """
+    aligned_previous = previous.set_index(reference)[questions_list]\
+        .reindex(current[reference])
+
+    movements = movement_values(current[questions_list].to_numpy(dtype=float),
+                                aligned_previous.to_numpy(dtype=float), calculation)
+
+    return pd.DataFrame(movements, index=current.index, columns=questions_list)
+
+
+def movement_values(current_values, previous_values, calculation):
+    """
+    Calculates movements from aligned arrays of current and previous values.
+    :param current_values: Current period values. - Type: Array
+    :param previous_values: Previous period values of the same rows. - Type: Array
+    :param calculation: Movement function accepting arrays. - Type: Function
+    :return: The movements. - Type: Array
+    """
+    # This check is too prevent dividing by zero.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(previous_values != 0,
+                        calculation(current_values, previous_values), 0.0)
@@ -1,11 +1,18 @@
-import json
 import logging
 import os
 
 import boto3
+import numpy as np
 import pandas as pd
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf, Range
+
+import execution_functions
+import imputation_functions as imp_func
+import metrics_functions
+import storage_functions
+import transfer_functions
 
 
 class EnvironmentSchema(Schema):
@@ -17,8 +24,12 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    execution_backend = fields.Str(
+        missing="lambda", validate=OneOf(execution_functions.BACKENDS))
     method_name = fields.Str(required=True)
     response_type = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
 
 
 class RuntimeSchema(Schema):
@@ -30,14 +41,22 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
+    cells = fields.Nested(imp_func.CellsSchema, missing=None, allow_none=True)
     current_data = fields.Str(required=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
     environment = fields.Str(required=True)
     in_file_name = fields.Str(required=True)
     movement_type = fields.Str(required=True)
     out_file_name = fields.Str(required=True)
     out_file_name_skip = fields.Str(required=True)
+    partitions = fields.Int(missing=1, validate=Range(min=1))
+    pass_by_reference = fields.Bool(missing=False)
+    payload_encoding = fields.Str(
+        missing="records", validate=OneOf(transfer_functions.AVAILABLE_ENCODINGS))
     period = fields.Str(required=True)
     period_column = fields.Str(required=True)
+    period_partitioned = fields.Bool(missing=False)
     periodicity = fields.Str(required=True)
     previous_data = fields.Str(required=True)
     questions_list = fields.List(fields.String, required=True)
@@ -66,6 +85,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
     current_step_num = 4
 
     try:
@@ -73,28 +93,38 @@ def lambda_handler(event, context):
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        # Set up clients
-        lambda_client = boto3.client("lambda", region_name="eu-west-2")
-
         environment_variables = EnvironmentSchema().load(os.environ)
 
+        # Set up clients
+        if environment_variables["execution_backend"] == "local":
+            lambda_client = execution_functions.LocalLambdaClient()
+        else:
+            lambda_client = boto3.client("lambda", region_name="eu-west-2")
+
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
         method_name = environment_variables["method_name"]
         response_type = environment_variables["response_type"]
+        storage_backend = environment_variables["storage_backend"]
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        cells = runtime_variables["cells"]
         current_data = runtime_variables["current_data"]
+        data_format = runtime_variables["data_format"]
         environment = runtime_variables["environment"]
         in_file_name = runtime_variables["in_file_name"]
         movement_type = runtime_variables["movement_type"]
         out_file_name = runtime_variables["out_file_name"]
         out_file_name_skip = runtime_variables["out_file_name_skip"]
+        partitions = runtime_variables["partitions"]
+        pass_by_reference = runtime_variables["pass_by_reference"]
+        payload_encoding = runtime_variables["payload_encoding"]
         period = runtime_variables["period"]
         period_column = runtime_variables["period_column"]
+        period_partitioned = runtime_variables["period_partitioned"]
         periodicity = runtime_variables["periodicity"]
         previous_data = runtime_variables["previous_data"]
         questions_list = runtime_variables["questions_list"]
@@ -124,22 +154,22 @@ def lambda_handler(event, context):
         aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
                                       current_step_num, total_steps)
 
-        data = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
-
         previous_period = general_functions.calculate_adjacent_periods(period,
                                                                        periodicity)
+        data = storage_functions.read_periods(bucket_name, in_file_name,
+                                              period_column, [period, previous_period],
+                                              data_format, storage_backend,
+                                              period_partitioned)
+        metrics.record("read", data)
         logger.info("Completed reading data from s3")
-        previous_period_data = data[
-            data[period_column].astype("str") == str(previous_period)]
-        data = data[
-            data[period_column].astype("str") == str(period)]
+        data, previous_period_data = split_periods(data, period_column, period,
+                                                   previous_period)
         logger.info("Split input data")
+        metrics.record("prepare", data)
 
         # Create a Dataframe where the response column
         # value is set as 1 i.e non responders
-        filtered_non_responders = data.loc[(data[response_type] == 1) &
-                                           (data[period_column].astype("str") ==
-                                            str(period))]
+        filtered_non_responders = data.loc[data[response_type] == 1]
 
         logger.info("Successfully created filtered non responders DataFrame")
 
@@ -149,25 +179,18 @@ def lambda_handler(event, context):
         if response_check > 0:
 
             # Save previous period data to s3 for apply to pick up later
-            aws_functions.save_to_s3(bucket_name, previous_data,
-                                     previous_period_data.to_json(orient="records"))
+            storage_functions.save_dataframe(bucket_name, previous_data,
+                                             previous_period_data, data_format,
+                                             storage_backend)
             # Save raw data to s3 for apply to pick up later
-            aws_functions.save_to_s3(bucket_name, current_data,
-                                     data.to_json(orient="records"))
+            storage_functions.save_dataframe(bucket_name, current_data, data,
+                                             data_format, storage_backend)
+            metrics.record("save")
             logger.info("Successfully sent data.")
 
-            # Ensure that only responder_ids with a response
-            # type of 2 (returned) get picked up
-            data = data[data[response_type] == 2]
-            previous_period_data = \
-                previous_period_data[previous_period_data[response_type] == 2]
-
-            # Ensure that only rows that exist in both current and previous get picked up.
-            data = data[data[reference].isin(previous_period_data[reference])].dropna()
-            previous_period_data = previous_period_data[previous_period_data[reference].isin(data[reference])].dropna()  # noqa e501
-
-            # Merged together so it can be sent via the payload to the method
-            merged_data = pd.concat([data, previous_period_data])
+            merged_data = prepare_movement_data(data, previous_period_data,
+                                                questions_list, reference,
+                                                response_type)
 
             # Make sure there is some data, non-responders were removed at this stage
             if len(merged_data.index) > 0:
@@ -175,41 +198,70 @@ def lambda_handler(event, context):
             else:
                 raise exception_classes.LambdaFailure("No data left after filtering")
 
-            for question in questions_list:
-                merged_data["movement_" + question] = 0.0
-
-            json_ordered_data = merged_data.to_json(orient="records")
-
-            json_payload = {
-                "RuntimeVariables": {
-                    "bpm_queue_url": bpm_queue_url,
-                    "current_period": period,
-                    "data": json.loads(json_ordered_data),
-                    "environment": environment,
-                    "movement_type": movement_type,
-                    "period_column": period_column,
-                    "previous_period": previous_period,
-                    "questions_list": questions_list,
-                    "run_id": run_id,
-                    "survey": survey
-                }
+            metrics.record("prepare", merged_data)
+
+            # Plan which cells need factors, so the later steps only work on those
+            # and the all-GB cells they fall back to.
+            if cells is not None:
+                demanded_cells = imp_func.demanded_cells(filtered_non_responders,
+                                                         cells["distinct_values"])
+                storage_functions.save_dataframe(bucket_name, cells["file_name"],
+                                                 demanded_cells, data_format,
+                                                 storage_backend)
+                merged_data, report = imp_func.prune_cells(
+                    merged_data, demanded_cells, cells["distinct_values"],
+                    cells["region_column"], cells["regionless_code"],
+                    regionless_added=False)
+                metrics.record("prune", merged_data, details=report)
+                logger.info(f"Pruned to {len(demanded_cells.index)} cells with "
+                            f"non-responders, skipping {report['skipped_rows']} of "
+                            f"{report['input_rows']} rows.")
+
+            data_reference = None
+            if pass_by_reference:
+                data_reference = transfer_functions.reference_payload(
+                    bucket_name, out_file_name, data_format, storage_backend)
+
+            method_variables = {
+                "aligned": True,
+                "bpm_queue_url": bpm_queue_url,
+                "current_period": period,
+                "environment": environment,
+                "movement_type": movement_type,
+                "period_column": period_column,
+                "previous_period": previous_period,
+                "questions_list": questions_list,
+                "run_id": run_id,
+                "survey": survey,
+                "unique_identifier": [reference]
             }
 
             logger.info("Successfully created movement columns on the data")
 
-            imputed_data = lambda_client.invoke(FunctionName=method_name,
-                                                Payload=json.dumps(json_payload))
-
-            logger.info("Successfully invoked method.")
-
-            json_response = json.loads(imputed_data.get("Payload").read().decode("UTF-8"))
-            logger.info("JSON extracted from method response.")
-
-            if not json_response["success"]:
-                raise exception_classes.MethodFailure(json_response["error"])
-
             imputation_run_type = "Calculate Movement."
-            aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
+            if partitions > 1:
+                output = execution_functions.invoke_partitions(
+                    lambda_client, method_name, method_variables, merged_data,
+                    [reference], partitions, payload_encoding, data_reference, metrics)
+                logger.info("Successfully invoked method.")
+                storage_functions.save_dataframe(bucket_name, out_file_name, output,
+                                                 data_format, storage_backend)
+            else:
+                payload = {
+                    "RuntimeVariables": {
+                        **method_variables,
+                        **transfer_functions.data_payload(merged_data, payload_encoding,
+                                                          data_reference)
+                    }
+                }
+                json_response = execution_functions.invoke_method(
+                    lambda_client, method_name, payload, metrics)
+                logger.info("Successfully invoked method.")
+                transfer_functions.save_method_data(
+                    bucket_name, out_file_name, json_response, payload_encoding,
+                    data_format, storage_backend)
+                transfer_functions.delete_reference(data_reference)
+            metrics.record("save")
 
             logger.info("Successfully sent the data to s3")
 
@@ -218,8 +270,9 @@ def lambda_handler(event, context):
             to_be_imputed = False
             imputation_run_type = "Has Not Run."
 
-            aws_functions.save_to_s3(bucket_name, out_file_name_skip,
-                                     data.to_json(orient="records"))
+            storage_functions.save_dataframe(bucket_name, out_file_name_skip, data,
+                                             data_format, storage_backend)
+            metrics.record("save", data)
 
             logger.info("Successfully sent the unchanged data to s3")
 
@@ -242,7 +295,84 @@ def lambda_handler(event, context):
 
     logger.info("Successfully completed module: " + current_module)
 
+    metrics.emit(run_id, survey)
     return {
         "success": True,
-        "impute": to_be_imputed
+        "impute": to_be_imputed,
+        "metrics": metrics.summary()
     }
+
+
+def split_periods(data, period_column, period, previous_period):
+    """
+    Splits the input data into the current and previous periods.
+    :param data: Data for both periods. - Type: DataFrame
+    :param period_column: Name of the period column. - Type: String
+    :param period: The current period. - Type: String
+    :param previous_period: The previous period. - Type: String
+    :return: Current period data, previous period data. - Type: Tuple
+    """
+    codes = period_codes(data[period_column], [period, previous_period])
+
+    return data[codes == 0], data[codes == 1]
+
+
+def period_codes(period_values, periods):
+    """
+    Finds which of the periods each row is in. Periods match as strings, as
+    before, but the period column is only converted once: an integer column is
+    compared as integers, anything else as strings.
+    :param period_values: The period column. - Type: Series
+    :param periods: The periods. - Type: List
+    :return: Position in periods of each row's period, or -1. - Type: Array
+    """
+    integer = pd.api.types.is_integer_dtype(period_values)
+    keys = period_values.to_numpy() if integer else \
+        period_values.astype("str").to_numpy()
+    periods = storage_functions.period_keys(periods, integer)
+
+    codes = np.full(len(keys), -1, dtype=np.int64)
+    for position, period in enumerate(periods):
+        if period is not None:
+            codes[(keys == period) & (codes < 0)] = position
+
+    return codes
+
+
+def prepare_movement_data(data, previous_period_data, questions_list, reference,
+                          response_type):
+    """
+    Prepares the data for the movement method: the returned responses which are in
+    both periods, aligned on reference, with the previous period's values in prev_
+    columns and a movement column per question.
+    :param data: Current period data. - Type: DataFrame
+    :param previous_period_data: Previous period data. - Type: DataFrame
+    :param questions_list: List of question names. - Type: List
+    :param reference: Column which uniquely identifies a contributor. - Type: String
+    :param response_type: Name of the response type column. - Type: String
+    :return: Data for the movement method, one row per reference. - Type: DataFrame
+    """
+    # Ensure that only responder_ids with a response
+    # type of 2 (returned) get picked up
+    data = data[data[response_type] == 2].dropna()
+    previous_period_data = \
+        previous_period_data[previous_period_data[response_type] == 2]
+
+    # Previous period rows with missing values are left out, so the current period
+    # row has no previous values and gets no movements.
+    previous_values = previous_period_data[[reference] + questions_list]
+    missing = previous_period_data.isnull().any(axis=1).to_numpy()
+    if missing.any():
+        previous_values = previous_values.astype(dict.fromkeys(questions_list, float))
+        previous_values.loc[missing, questions_list] = np.nan
+
+    # Ensure that only rows that exist in both current and previous get picked up.
+    aligned_data = data.merge(
+        previous_values.rename(columns=dict(zip(
+            questions_list, imp_func.produce_columns("prev_", questions_list)))),
+        on=reference, how="inner")
+
+    for question in questions_list:
+        aligned_data["movement_" + question] = 0.0
+
+    return aligned_data
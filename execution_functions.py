@@ -0,0 +1,189 @@
+import importlib
+import io
+import json
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from es_aws_functions import exception_classes
+
+import transfer_functions
+from imputation_functions import partition_groups
+
+BACKENDS = ["lambda", "local"]
+# The deployed method Lambdas and the modules whose handlers they run. Any other
+# method name is taken to be the name of a module.
+METHOD_MODULES = {
+    "es-add-regionless-method": "add_regionless_method",
+    "es-imputation-apply-factors-method": "apply_factors_method",
+    "es-imputation-atypicals-method": "atypicals_method",
+    "es-imputation-calculate-factors-method": "calculate_imputation_factors_method",
+    "es-imputation-calculate-means-method": "calculate_means_method",
+    "es-imputation-calculate-movement-method": "calculate_movement_method",
+    "es-imputation-iqrs-method": "iqrs_method"
+}
+
+_local_executors = {}
+
+
+class LocalLambdaClient:
+    """
+    Runs methods in a pool of local processes instead of on Lambda. Its invoke takes
+    and returns what the Lambda client's does, so the wranglers use either one in
+    the same way.
+    """
+
+    def __init__(self, workers=None):
+        self.executor = local_executor(workers)
+
+    def invoke(self, FunctionName, Payload):
+        """
+        Runs a method's handler in one of the pool's processes.
+        :param FunctionName: Name of the method Lambda or module. - Type: String
+        :param Payload: The method's event, as JSON. - Type: String
+        :return: The method's response, as the Lambda client returns it. - Type: Dict
+        """
+        module_name = METHOD_MODULES.get(FunctionName, FunctionName)
+        method_response = self.executor.submit(run_method, module_name,
+                                               Payload).result()
+
+        return {
+            "Payload": io.BytesIO(method_response.encode("UTF-8")),
+            "StatusCode": 200
+        }
+
+
+def local_executor(workers=None):
+    """
+    Gives the process pool used to run methods locally. Pools are kept, so a
+    process running several wranglers starts its worker processes once.
+    :param workers: Number of processes. The number of CPUs if None. - Type: Int
+    :return: The process pool. - Type: ProcessPoolExecutor
+    """
+    if workers not in _local_executors:
+        # Workers are spawned rather than forked, as the wranglers invoke from
+        # several threads at once.
+        _local_executors[workers] = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    return _local_executors[workers]
+
+
+def run_method(module_name, payload):
+    """
+    Runs a method's handler, as Lambda would.
+    :param module_name: The method's module. - Type: String
+    :param payload: The method's event, as JSON. - Type: String
+    :return: The method's response, as JSON. - Type: String
+    """
+    method = importlib.import_module(module_name)
+
+    return json.dumps(method.lambda_handler(json.loads(payload), None))
+
+
+def invoke_method(lambda_client, method_name, payload, metrics=None):
+    """
+    Invokes a method and reads its response.
+    :param lambda_client: boto3 Lambda client. - Type: Client
+    :param method_name: Name of the method Lambda. - Type: String
+    :param payload: The method's event, including its data. - Type: Dict
+    :param metrics: Records the serialise and invoke stages. - Type: StageMetrics
+    :return: The method's response. - Type: Dict
+    """
+    method_payload = json.dumps(payload)
+    if metrics is not None:
+        metrics.record("serialise", payload=method_payload)
+
+    return _invoke_serialised(lambda_client, method_name, method_payload, metrics)
+
+
+def _invoke_serialised(lambda_client, method_name, method_payload, metrics=None):
+    returned_data = lambda_client.invoke(FunctionName=method_name,
+                                         Payload=method_payload)
+
+    method_response = returned_data.get("Payload").read().decode("UTF-8")
+    json_response = json.loads(method_response)
+    if metrics is not None:
+        metrics.record("invoke", payload=method_response)
+        metrics.record_method(json_response)
+
+    if not json_response["success"]:
+        raise exception_classes.MethodFailure(json_response["error"])
+
+    return json_response
+
+
+def invoke_partitions(lambda_client, method_name, method_variables, data,
+                      group_columns=None, partitions=1, payload_encoding="records",
+                      data_reference=None, metrics=None):
+    """
+    Splits the data into partitions, invokes the method on every partition at once
+    and joins the results in partition order.
+    :param lambda_client: boto3 Lambda client. - Type: Client
+    :param method_name: Name of the method Lambda. - Type: String
+    :param method_variables: The method's RuntimeVariables, apart from the data.
+                             - Type: Dict
+    :param data: The prepared data. - Type: DataFrame
+    :param group_columns: Columns whose groups the method works on. Groups are never
+                          split. None when the method works on each row on its own.
+                          - Type: List
+    :param partitions: Number of partitions to aim for. - Type: Int
+    :param payload_encoding: One of transfer_functions.ENCODINGS. - Type: String
+    :param data_reference: Locations from reference_payload, if passing by reference.
+                           Each partition uses part_reference of them. - Type: Dict
+    :param metrics: Records the fan-out's stages. - Type: StageMetrics
+    :return: The method's output for all of the data. - Type: DataFrame
+    """
+    max_rows = max(math.ceil(len(data.index) / partitions), 1)
+    if group_columns is None:
+        parts = [data.iloc[rows] for rows in
+                 np.array_split(np.arange(len(data.index)), partitions)
+                 if len(rows) > 0]
+    else:
+        parts = partition_groups(data, group_columns, max_rows)
+    if len(parts) == 0:
+        parts = [data]
+
+    if len(parts) == 1:
+        # A single partition is sent exactly as it would be without partitioning.
+        part_references = [data_reference]
+    else:
+        part_references = [transfer_functions.part_reference(data_reference, part)
+                           for part in range(len(parts))]
+
+    payloads = [
+        {
+            "RuntimeVariables": {
+                **method_variables,
+                **transfer_functions.data_payload(part, payload_encoding,
+                                                  part_reference)
+            }
+        } for part, part_reference in zip(parts, part_references)
+    ]
+
+    if len(payloads) == 1:
+        responses = [invoke_method(lambda_client, method_name, payloads[0], metrics)]
+    else:
+        method_payloads = [json.dumps(payload) for payload in payloads]
+        if metrics is not None:
+            metrics.record("serialise", payload=method_payloads)
+        with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+            responses = list(executor.map(
+                lambda method_payload: _invoke_serialised(lambda_client, method_name,
+                                                          method_payload),
+                method_payloads))
+        if metrics is not None:
+            metrics.record("invoke")
+            metrics.record_method(responses)
+
+    outputs = []
+    for response, part_reference in zip(responses, part_references):
+        outputs.append(transfer_functions.method_dataframe(response, payload_encoding))
+        transfer_functions.delete_reference(part_reference, delete_result=True)
+    output = pd.concat(outputs, ignore_index=True)
+    if metrics is not None:
+        metrics.record("deserialise", output)
+
+    return output
@@ -1,8 +1,12 @@
 from types import SimpleNamespace
 
+import numpy as np
 import pandas as pd
 from marshmallow import EXCLUDE, Schema, fields
 
+# Prefix of the columns holding the all-GB view of each row in rolled up data.
+REGIONLESS_PREFIX = "regionless_"
+
 
 class FactorsSchema(Schema):
     region_column = fields.Str(required=True)
@@ -41,12 +45,34 @@ class ExtendedFactorsCalculationASchema(FactorsCalculationASchema):
     third_imputation_factors = fields.Field(required=True)
 
 
+class RollupSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    emit_regionless = fields.Bool(missing=False)
+    region_column = fields.Str(required=True)
+    regionless_code = fields.Int(required=True)
+
+
+class CellsSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    distinct_values = fields.List(fields.String, required=True)
+    file_name = fields.Str(required=True)
+    region_column = fields.Str(required=True)
+    regionless_code = fields.Int(required=True)
+
+
 def movement_calculation_a(current_value, previous_value):
     """
     Movements calculation for Sand and Gravel.
-    :param current_value: The current value for the current period - Type: Integer(?)
-    :param previous_value: The current value for the previous period - Type: Integer(?)
-    :return: Calculation value - Type: Integer(?)
+    Works element-wise when given NumPy arrays or Series.
+    :param current_value: The current value for the current period
+                          - Type: Number/Array
+    :param previous_value: The current value for the previous period
+                           - Type: Number/Array
+    :return: Calculation value - Type: Number/Array
     """
     number = (current_value - previous_value) / previous_value
     return number
@@ -55,9 +81,12 @@ def movement_calculation_a(current_value, previous_value):
 def movement_calculation_b(current_value, previous_value):
     """
     Movements calculation for Bricks/Blocks.
-    :param current_value: The current value for the current period - Type: Integer(?)
-    :param previous_value: The current value for the previous period - Type: Integer(?)
-    :return: Calculation value - Type: Integer(?)
+    Works element-wise when given NumPy arrays or Series.
+    :param current_value: The current value for the current period
+                          - Type: Number/Array
+    :param previous_value: The current value for the previous period
+                           - Type: Number/Array
+    :return: Calculation value - Type: Number/Array
     """
     number = current_value / previous_value
     return number
@@ -80,8 +109,8 @@ def factors_calculation_a(row, questions, **kwargs):
         - third_threshold: One of three thresholds to compare the question count to.
         - first_imputation_factor: One of three factors to be assigned to the question.
         - second_imputation_factor: One of three factors to be assigned to the question.
-        - third_imputation_factors: A Dataframe containing factors
-        to be assigned to the questions.
+        - third_imputation_factors: A Dataframe or FactorsLookup containing
+        factors to be assigned to the questions.
         - region_column: The name of the column that holds region.
         - regionless_code: The value used as 'all GB' in the 'region_column'
         - survey_column: Column name of the dataframe containing the survey code.
@@ -121,29 +150,11 @@ def factors_calculation_a(row, questions, **kwargs):
         else:
             if row["movement_" + question + "_count"] < int(
                     runtime_object.third_threshold):
-                factor_filter = ""
-
-                # Ignore region in matching columns (we need to find the all-gb data)
-                if runtime_object.region_column in runtime_object.distinct_values:
-                    runtime_object.distinct_values.remove(runtime_object.region_column)
-
-                if len(runtime_object.distinct_values) < 1:
-                    row["imputation_factor_" + question] = \
-                        float(pd.to_numeric(
-                            runtime_object.third_imputation_factors[
-                                "imputation_factor_" + question].take([0])))
-                else:
-                    # Find the correct mean (region or region+strata handling)
-                    for value in runtime_object.distinct_values:
-                        if value != runtime_object.distinct_values[0]:
-                            factor_filter += " & "
-                        factor_filter += "(%s == '%s')" % (value, row[value])
-
-                    row["imputation_factor_" + question] = \
-                        float(pd.to_numeric(
-                            runtime_object.third_imputation_factors.query(
-                                str(factor_filter))["imputation_factor_" + question]
-                            .take([0])))
+                gb_factors = FactorsLookup.from_factors(
+                    runtime_object.third_imputation_factors, questions,
+                    runtime_object.distinct_values, runtime_object.region_column)
+                row["imputation_factor_" + question] = \
+                    gb_factors.factor(row, question)
 
             else:
                 row["imputation_factor_" + question] =\
@@ -157,6 +168,165 @@ def factors_calculation_a(row, questions, **kwargs):
     return row
 
 
+def factors_calculation_a_frame(df, questions, **kwargs):
+    """
+    Calculates the imputation factors for the whole DataFrame at once.
+    Produces the same imputation_factor_ columns as applying factors_calculation_a
+    to every row, using boolean masks per branch and a single lookup to find the
+    all-GB factor of regional cells below the third threshold.
+
+    :param df: DataFrame
+    :param questions: question names in columns
+    :param kwargs: The same parameters as factors_calculation_a.
+
+    :return: DataFrame
+    """
+
+    runtime_object = SimpleNamespace(**kwargs)
+    df = df.copy()
+
+    regionless = df[runtime_object.region_column] == runtime_object.regionless_code
+    survey = df[runtime_object.survey_column]
+    adjustment = 1.0 if runtime_object.percentage_movement else 0.0
+
+    regionless_thresholds = [
+        ("066",
+         getattr(runtime_object, "first_threshold", None),
+         getattr(runtime_object, "first_imputation_factor", None)),
+        ("076",
+         getattr(runtime_object, "second_threshold", None),
+         getattr(runtime_object, "second_imputation_factor", None))
+    ]
+    other_surveys = regionless & ~survey.isin(
+        [survey_code for survey_code, _, _ in regionless_thresholds])
+
+    gb_factors = None
+
+    for question in questions:
+        count = df["movement_" + question + "_count"]
+        mean = pd.to_numeric(df["mean_" + question]).astype(float)
+
+        # Regional cells at or above the threshold use their own mean.
+        factor = mean + adjustment
+
+        for survey_code, threshold, imputation_factor in regionless_thresholds:
+            rows = regionless & (survey == survey_code)
+            if rows.any():
+                factor[rows] = np.where(count[rows] < int(threshold),
+                                        float(imputation_factor),
+                                        mean[rows]) + adjustment
+
+        factor[other_surveys] = adjustment
+
+        below_threshold = ~regionless & (count < int(runtime_object.third_threshold))
+        if below_threshold.any():
+            if gb_factors is None:
+                gb_factors = FactorsLookup.from_factors(
+                    runtime_object.third_imputation_factors, questions,
+                    runtime_object.distinct_values,
+                    runtime_object.region_column).lookup(df)
+
+            gb_factor = gb_factors["imputation_factor_" + question][below_threshold]
+            if gb_factor.isnull().any():
+                raise ValueError("No all-GB imputation factor found for " + question)
+
+            factor[below_threshold] = gb_factor
+
+        df["imputation_factor_" + question] = factor
+
+    return df
+
+
+class FactorsLookup:
+    """
+    Finds the all-GB imputation factors of a cell from its distinct values other
+    than region. The factors are indexed once, so each lookup is a hash lookup
+    rather than a search of the factors. Where several rows share a cell, the
+    first is used.
+    """
+
+    def __init__(self, factors, questions, distinct_values, region_column):
+        """
+        :param factors: A Dataframe containing the all-GB factors. - Type: DataFrame
+        :param questions: question names in columns. - Type: List
+        :param distinct_values: Array of column names to derive distinct values from
+                                and store in table. - Type: List
+        :param region_column: The name of the column that holds region. - Type: String
+        """
+        self.factor_columns = produce_columns("imputation_factor_", questions)
+        self.match_columns = [value for value in distinct_values
+                              if value != region_column]
+
+        if len(self.match_columns) < 1:
+            factors = factors.iloc[:1]
+        else:
+            factors = factors.drop_duplicates(self.match_columns)
+        self.factors = factors[self.factor_columns].apply(pd.to_numeric)\
+            .to_numpy(dtype=float)
+        self.columns = {column: position
+                        for position, column in enumerate(self.factor_columns)}
+        self.index = None
+        if self.match_columns:
+            self.index = pd.MultiIndex.from_frame(factors[self.match_columns])
+            keys = factors[self.match_columns].itertuples(index=False, name=None)
+        else:
+            keys = [()] * len(factors.index)
+        self.key_positions = {key: position for position, key in enumerate(keys)}
+
+    @classmethod
+    def from_factors(cls, factors, questions, distinct_values, region_column):
+        """
+        Indexes the factors, unless they already are.
+        :param factors: A Dataframe or FactorsLookup of the all-GB factors.
+        :return: FactorsLookup
+        """
+        if isinstance(factors, cls):
+            return factors
+
+        return cls(factors, questions, distinct_values, region_column)
+
+    def factor(self, row, question):
+        """
+        Finds the all-GB factor of a single row.
+        :param row: row of DataFrame, or a dict of the distinct values.
+        :param question: The question name.
+        :return: The factor. - Type: Float
+        """
+        key = tuple(row[value] for value in self.match_columns)
+        if key not in self.key_positions:
+            raise ValueError("No all-GB imputation factor found for " + question)
+
+        return float(self.factors[self.key_positions[key],
+                                  self.columns["imputation_factor_" + question]])
+
+    def positions(self, df):
+        """
+        Finds the position of the all-GB factors matching each row of the DataFrame.
+        :param df: DataFrame containing the distinct values.
+        :return: Positions in the indexed factors, or -1 for rows without an all-GB
+                 factor. - Type: Array
+        """
+        if len(self.factors) == 0:
+            return np.full(len(df.index), -1, dtype=np.int64)
+        if self.index is None:
+            return np.zeros(len(df.index), dtype=np.int64)
+
+        return self.index.get_indexer(pd.MultiIndex.from_frame(df[self.match_columns]))
+
+    def lookup(self, df):
+        """
+        Finds the all-GB factors matching each row of the DataFrame.
+        :param df: DataFrame containing the distinct values.
+        :return: DataFrame of imputation_factor_ columns indexed like df. Rows
+                 without an all-GB factor are null.
+        """
+        positions = self.positions(df)
+        values = np.full((len(df.index), len(self.factor_columns)), np.nan)
+        values[positions >= 0] = self.factors[positions[positions >= 0]]
+
+        return pd.DataFrame(values, index=df.index, columns=self.factor_columns)
+
+
 def factors_calculation_b(row, questions, **kwargs):
     """
     Calculates the imputation factors for the DataFrame on row by row basis.
@@ -183,6 +353,47 @@ def factors_calculation_b(row, questions, **kwargs):
     return row
 
 
+def factors_calculation_b_frame(df, questions, **kwargs):
+    """
+    Calculates the imputation factors for the whole DataFrame at once.
+    Produces the same imputation_factor_ columns as applying factors_calculation_b
+    to every row.
+
+    :param df: DataFrame
+    :param questions: A list of question names
+    :param kwargs: A dictionary of the following parameters:
+        - threshold: The threshold to compare the question count to.
+
+    :return: DataFrame
+    """
+
+    runtime_object = SimpleNamespace(**kwargs)
+    df = df.copy()
+
+    for question in questions:
+        df["imputation_factor_" + question] = np.where(
+            df["movement_" + question + "_count"] < int(runtime_object.threshold),
+            df["mean_" + question], 0)
+
+    return df
+
+
+def sas_round_array(values):
+    """
+    Rounds half away from zero, as general_functions.sas_round does for a single
+    number, over a whole array or Series at once.
+    :param values: Values to be rounded - Type: Array/Series
+    :return: Rounded values, as integers unless any are missing - Type: Array
+    """
+    values = np.asarray(values, dtype=float)
+    rounded = np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+    if np.isnan(rounded).any():
+        return rounded
+
+    return rounded.astype(np.int64)
+
+
 def produce_columns(prefix, columns, additional=[], suffix=""):
     """
     Produces columns with a prefix, based on standard columns.
@@ -201,3 +412,328 @@ def produce_columns(prefix, columns, additional=[], suffix=""):
     new_columns = new_columns + additional
 
     return new_columns
+
+
+def partition_groups(df, group_columns, max_rows):
+    """
+    Splits a DataFrame into partitions without splitting any group, so each
+    partition can be processed on its own. Groups are taken in order of their
+    values and added to a partition until it holds max_rows rows. A single group
+    larger than max_rows makes up a partition on its own.
+    :param df: DataFrame to be split. - Type: DataFrame
+    :param group_columns: Columns which define the groups. - Type: List
+    :param max_rows: Rows to aim for in each partition. - Type: Int
+    :return: The partitions, in order. - Type: List
+    """
+    if len(df.index) == 0:
+        return []
+    if len(group_columns) == 0:
+        return [df]
+
+    group_number = df.groupby(group_columns, sort=True).ngroup().to_numpy()
+    # Rows with a missing group value are not numbered, so they go last.
+    in_group = group_number >= 0
+    group_number = np.where(in_group, group_number,
+                            group_number[in_group].max() + 1 if in_group.any() else 0)\
+        .astype(np.int64)
+    group_sizes = np.bincount(group_number)
+
+    partition_of_group = np.zeros(len(group_sizes), dtype=np.int64)
+    partition = 0
+    rows = 0
+    for group in range(len(group_sizes)):
+        if rows > 0 and rows + group_sizes[group] > max_rows:
+            partition += 1
+            rows = 0
+        partition_of_group[group] = partition
+        rows += group_sizes[group]
+
+    row_partition = partition_of_group[group_number]
+    order = np.argsort(row_partition, kind="stable")
+    boundaries = np.searchsorted(row_partition[order], np.arange(1, partition + 1))
+
+    return [df.iloc[rows] for rows in np.split(order, boundaries)]
+
+
+def group_numbers(df, group_columns):
+    """
+    Numbers the groups of a DataFrame, as groupby finds them.
+    :param df: DataFrame to be grouped. - Type: DataFrame
+    :param group_columns: Columns which define the groups. With none, every row is
+                          in the same group. - Type: List
+    :return: The group number of each row, -1 for rows missing a group value as
+             groupby leaves them out, and the number of groups. - Type: Tuple
+    """
+    if len(group_columns) == 0:
+        return np.zeros(len(df.index), dtype=np.int64), min(len(df.index), 1)
+
+    numbers = df.groupby(group_columns, sort=False).ngroup().to_numpy()
+    in_group = numbers >= 0
+    numbers = np.where(in_group, numbers, -1).astype(np.int64)
+
+    return numbers, int(numbers.max()) + 1 if in_group.any() else 0
+
+
+def regionless_values(distinct_values, region_column):
+    """
+    Produces the columns which define the all-GB cells.
+    :param distinct_values: Columns which define the regional cells. - Type: List
+    :param region_column: The name of the column that holds region. - Type: String
+    :return: distinct_values without the region column. - Type: List
+    """
+    return [value for value in distinct_values if value != region_column]
+
+
+def add_regionless_rows(df, region_column, regionless_code):
+    """
+    Turns rolled up data into the layout add_regionless produces. Every row is
+    followed by a copy with the regionless code as its region, which takes the
+    values of the row's regionless_ columns. The regionless_ columns are dropped.
+    :param df: Rolled up data. - Type: DataFrame
+    :param region_column: The name of the column that holds region. - Type: String
+    :param regionless_code: Region code for all of GB. - Type: Int
+    :return: The regional rows followed by the all-GB rows. - Type: DataFrame
+    """
+    rollup_columns = [column for column in df.columns
+                      if column.startswith(REGIONLESS_PREFIX)]
+    regional_data = df.drop(rollup_columns, axis=1)
+
+    regionless_data = regional_data.copy()
+    regionless_data[region_column] = regionless_code
+    for column in rollup_columns:
+        regional_column = column[len(REGIONLESS_PREFIX):]
+        if regional_column in regionless_data.columns:
+            regionless_data[regional_column] = df[column]
+
+    return pd.concat([regional_data, regionless_data])
+
+
+def demanded_cells(non_responders, distinct_values):
+    """
+    Finds the cells which need imputation factors: those with a non-responder.
+    :param non_responders: Current period non-responders. - Type: DataFrame
+    :param distinct_values: Columns which define the cells. - Type: List
+    :return: One row per cell. - Type: DataFrame
+    """
+    return non_responders[distinct_values].drop_duplicates().reset_index(drop=True)
+
+
+def prune_cells(df, cells, distinct_values, region_column, regionless_code,
+                regionless_added=True):
+    """
+    Keeps only the rows needed for the factors of the given cells: the rows of the
+    cells and of the all-GB cells they fall back to. Until the all-GB rows are
+    added, an all-GB cell is made of the regional rows of every region, so those
+    are all kept.
+    :param df: Data to be pruned. - Type: DataFrame
+    :param cells: The cells which need factors, from demanded_cells. - Type: DataFrame
+    :param distinct_values: Columns which define the cells. - Type: List
+    :param region_column: The name of the column that holds region. - Type: String
+    :param regionless_code: Region code for all of GB. - Type: Int
+    :param regionless_added: Whether df holds the all-GB rows. - Type: Boolean
+    :return: The kept rows and a report of the cells and rows skipped. - Type: Tuple
+    """
+    keep = _in_cells(df, cells, regionless_values(distinct_values, region_column))
+    if regionless_added:
+        keep &= _in_cells(df, cells, distinct_values) | \
+            (df[region_column] == regionless_code).to_numpy()
+    pruned = df if keep.all() else df[keep]
+
+    numbers, total_cells = group_numbers(df, distinct_values)
+    kept_numbers = numbers[keep]
+    report = {
+        "input_cells": total_cells,
+        "input_rows": len(df.index),
+        "skipped_cells": total_cells - len(np.unique(kept_numbers[kept_numbers >= 0])),
+        "skipped_rows": len(df.index) - len(pruned.index)
+    }
+
+    return pruned, report
+
+
+def _in_cells(df, cells, columns):
+    # Whether each row's values of the columns match one of the cells. The cells and
+    # rows are numbered together, so matching values share a number.
+    if len(columns) == 0:
+        return np.full(len(df.index), len(cells.index) > 0)
+
+    numbers, _ = group_numbers(
+        pd.concat([cells[columns], df[columns]], ignore_index=True), columns)
+    cell_numbers = numbers[:len(cells.index)]
+
+    return np.isin(numbers[len(cells.index):], cell_numbers[cell_numbers >= 0])
+
+
+class CellStatistics:
+    """
+    Holds the sum and count of each question's movements in every cell, apart from
+    the data, so they can be kept between stages. They are updated as rows are
+    added, removed or found to be atypical, by grouping only those rows, and the
+    means are then found without grouping all the rows again.
+    """
+
+    def __init__(self, keys, questions, sums, counts):
+        """
+        :param keys: The values of the cells' group columns, one row per cell.
+                     - Type: DataFrame
+        :param questions: question names in columns. - Type: List
+        :param sums: Sum of each question's movements, per cell. - Type: Array
+        :param counts: Number of each question's movements, per cell. - Type: Array
+        """
+        self.group_columns = list(keys.columns)
+        self.keys = keys.reset_index(drop=True)
+        self.questions = list(questions)
+        self.sums = np.asarray(sums, dtype=float)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    @classmethod
+    def from_data(cls, df, questions, group_columns, movement_columns=None):
+        """
+        Groups the data's movements by cell.
+        :param df: Data containing the movement columns. - Type: DataFrame
+        :param questions: question names in columns. - Type: List
+        :param group_columns: Columns which define the cells. - Type: List
+        :param movement_columns: Columns holding each question's movements, if not
+                                 the movement_ columns. - Type: List
+        :return: CellStatistics
+        """
+        if movement_columns is None:
+            movement_columns = produce_columns("movement_", questions)
+        group_keys = group_columns
+        if len(group_columns) == 0:
+            group_keys = np.zeros(len(df.index), dtype=np.int64)
+
+        aggregated = df.groupby(group_keys)[movement_columns].agg(["sum", "count"])
+        keys = pd.DataFrame(index=range(len(aggregated.index)))
+        if len(group_columns) > 0:
+            keys = aggregated.index.to_frame(index=False)
+
+        return cls(keys, questions,
+                   aggregated.xs("sum", axis=1, level=1)[movement_columns].to_numpy(),
+                   aggregated.xs("count", axis=1, level=1)[movement_columns]
+                   .to_numpy())
+
+    @classmethod
+    def from_frame(cls, frame, questions, group_columns):
+        """
+        Reads statistics saved by to_frame.
+        :param frame: One row per cell. - Type: DataFrame
+        :param questions: question names in columns. - Type: List
+        :param group_columns: Columns which define the cells. - Type: List
+        :return: CellStatistics
+        """
+        return cls(frame[group_columns], questions,
+                   frame[produce_columns("movement_", questions, suffix="_sum")],
+                   frame[produce_columns("movement_", questions, suffix="_count")])
+
+    def to_frame(self):
+        """
+        Lays out the statistics for saving, one row per cell.
+        :return: The group columns and movement_*_sum and movement_*_count columns.
+                 - Type: DataFrame
+        """
+        return pd.concat([
+            self.keys,
+            pd.DataFrame(self.sums, columns=produce_columns(
+                "movement_", self.questions, suffix="_sum")),
+            pd.DataFrame(self.counts, columns=produce_columns(
+                "movement_", self.questions, suffix="_count"))
+        ], axis=1)
+
+    def positions(self, df):
+        """
+        Finds the cell of each row of the DataFrame.
+        :param df: DataFrame containing the group columns.
+        :return: Positions in the statistics, or -1 for rows in no cell.
+                 - Type: Array
+        """
+        if len(self.keys.index) == 0:
+            return np.full(len(df.index), -1, dtype=np.int64)
+        if len(self.group_columns) == 0:
+            return np.zeros(len(df.index), dtype=np.int64)
+
+        # Each column's values are numbered against the cells' values, and the
+        # numbers combined into one code per row, to find among the cells' codes.
+        row_codes = np.zeros(len(df.index), dtype=np.int64)
+        cell_codes = np.zeros(len(self.keys.index), dtype=np.int64)
+        found = np.ones(len(df.index), dtype=bool)
+        for column in self.group_columns:
+            values = pd.Index(self.keys[column].unique())
+            numbers = values.get_indexer(df[column])
+            found &= numbers >= 0
+            row_codes = row_codes * len(values) + numbers
+            cell_codes = cell_codes * len(values) + values.get_indexer(
+                self.keys[column])
+
+        order = np.argsort(cell_codes)
+        matches = np.minimum(np.searchsorted(cell_codes[order], row_codes),
+                             len(order) - 1)
+        found &= cell_codes[order][matches] == row_codes
+
+        return np.where(found, order[matches], -1)
+
+    def update(self, df, values, sign=1):
+        """
+        Adds rows' movements to the statistics of their cells, or with a sign of -1
+        removes them. Missing movements are left out, so only the rows with a
+        movement are grouped. Cells not yet held are added.
+        :param df: The rows, containing the group columns. - Type: DataFrame
+        :param values: The rows' movements, a column per question. - Type: Array
+        :param sign: 1 to add the rows, -1 to remove them. - Type: Int
+        :return: None
+        """
+        values = np.asarray(values, dtype=float).reshape(len(df.index), -1)
+        changed = ~np.isnan(values).all(axis=1)
+        keys = df.loc[changed, self.group_columns]
+        in_group = keys.notnull().all(axis=1).to_numpy()
+        keys = keys[in_group]
+        values = values[changed][in_group]
+
+        positions = self.positions(keys)
+        if (positions < 0).any():
+            new_keys = pd.DataFrame(index=range(1))
+            if len(self.group_columns) > 0:
+                new_keys = keys[positions < 0].drop_duplicates()
+            self.keys = pd.concat([self.keys, new_keys], ignore_index=True)
+            self.sums = np.vstack([self.sums, np.zeros((len(new_keys.index),
+                                                        len(self.questions)))])
+            self.counts = np.vstack([self.counts, np.zeros(
+                (len(new_keys.index), len(self.questions)), dtype=np.int64)])
+            positions = self.positions(keys)
+
+        cells = len(self.keys.index)
+        for question in range(len(self.questions)):
+            valid = ~np.isnan(values[:, question])
+            self.sums[:, question] += sign * np.bincount(
+                positions[valid], values[valid, question], cells)
+            self.counts[:, question] += sign * np.bincount(positions[valid],
+                                                           minlength=cells)
+        # A cell left empty has no sum, rather than the rounding left by removal.
+        self.sums[self.counts == 0] = 0.0
+
+    def results(self, df):
+        """
+        Finds the sum, count and mean of each question's movements in each row's
+        cell.
+        :param df: DataFrame containing the group columns.
+        :return: sums, counts and means, per question. Rows in no cell have a
+                 missing sum and no count or mean. - Type: List
+        """
+        if len(self.keys.index) == 0:
+            return [(np.full(len(df.index), np.nan),
+                     np.zeros(len(df.index), dtype=np.int64),
+                     np.zeros(len(df.index))) for _ in self.questions]
+
+        positions = self.positions(df)
+        in_group = positions >= 0
+        positions = np.where(in_group, positions, 0)
+
+        results = []
+        for question in range(len(self.questions)):
+            sums = np.where(in_group, self.sums[positions, question], np.nan)
+            counts = np.where(in_group, self.counts[positions, question], 0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means = np.where(counts > 0, sums / counts, 0)
+            results.append((sums, counts, means))
+
+        return results
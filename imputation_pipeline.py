@@ -0,0 +1,464 @@
+import logging
+import os
+
+import pandas as pd
+from es_aws_functions import aws_functions, exception_classes, general_functions
+from marshmallow import EXCLUDE, INCLUDE, Schema, fields
+from marshmallow.validate import Equal, OneOf
+
+import add_regionless_method
+import apply_factors_method
+import apply_factors_wrangler
+import atypicals_method
+import calculate_imputation_factors_method
+import calculate_means_method
+import calculate_movement_method
+import calculate_movement_wrangler
+import iqrs_method
+import metrics_functions
+import storage_functions
+from imputation_functions import (REGIONLESS_PREFIX, CellStatistics, demanded_cells,
+                                  produce_columns, prune_cells, regionless_values)
+
+
+class EnvironmentSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating environment params: {e}")
+        raise ValueError(f"Error validating environment params: {e}")
+
+    bucket_name = fields.Str(required=True)
+    response_type = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
+
+
+class FactorsSchema(Schema):
+    class Meta:
+        unknown = INCLUDE
+
+    factors_type = fields.Str(required=True)
+    region_column = fields.Str(required=True)
+    regionless_code = fields.Int(required=True)
+
+
+class IncrementalSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    changed_references = fields.List(fields.Raw, required=True)
+    previous_file_name = fields.Str(required=True)
+
+
+class RuntimeSchema(Schema):
+    class Meta:
+        unknown = EXCLUDE
+
+    def handle_error(self, e, data, **kwargs):
+        logging.error(f"Error validating runtime params: {e}")
+        raise ValueError(f"Error validating runtime params: {e}")
+
+    bpm_queue_url = fields.Str(required=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
+    distinct_values = fields.List(fields.String, required=True)
+    environment = fields.Str(required=True)
+    factors_parameters = fields.Dict(
+        keys=fields.String(validate=Equal(comparable="RuntimeVariables")),
+        values=fields.Nested(FactorsSchema, required=True))
+    in_file_name = fields.Str(required=True)
+    incremental = fields.Nested(IncrementalSchema, missing=None, allow_none=True)
+    iqrs_engine = fields.Str(missing="groupby")
+    movement_type = fields.Str(required=True)
+    out_file_name = fields.Str(required=True)
+    out_file_name_skip = fields.Str(required=True)
+    period = fields.Str(required=True)
+    period_column = fields.Str(required=True)
+    period_partitioned = fields.Bool(missing=False)
+    periodicity = fields.Str(required=True)
+    prune = fields.Bool(missing=False)
+    questions_list = fields.List(fields.String, required=True)
+    rollup = fields.Bool(missing=False)
+    sns_topic_arn = fields.Str(required=True)
+    sum_columns = fields.List(fields.Dict, required=True)
+    survey = fields.Str(required=True)
+    total_steps = fields.Int(required=True)
+    unique_identifier = fields.List(fields.String, required=True)
+
+
+def lambda_handler(event, context):
+    """
+    Runs the whole imputation chain (movements, add regionless, means, IQRS,
+    atypicals, recalculate means, factors and apply factors) in one process, on
+    DataFrames held in memory. It takes the same input file as the movement wrangler
+    and saves the same output as the apply factors wrangler, or the unchanged data
+    to out_file_name_skip when there are no non-responders.
+    :param event: Contains the runtime variables of every step. - Type: JSON
+    :param context: N/A
+    :return: Success & Impute/Error - Type: JSON
+    """
+    current_module = "Imputation Pipeline."
+    error_message = ""
+
+    # Define run_id outside of try block
+    run_id = 0
+
+    # Set-up variables for status message
+    bpm_queue_url = None
+    current_step_num = 4
+    metrics = metrics_functions.StageMetrics(current_module)
+
+    try:
+        # Retrieve run_id before input validation
+        # Because it is used in exception handling
+        run_id = event["RuntimeVariables"]["run_id"]
+
+        environment_variables = EnvironmentSchema().load(os.environ)
+
+        runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
+
+        # Environment Variables
+        bucket_name = environment_variables["bucket_name"]
+        response_type = environment_variables["response_type"]
+        storage_backend = environment_variables["storage_backend"]
+
+        # Runtime Variables
+        bpm_queue_url = runtime_variables["bpm_queue_url"]
+        data_format = runtime_variables["data_format"]
+        environment = runtime_variables["environment"]
+        in_file_name = runtime_variables["in_file_name"]
+        out_file_name = runtime_variables["out_file_name"]
+        out_file_name_skip = runtime_variables["out_file_name_skip"]
+        sns_topic_arn = runtime_variables["sns_topic_arn"]
+        survey = runtime_variables["survey"]
+        total_steps = runtime_variables["total_steps"]
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module, run_id,
+                                                           context=context)
+        raise exception_classes.LambdaFailure(error_message)
+
+    try:
+        logger = general_functions.get_logger(survey, current_module, environment,
+                                              run_id)
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module,
+                                                           run_id, context=context)
+        raise exception_classes.LambdaFailure(error_message)
+
+    try:
+        logger.info("Started - retrieved configuration variables.")
+
+        # Send in progress status to BPM.
+        status = "IN PROGRESS"
+        aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
+                                      current_step_num, total_steps)
+
+        # Only the current and previous periods are needed.
+        period = runtime_variables["period"]
+        data = storage_functions.read_periods(
+            bucket_name, in_file_name, runtime_variables["period_column"],
+            [period, general_functions.calculate_adjacent_periods(
+                period, runtime_variables["periodicity"])],
+            data_format, storage_backend, runtime_variables["period_partitioned"])
+        metrics.record("read", data)
+        logger.info("Successfully retrieved data")
+
+        incremental = runtime_variables["incremental"]
+        if incremental is None:
+            output_data, to_be_imputed = run_imputation(data, runtime_variables,
+                                                        response_type, metrics)
+        else:
+            # Only the cells of the changed references are imputed again.
+            previous_output = storage_functions.read_dataframe(
+                bucket_name, incremental["previous_file_name"], data_format,
+                storage_backend)
+            metrics.record("read", previous_output)
+            output_data, to_be_imputed = run_incremental_imputation(
+                data, previous_output, incremental["changed_references"],
+                runtime_variables, response_type, metrics)
+
+        if to_be_imputed:
+            imputation_run_type = "Pipeline."
+            output_file = out_file_name
+        else:
+            imputation_run_type = "Has Not Run."
+            output_file = out_file_name_skip
+        logger.info("Imputation - " + imputation_run_type)
+
+        storage_functions.save_dataframe(bucket_name, output_file, output_data,
+                                         data_format, storage_backend)
+        metrics.record("save", output_data)
+        logger.info("Successfully sent data to s3.")
+
+        aws_functions.send_sns_message(sns_topic_arn,
+                                       "Imputation - " + imputation_run_type)
+        logger.info("Successfully sent message to sns.")
+
+    except Exception as e:
+        error_message = general_functions.handle_exception(e, current_module,
+                                                           run_id, context=context,
+                                                           bpm_queue_url=bpm_queue_url)
+    finally:
+        if (len(error_message)) > 0:
+            logger.error(error_message)
+            raise exception_classes.LambdaFailure(error_message)
+
+    logger.info("Successfully completed module: " + current_module)
+
+    # Send end status to BPM.
+    status = "DONE"
+    aws_functions.send_bpm_status(bpm_queue_url, current_module, status, run_id,
+                                  current_step_num, total_steps)
+
+    metrics.emit(run_id, survey)
+    return {
+        "success": True,
+        "impute": to_be_imputed,
+        "metrics": metrics.summary()
+    }
+
+
+def run_imputation(data, runtime_variables, response_type, metrics=None):
+    """
+    Runs every imputation step on the input data, preparing the data for each
+    method as its wrangler does.
+    :param data: Current and previous period data. - Type: DataFrame
+    :param runtime_variables: Loaded RuntimeVariables. - Type: Dict
+    :param response_type: Name of the response type column. - Type: String
+    :param metrics: Records a stage for each step, named after the step.
+                    - Type: StageMetrics
+    :return: Imputed current period data, or the unchanged current period data if
+             there are no non-responders, and whether it was imputed. - Type: Tuple
+    """
+    distinct_values = runtime_variables["distinct_values"]
+    factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
+    iqrs_engine = runtime_variables["iqrs_engine"]
+    movement_type = runtime_variables["movement_type"]
+    period = runtime_variables["period"]
+    period_column = runtime_variables["period_column"]
+    periodicity = runtime_variables["periodicity"]
+    questions_list = runtime_variables["questions_list"]
+    reference = runtime_variables["unique_identifier"][0]
+    region_column = factors_parameters["region_column"]
+    regionless_code = factors_parameters["regionless_code"]
+    sum_columns = runtime_variables["sum_columns"]
+
+    atypical_columns = produce_columns("atyp_", questions_list)
+    iqrs_columns = produce_columns("iqrs_", questions_list)
+    mean_columns = produce_columns("mean_", questions_list)
+    movement_columns = produce_columns("movement_", questions_list)
+
+    if metrics is None:
+        metrics = metrics_functions.StageMetrics("Imputation Pipeline.")
+
+    previous_period = general_functions.calculate_adjacent_periods(period, periodicity)
+    current_data, previous_period_data = calculate_movement_wrangler.split_periods(
+        data, period_column, period, previous_period)
+
+    if not (current_data[response_type] == 1).any():
+        return current_data, False
+
+    # Calculate movements.
+    df = calculate_movement_wrangler.prepare_movement_data(
+        current_data, previous_period_data, questions_list, reference, response_type)
+    if len(df.index) == 0:
+        raise ValueError("No data left after filtering")
+    metrics.record("prepare", df)
+
+    # With prune, only the cells with non-responders, and the all-GB cells they fall
+    # back to, are worked on.
+    cells = None
+    if runtime_variables["prune"]:
+        cells = demanded_cells(current_data[current_data[response_type] == 1],
+                               distinct_values)
+        df = _prune(df, cells, distinct_values, region_column, regionless_code, False,
+                    metrics)
+
+    df = calculate_movement_method.calculate_aligned_movements(
+        df, movement_type, questions_list)
+    metrics.record("movements", df)
+
+    # Add the GB region, or with rollup calculate the all-GB cells alongside the
+    # regional cells and only add their rows once the means are recalculated.
+    rollup = None
+    if runtime_variables["rollup"]:
+        rollup = {"region_column": region_column, "regionless_code": regionless_code}
+    else:
+        df = add_regionless_method.add_regionless(df, region_column, regionless_code)\
+            .reset_index(drop=True)
+    metrics.record("regionless", df)
+    if cells is not None and rollup is None:
+        df = _prune(df, cells, distinct_values, region_column, regionless_code, True,
+                    metrics)
+
+    # Calculate means, keeping the sums and counts of each cell so the atypical
+    # movements can be removed from them rather than grouping every row again.
+    statistics = CellStatistics.from_data(df, questions_list, distinct_values)
+    regionless_statistics = None
+    if rollup is not None:
+        regionless_statistics = CellStatistics.from_data(
+            df, questions_list, regionless_values(distinct_values, region_column))
+    df = _zero_columns(df, mean_columns, 0.0)
+    df = calculate_means_method.calculate_means(df, questions_list, distinct_values,
+                                                rollup, statistics,
+                                                regionless_statistics)
+    metrics.record("means", df)
+
+    # Calculate IQRS.
+    df = _zero_columns(df, iqrs_columns, 0)
+    df = iqrs_method.calc_iqrs(df, movement_columns, iqrs_columns, distinct_values,
+                               engine=iqrs_engine, rollup=rollup)
+    metrics.record("iqrs", df)
+
+    # Calculate atypicals. Atypical movements are removed, stored as missing values.
+    df = _zero_columns(df, atypical_columns, 0)
+    df = atypicals_method.calc_atypicals(df, atypical_columns, movement_columns,
+                                         iqrs_columns, mean_columns, rollup,
+                                         statistics, regionless_statistics)
+    recalculate_columns = movement_columns
+    dropped_columns = atypical_columns + iqrs_columns
+    if rollup is not None:
+        recalculate_columns = movement_columns + \
+            produce_columns(REGIONLESS_PREFIX, movement_columns)
+        dropped_columns = dropped_columns + \
+            produce_columns(REGIONLESS_PREFIX, dropped_columns)
+        rollup["emit_regionless"] = True
+    df[recalculate_columns] = df[recalculate_columns].astype(float)
+    metrics.record("atypicals", df)
+
+    # Recalculate means without the atypical movements.
+    df = df.drop(produce_columns("movement_", questions_list, suffix="_count") +
+                 produce_columns("movement_", questions_list, suffix="_sum") +
+                 dropped_columns, axis=1)
+    df = _zero_columns(df, mean_columns, 0.0)
+    df = calculate_means_method.calculate_means(
+        df, questions_list, distinct_values, rollup, statistics,
+        regionless_statistics).reset_index(drop=True)
+    metrics.record("recalculate_means", df)
+    if cells is not None and rollup is not None:
+        df = _prune(df, cells, distinct_values, region_column, regionless_code, True,
+                    metrics)
+
+    # Calculate factors.
+    df = _zero_columns(df, produce_columns("imputation_factor_", questions_list), 0)
+    factors_type, factors = calculate_imputation_factors_method.load_factors(
+        factors_parameters)
+    df = calculate_imputation_factors_method.calculate_imputation_factors(
+        df, factors_type, factors, questions_list, distinct_values)
+    factors_dataframe = df[produce_columns(
+        "imputation_factor_", questions_list, distinct_values + [period_column]
+    )].drop_duplicates()
+    metrics.record("factors", factors_dataframe)
+
+    # Apply factors.
+    non_responders_with_factors = apply_factors_wrangler.merge_factors(
+        current_data[current_data[response_type] == 1], previous_period_data,
+        factors_dataframe, questions_list, distinct_values, reference, response_type,
+        region_column, regionless_code).reset_index(drop=True)
+    imputed_non_responders = apply_factors_method.apply_factors(
+        non_responders_with_factors, questions_list, sum_columns)
+    imputed_data = apply_factors_wrangler.combine_imputed(
+        current_data, imputed_non_responders, questions_list, response_type)
+    metrics.record("apply", imputed_data)
+
+    return imputed_data, True
+
+
+def run_incremental_imputation(data, previous_output, changed_references,
+                               runtime_variables, response_type, metrics=None):
+    """
+    Imputes again after some references have changed, such as for late returns,
+    giving the same output as run_imputation. The all-GB cells, which hold every
+    region's cells, are imputed independently of each other. So only the all-GB
+    cells of the changed references are run through every step, and the previous
+    output is kept for the rest.
+    :param data: Current and previous period data, with the changes. - Type: DataFrame
+    :param previous_output: Output of the last run, from run_imputation or
+                            run_incremental_imputation. - Type: DataFrame
+    :param changed_references: References whose data has changed, in either period.
+                               - Type: List
+    :param runtime_variables: Loaded RuntimeVariables. - Type: Dict
+    :param response_type: Name of the response type column. - Type: String
+    :param metrics: Records a stage for each step, named after the step.
+                    - Type: StageMetrics
+    :return: Imputed current period data, in the order of the current period data,
+             and whether it was imputed. - Type: Tuple
+    """
+    distinct_values = runtime_variables["distinct_values"]
+    factors_parameters = runtime_variables["factors_parameters"]["RuntimeVariables"]
+    period = runtime_variables["period"]
+    reference = runtime_variables["unique_identifier"][0]
+
+    if metrics is None:
+        metrics = metrics_functions.StageMetrics("Imputation Pipeline.")
+
+    current_data, previous_period_data = calculate_movement_wrangler.split_periods(
+        data, runtime_variables["period_column"], period,
+        general_functions.calculate_adjacent_periods(
+            period, runtime_variables["periodicity"]))
+    if not (current_data[response_type] == 1).any():
+        return current_data, False
+
+    # A changed reference may have moved cell, so its previous cell is included.
+    changed_cells = pd.concat([
+        current_data.loc[current_data[reference].isin(changed_references),
+                         distinct_values],
+        previous_output.loc[previous_output[reference].isin(changed_references),
+                            distinct_values]
+    ])
+    changed_current, report = prune_cells(
+        current_data, changed_cells, distinct_values,
+        factors_parameters["region_column"], factors_parameters["regionless_code"],
+        regionless_added=False)
+    metrics.record("changed", changed_current, details=report)
+
+    # Movements come from the cells of the current period, so the previous period
+    # rows of the same references are needed, whichever cell they were in.
+    changed_previous = previous_period_data[previous_period_data[reference].isin(
+        changed_current[reference])]
+    changed_data = pd.concat([changed_current, changed_previous])
+
+    changed_output = previous_output.iloc[:0]
+    if len(changed_cells.index) > 0:
+        movement_data = calculate_movement_wrangler.prepare_movement_data(
+            changed_current, changed_previous, runtime_variables["questions_list"],
+            reference, response_type)
+        if len(movement_data.index) > 0:
+            changed_output, _ = run_imputation(changed_data, runtime_variables,
+                                               response_type, metrics)
+        else:
+            # Without movements the changed cells get no factors, so as in a full
+            # run only their responders are kept.
+            changed_output = changed_current[changed_current[response_type] == 2]
+
+    # Non-responders left without factors are in neither output.
+    output_data = pd.concat([
+        previous_output[~previous_output[reference].isin(changed_current[reference])],
+        changed_output
+    ]).set_index(reference)
+    output_data = output_data.loc[current_data.loc[
+        current_data[reference].isin(output_data.index), reference]]\
+        .reset_index()[previous_output.columns]
+    metrics.record("combine", output_data)
+
+    return output_data, True
+
+
+def _prune(df, cells, distinct_values, region_column, regionless_code,
+           regionless_added, metrics):
+    df, report = prune_cells(df, cells, distinct_values, region_column,
+                             regionless_code, regionless_added)
+    metrics.record("prune", df, details=report)
+
+    return df.reset_index(drop=True)
+
+
+def _zero_columns(df, columns, value):
+    # The wranglers add each method's output columns before invoking it.
+    for column in columns:
+        df[column] = value
+
+    return df
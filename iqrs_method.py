@@ -1,13 +1,16 @@
 import logging
 
-import pandas as pd
+import numpy as np
 from es_aws_functions import general_functions
-from marshmallow import EXCLUDE, Schema, fields
+from marshmallow import EXCLUDE, fields
 
+import imputation_functions as imp_func
+import metrics_functions
+import transfer_functions
 from imputation_functions import produce_columns
 
 
-class RuntimeSchema(Schema):
+class RuntimeSchema(transfer_functions.DataSchema):
     class Meta:
         unknown = EXCLUDE
 
@@ -16,10 +19,11 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
-    data = fields.List(fields.Dict, required=True)
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
+    iqrs_engine = fields.Str(missing="groupby")
     questions_list = fields.List(fields.String, required=True)
+    rollup = fields.Nested(imp_func.RollupSchema, missing=None, allow_none=True)
     survey = fields.Str(required=True)
 
 
@@ -39,6 +43,7 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
@@ -51,10 +56,16 @@ def lambda_handler(event, context):
         bpm_queue_url = runtime_variables["bpm_queue_url"]
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
-        input_data = pd.DataFrame(runtime_variables["data"])
+        input_data = transfer_functions.load_data(runtime_variables)
+        iqrs_engine = runtime_variables["iqrs_engine"]
         questions_list = runtime_variables["questions_list"]
+        rollup = runtime_variables["rollup"]
         survey = runtime_variables["survey"]
 
+        # Check the data the calculation needs, as a whole.
+        transfer_functions.check_data(
+            input_data, produce_columns("movement_", questions_list), distinct_values)
+
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module, run_id,
                                                            context=context)
@@ -71,6 +82,8 @@ def lambda_handler(event, context):
     try:
 
         logger.info("Started - retrieved configuration variables.")
+        metrics.record("read", input_data,
+                       event["RuntimeVariables"].get("encoded_data"))
 
         movement_columns = produce_columns("movement_", questions_list)
         iqrs_columns = produce_columns("iqrs_", questions_list)
@@ -79,13 +92,17 @@ def lambda_handler(event, context):
             input_data,
             movement_columns,
             iqrs_columns,
-            distinct_values
+            distinct_values,
+            engine=iqrs_engine,
+            rollup=rollup
         )
 
         logger.info("Successfully finished calculations of IQRS.")
 
-        json_out = iqrs_df.to_json(orient="records")
-        final_output = {"data": json_out}
+        metrics.record("compute", iqrs_df)
+        final_output = transfer_functions.method_output(iqrs_df, runtime_variables)
+        metrics.record("save" if "data_location" in final_output else "serialise",
+                       payload=final_output.get("data"))
 
     except Exception as e:
         error_message = general_functions.handle_exception(e, current_module,
@@ -97,16 +114,87 @@ def lambda_handler(event, context):
             return {"success": False, "error": error_message}
 
     logger.info("Successfully completed module: " + current_module)
+    final_output["metrics"] = metrics.summary()
+    metrics.emit(run_id, survey)
     final_output["success"] = True
     return final_output
 
 
-def calc_iqrs(input_table, move_cols, iqrs_cols, distinct_values):
+def calc_iqrs(input_table, move_cols, iqrs_cols, distinct_values, engine="groupby",
+              rollup=None):
     """
     Calculate IQRS.
     :param input_table: Input DataFrame. - Type: DataFrame
     :param move_cols: Movement column list. - Type: List
     :param iqrs_cols: IQRS column list. - Type: List
+    :param distinct_values: Array of column names to derive distinct values from
+                            and store in table. - Type: List
+    :param engine: "groupby" to calculate every group and question in a single
+                   grouped pass, or "query" to use the original filter per group
+                   (kept for parity testing). The query engine compares the
+                   distinct values as quoted strings, so finds no rows, and leaves
+                   the IQRS unchanged, for numeric distinct values such as an
+                   integer region. The groupby engine matches them by value.
+                   - Type: String
+    :param rollup: For rolled up data, without all-GB rows, the region_column. The
+                   IQRS of each row's all-GB cell are then added as regionless_
+                   columns, from the same sort. Needs the groupby engine.
+                   - Type: Dict
+    :return: Table. - Type: DataFrame
+    """
+    if engine == "query":
+        if rollup is not None:
+            raise ValueError("The query IQRS engine does not support rollup")
+        return calc_iqrs_query(input_table, move_cols, iqrs_cols, distinct_values)
+    if engine != "groupby":
+        raise ValueError(f"Unknown IQRS engine: {engine}")
+
+    input_table = input_table.copy()
+
+    # The movements of every group and question are sorted together, once. Rows
+    # missing a distinct value are in no group, so get no IQR, as in a groupby.
+    group_numbers, group_count = imp_func.group_numbers(input_table, distinct_values)
+    output_cols = list(iqrs_cols)
+    if rollup is not None:
+        # The all-GB cells are numbered after the regional cells.
+        regionless_numbers, regionless_count = imp_func.group_numbers(
+            input_table, imp_func.regionless_values(distinct_values,
+                                                    rollup["region_column"]))
+        group_numbers = np.concatenate([
+            group_numbers,
+            np.where(regionless_numbers >= 0, regionless_numbers + group_count, -1)
+        ])
+        group_count += regionless_count
+        output_cols += produce_columns(imp_func.REGIONLESS_PREFIX, iqrs_cols)
+
+    movements = input_table[move_cols].to_numpy(dtype=float)
+    if rollup is not None:
+        movements = np.concatenate([movements, movements])
+    in_group = group_numbers >= 0
+
+    batch_groups = group_numbers[in_group][:, np.newaxis] + \
+        np.arange(len(move_cols)) * group_count
+    batch_iqrs = iqr_groups(movements[in_group].ravel(), batch_groups.ravel(),
+                            group_count * len(move_cols))
+
+    iqrs = np.full(movements.shape, np.nan)
+    iqrs[in_group] = batch_iqrs[batch_groups]
+    # With rollup, the all-GB IQRS of the rows follow their regional IQRS.
+    rows = len(input_table.index)
+    for i in range(0, len(output_cols)):
+        rollup_set, question = divmod(i, len(move_cols))
+        input_table[output_cols[i]] = iqrs[rollup_set * rows:(rollup_set + 1) * rows,
+                                           question]
+
+    return input_table
+
+
+def calc_iqrs_query(input_table, move_cols, iqrs_cols, distinct_values):
+    """
+    Calculate IQRS by filtering the table once per distinct group.
+    :param input_table: Input DataFrame. - Type: DataFrame
+    :param move_cols: Movement column list. - Type: List
+    :param iqrs_cols: IQRS column list. - Type: List
     :param distinct_values: Array of column names to derive distinct values from
                             and store in table. - Type: List
     :return: Table. - Type: DataFrame
@@ -143,22 +231,73 @@ def iqr_sum(df, quest):
     :param quest: Individual question no - Type: String
     :return: String
     """
-    df = df[quest]
-    df_size = df.size
-
-    import math
-
-    if df_size % 2 == 0:
-        sorted_df = df.sort_values()
-        df = sorted_df.reset_index(drop=True)
-        df_bottom = df[0:math.ceil(int(df_size / 2))].median()
-        df_top = df[math.ceil(int(df_size / 2)):].median()
-        iqr = df_top - df_bottom
-    else:
-        sorted_df = df.sort_values()
-        df = sorted_df.reset_index(drop=True)
-        q1 = df[(math.ceil(0.25 * (df_size + 1))) - 1]
-        q3 = df[(math.floor(0.75 * (df_size + 1))) - 1]
-        iqr = q3 - q1
-
-    return iqr
+    return iqr_series(df[quest])
+
+
+def iqr_series(df):
+    """
+    Calculates the interquartile range of a single series of movements.
+    :param df: Movement values for one question in one group - Type: Series
+    :return: Float
+    """
+    return iqr_array(df.to_numpy(dtype=float))
+
+
+def iqr_array(values):
+    """
+    Calculates the interquartile range of an array of movements. An even number of
+    values is split into halves and the IQR is the difference of their medians. For
+    an odd number, the quartiles are the values at positions ceil((n + 1) / 4) and
+    floor(3 * (n + 1) / 4). Missing values are sorted last and are counted in n,
+    but are left out of the medians.
+    :param values: Movement values for one question in one group - Type: ndarray
+    :return: Float
+    """
+    values = np.asarray(values, dtype=float)
+
+    return iqr_groups(values, np.zeros(values.size, dtype=np.int64), 1)[0]
+
+
+def iqr_groups(values, group_numbers, group_count):
+    """
+    Calculates the interquartile range of many groups at once, as iqr_array does
+    for each, from a single sort of the values by group and value.
+    :param values: Movement values. - Type: ndarray
+    :param group_numbers: Group of each value, from 0 to group_count - 1.
+                          - Type: ndarray
+    :param group_count: Number of groups. - Type: Int
+    :return: IQR of each group, NaN for a group without values. - Type: ndarray
+    """
+    values = np.asarray(values, dtype=float)
+    group_numbers = np.asarray(group_numbers, dtype=np.int64)
+    if values.size == 0:
+        return np.full(group_count, np.nan)
+
+    order = np.lexsort((values, group_numbers))
+    sorted_values = values[order]
+    sizes = np.bincount(group_numbers, minlength=group_count)
+    starts = np.cumsum(sizes) - sizes
+    # Running count of present values. Missing values sort to the end of their
+    # group, so the present values of any slice of a group come first.
+    present = np.concatenate(([0], np.cumsum(~np.isnan(sorted_values))))
+
+    halves = sizes // 2
+    even_iqrs = _sorted_median(sorted_values, present, starts + halves,
+                               starts + sizes) - \
+        _sorted_median(sorted_values, present, starts, starts + halves)
+
+    last = sorted_values.size - 1
+    q1 = sorted_values[np.minimum(starts + (sizes + 4) // 4 - 1, last)]
+    q3 = sorted_values[np.minimum(starts + (3 * sizes + 3) // 4 - 1, last)]
+
+    return np.where(sizes % 2 == 0, even_iqrs, q3 - q1)
+
+
+def _sorted_median(sorted_values, present, firsts, lasts):
+    # Median of each slice [first, last) of sorted_values, skipping missing values.
+    counts = present[lasts] - present[firsts]
+    last = sorted_values.size - 1
+    lower = sorted_values[np.minimum(firsts + np.maximum(counts - 1, 0) // 2, last)]
+    upper = sorted_values[np.minimum(firsts + counts // 2, last)]
+
+    return np.where(counts > 0, (lower + upper) / 2, np.nan)
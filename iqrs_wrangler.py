@@ -1,12 +1,16 @@
-import json
 import logging
 import os
 
 import boto3
 from es_aws_functions import aws_functions, exception_classes, general_functions
 from marshmallow import EXCLUDE, Schema, fields
+from marshmallow.validate import OneOf, Range
 
+import execution_functions
 import imputation_functions as imp_func
+import metrics_functions
+import storage_functions
+import transfer_functions
 
 
 class EnvironmentSchema(Schema):
@@ -18,8 +22,12 @@ class EnvironmentSchema(Schema):
         raise ValueError(f"Error validating environment params: {e}")
 
     bucket_name = fields.Str(required=True)
+    execution_backend = fields.Str(
+        missing="lambda", validate=OneOf(execution_functions.BACKENDS))
     method_name = fields.Str(required=True)
     run_environment = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
 
 
 class RuntimeSchema(Schema):
@@ -31,11 +39,18 @@ class RuntimeSchema(Schema):
         raise ValueError(f"Error validating runtime params: {e}")
 
     bpm_queue_url = fields.Str(required=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
     distinct_values = fields.List(fields.String, required=True)
     environment = fields.Str(required=True)
     in_file_name = fields.Str(required=True)
     out_file_name = fields.Str(required=True)
+    partitions = fields.Int(missing=1, validate=Range(min=1))
+    pass_by_reference = fields.Bool(missing=False)
+    payload_encoding = fields.Str(
+        missing="records", validate=OneOf(transfer_functions.AVAILABLE_ENCODINGS))
     questions_list = fields.List(fields.String, required=True)
+    rollup = fields.Nested(imp_func.RollupSchema, missing=None, allow_none=True)
     sns_topic_arn = fields.Str(required=True)
     survey = fields.Str(required=True)
 
@@ -55,31 +70,41 @@ def lambda_handler(event, context):
 
     # Set-up variables for status message
     bpm_queue_url = None
+    metrics = metrics_functions.StageMetrics(current_module)
 
     try:
         # Retrieve run_id before input validation
         # Because it is used in exception handling
         run_id = event["RuntimeVariables"]["run_id"]
 
-        # Set up clients
-        lambda_client = boto3.client("lambda", region_name="eu-west-2")
-
         environment_variables = EnvironmentSchema().load(os.environ)
 
+        # Set up clients
+        if environment_variables["execution_backend"] == "local":
+            lambda_client = execution_functions.LocalLambdaClient()
+        else:
+            lambda_client = boto3.client("lambda", region_name="eu-west-2")
+
         runtime_variables = RuntimeSchema().load(event["RuntimeVariables"])
 
         # Environment Variables
         bucket_name = environment_variables["bucket_name"]
         method_name = environment_variables["method_name"]
         run_environment = environment_variables["run_environment"]
+        storage_backend = environment_variables["storage_backend"]
 
         # Runtime Variables
         bpm_queue_url = runtime_variables["bpm_queue_url"]
+        data_format = runtime_variables["data_format"]
         distinct_values = runtime_variables["distinct_values"]
         environment = runtime_variables["environment"]
         in_file_name = runtime_variables["in_file_name"]
         out_file_name = runtime_variables["out_file_name"]
+        partitions = runtime_variables["partitions"]
+        pass_by_reference = runtime_variables["pass_by_reference"]
+        payload_encoding = runtime_variables["payload_encoding"]
         questions_list = runtime_variables["questions_list"]
+        rollup = runtime_variables["rollup"]
         sns_topic_arn = runtime_variables["sns_topic_arn"]
         survey = runtime_variables['survey']
 
@@ -100,7 +125,9 @@ def lambda_handler(event, context):
 
         logger.info("Started - retrieved configuration variables.")
 
-        data = aws_functions.read_dataframe_from_s3(bucket_name, in_file_name)
+        data = storage_functions.read_dataframe(bucket_name, in_file_name,
+                                                data_format, storage_backend)
+        metrics.record("read", data)
         logger.info("Successfully retrieved data.")
         iqrs_columns = imp_func.produce_columns("iqrs_", questions_list)
         for col in iqrs_columns:
@@ -108,39 +135,58 @@ def lambda_handler(event, context):
 
         logger.info("IQRS columns successfully added")
 
-        data_json = data.to_json(orient="records")
-
-        logger.info("Dataframe converted to JSON")
-
-        payload = {
-            "RuntimeVariables": {
-                "bpm_queue_url": bpm_queue_url,
-                "data": json.loads(data_json),
-                "distinct_values": distinct_values,
-                "environment": environment,
-                "questions_list": questions_list,
-                "run_id": run_id,
-                "survey": survey
-            }
+        metrics.record("prepare", data)
+        data_reference = None
+        if pass_by_reference:
+            data_reference = transfer_functions.reference_payload(
+                bucket_name, out_file_name, data_format, storage_backend)
+
+        # Rolled up all-GB cells span regions, so are kept whole.
+        partition_columns = distinct_values
+        if rollup is not None:
+            partition_columns = imp_func.regionless_values(
+                distinct_values, rollup["region_column"])
+
+        method_variables = {
+            "bpm_queue_url": bpm_queue_url,
+            "distinct_values": distinct_values,
+            "environment": environment,
+            "questions_list": questions_list,
+            "run_id": run_id,
+            "survey": survey
         }
-
-        wrangled_data = lambda_client.invoke(
-            FunctionName=method_name,
-            Payload=json.dumps(payload)
-        )
-        logger.info("Successfully invoked method.")
-
-        json_response = json.loads(wrangled_data.get("Payload").read().decode("UTF-8"))
-        logger.info("JSON extracted from method response.")
-
-        if not json_response["success"]:
-            raise exception_classes.MethodFailure(json_response["error"])
-
-        aws_functions.save_to_s3(bucket_name, out_file_name, json_response["data"])
+        if rollup is not None:
+            method_variables["rollup"] = rollup
+
+        if partitions > 1:
+            output = execution_functions.invoke_partitions(
+                lambda_client, method_name, method_variables, data,
+                partition_columns, partitions, payload_encoding,
+                data_reference, metrics)
+            logger.info("Successfully invoked method.")
+            storage_functions.save_dataframe(bucket_name, out_file_name, output,
+                                             data_format, storage_backend)
+        else:
+            payload = {
+                "RuntimeVariables": {
+                    **method_variables,
+                    **transfer_functions.data_payload(data, payload_encoding,
+                                                      data_reference)
+                }
+            }
+            json_response = execution_functions.invoke_method(
+                lambda_client, method_name, payload, metrics)
+            logger.info("Successfully invoked method.")
+            transfer_functions.save_method_data(
+                bucket_name, out_file_name, json_response, payload_encoding,
+                data_format, storage_backend)
+            transfer_functions.delete_reference(data_reference)
+        metrics.record("save")
         logger.info("Successfully sent data to s3.")
 
         if run_environment != "development":
-            logger.info(aws_functions.delete_data(bucket_name, in_file_name))
+            logger.info(storage_functions.delete_data(bucket_name, in_file_name,
+                                                      storage_backend))
             logger.info("Successfully deleted input data from s3.")
 
         aws_functions.send_sns_message(sns_topic_arn, "Imputation - IQRs.")
@@ -157,4 +203,5 @@ def lambda_handler(event, context):
 
     logger.info("Successfully completed module: " + current_module)
 
-    return {"success": True}
+    metrics.emit(run_id, survey)
+    return {"success": True, "metrics": metrics.summary()}
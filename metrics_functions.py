@@ -0,0 +1,172 @@
+import json
+import sys
+import time
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+NAMESPACE = "es-imputation"
+STAGES = ["read", "prepare", "serialise", "invoke", "deserialise", "compute", "save"]
+
+
+class StageMetrics:
+    """
+    Records the wall time, rows, payload bytes and peak RSS of each stage of a
+    handler. Each call to record ends a stage, which began at the previous call.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.stages = []
+        self.started = time.perf_counter()
+        self.last_recorded = self.started
+        self.method_metrics = None
+
+    def record(self, stage, data=None, payload=None, details=None):
+        """
+        Ends a stage.
+        :param stage: Name of the stage, usually one of STAGES. - Type: String
+        :param data: Data the stage produced, to count its rows. - Type: DataFrame
+        :param payload: Serialised data the stage produced or received.
+                        - Type: String/Bytes/List
+        :param details: Further figures about the stage, kept with its metrics.
+                        - Type: Dict
+        :return: The stage's metrics. - Type: Dict
+        """
+        now = time.perf_counter()
+        stage_metrics = {
+            "payload_bytes": payload_bytes(payload),
+            "peak_rss_mb": peak_rss_mb(),
+            "rows": len(data.index) if isinstance(data, pd.DataFrame) else None,
+            "seconds": now - self.last_recorded,
+            "stage": stage
+        }
+        if details is not None:
+            stage_metrics.update(details)
+        self.last_recorded = now
+        self.stages.append(stage_metrics)
+
+        return stage_metrics
+
+    def record_method(self, response):
+        """
+        Keeps the metrics returned by a method, so the wrangler's summary includes
+        them. A list of responses, from a method invoked once per partition, keeps
+        a list of metrics.
+        :param response: The method's response or responses. - Type: Dict/List
+        :return: None
+        """
+        if isinstance(response, list):
+            self.method_metrics = [part.get("metrics") for part in response]
+        else:
+            self.method_metrics = response.get("metrics")
+
+    def summary(self):
+        """
+        Aggregates the recorded stages, for returning in a handler's response.
+        :return: Every stage, the total seconds per stage name, the overall seconds,
+                 the peak RSS and any metrics returned by a method. - Type: Dict
+        """
+        stage_seconds = {}
+        for stage_metrics in self.stages:
+            stage_seconds[stage_metrics["stage"]] = \
+                stage_seconds.get(stage_metrics["stage"], 0) + stage_metrics["seconds"]
+
+        summary = {
+            "peak_rss_mb": peak_rss_mb(),
+            "seconds": time.perf_counter() - self.started,
+            "stage_seconds": stage_seconds,
+            "stages": self.stages
+        }
+        if self.method_metrics is not None:
+            summary["method"] = self.method_metrics
+
+        return summary
+
+    def emit(self, run_id, survey=None):
+        """
+        Prints every recorded stage in CloudWatch embedded metric format, so
+        CloudWatch Logs turns them into metrics.
+        :param run_id: The run's id, added as a property. - Type: String
+        :param survey: The survey, added as a property. - Type: String
+        :return: The printed log lines. - Type: List
+        """
+        lines = [json.dumps(embedded_metric(self.module, stage_metrics, run_id, survey))
+                 for stage_metrics in self.stages]
+        for line in lines:
+            print(line)
+        sys.stdout.flush()
+
+        return lines
+
+
+def embedded_metric(module, stage_metrics, run_id=None, survey=None):
+    """
+    Lays out a stage's metrics in CloudWatch embedded metric format.
+    :param module: The handler's module name. - Type: String
+    :param stage_metrics: A stage from StageMetrics.record. - Type: Dict
+    :param run_id: The run's id. - Type: String
+    :param survey: The survey. - Type: String
+    :return: The log record. - Type: Dict
+    """
+    metrics = [{"Name": "Duration", "Unit": "Milliseconds"}]
+    values = {"Duration": stage_metrics["seconds"] * 1000}
+    for name, key, unit in [("Rows", "rows", "Count"),
+                            ("PayloadBytes", "payload_bytes", "Bytes"),
+                            ("PeakRSS", "peak_rss_mb", "Megabytes")]:
+        if stage_metrics[key] is not None:
+            metrics.append({"Name": name, "Unit": unit})
+            values[name] = stage_metrics[key]
+
+    return {
+        "_aws": {
+            "CloudWatchMetrics": [{
+                "Dimensions": [["Module", "Stage"]],
+                "Metrics": metrics,
+                "Namespace": NAMESPACE
+            }],
+            "Timestamp": int(time.time() * 1000)
+        },
+        "Module": module,
+        "RunId": run_id,
+        "Stage": stage_metrics["stage"],
+        "Survey": survey,
+        **values
+    }
+
+
+def payload_bytes(payload):
+    """
+    Measures serialised data.
+    :param payload: Serialised data, or a list of it. - Type: String/Bytes/List
+    :return: Its size in bytes, or None if there is no payload. - Type: Int
+    """
+    if payload is None:
+        return None
+    if isinstance(payload, list):
+        return sum(payload_bytes(part) for part in payload)
+    if isinstance(payload, str):
+        return len(payload.encode("UTF-8"))
+
+    return len(payload)
+
+
+def peak_rss_mb():
+    """
+    Reads the process's peak resident set size so far.
+    :return: Peak RSS in MB, or None where the resource module is unavailable.
+             - Type: Float
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+
+    return peak / 1024
@@ -0,0 +1,467 @@
+import io
+import os
+
+import boto3
+import pandas as pd
+from es_aws_functions import aws_functions
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+BACKENDS = ["s3", "local"]
+FORMATS = ["json", "parquet"]
+# Parquet needs pyarrow, which the deployed Lambdas only have from a layer.
+AVAILABLE_FORMATS = FORMATS if pa is not None else ["json"]
+# S3 multipart uploads need every part but the last to be at least 5 MiB.
+PART_SIZE = 8 * 1024 ** 2
+
+
+def data_format_of(file_name, data_format=None):
+    """
+    Works out the format of an intermediate file. An explicit .json or .parquet
+    extension wins, otherwise the run's data_format is used, defaulting to json.
+    :param file_name: Name of the file. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :return: One of FORMATS. - Type: String
+    """
+    extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+    if extension in FORMATS:
+        return extension
+    if data_format is not None:
+        return data_format
+
+    return "json"
+
+
+def read_dataframe(bucket_name, file_name, data_format=None, backend="s3"):
+    """
+    Reads an intermediate file into a DataFrame.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :return: The data. - Type: DataFrame
+    """
+    data_format = data_format_of(file_name, data_format)
+
+    if backend == "local":
+        file_path = os.path.join(bucket_name, file_name)
+        if data_format == "parquet":
+            return pd.read_parquet(file_path)
+        return pd.read_json(file_path, dtype=False)
+
+    if data_format == "parquet":
+        return pd.read_parquet(io.BytesIO(_read_s3_bytes(bucket_name, file_name)))
+    return aws_functions.read_dataframe_from_s3(bucket_name, file_name)
+
+
+def period_file_name(file_name, period):
+    """
+    Names the file holding one period of data which is saved a file per period.
+    :param file_name: Name of the file of every period. - Type: String
+    :param period: The period. - Type: String
+    :return: The file name with the suffix '_<period>'. - Type: String
+    """
+    stem, extension = os.path.splitext(file_name)
+    if extension.lower().lstrip(".") not in FORMATS:
+        stem, extension = file_name, ""
+
+    return f"{stem}_{period}{extension}"
+
+
+def read_periods(bucket_name, file_name, period_column, periods, data_format=None,
+                 backend="s3", partitioned=False):
+    """
+    Reads the data of some periods from data holding many. Only those periods are
+    loaded where the data is laid out by period, as save_periods saves it: with
+    partitioned, each period's file is read. Otherwise parquet row groups whose
+    statistics rule out every period are skipped, reading S3 objects by range.
+    JSON files are read whole. Rows of other periods may be returned, where they
+    share a row group with the periods.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file of every period. - Type: String
+    :param period_column: Name of the period column. - Type: String
+    :param periods: The periods to read. - Type: List
+    :param data_format: The run's data format, if set. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :param partitioned: Whether each period is its own file. - Type: Bool
+    :return: The data. - Type: DataFrame
+    """
+    if partitioned:
+        return pd.concat([read_dataframe(bucket_name, period_file_name(file_name, period),
+                                         data_format, backend)
+                          for period in periods], ignore_index=True)
+
+    if data_format_of(file_name, data_format) != "parquet" or pa is None:
+        return read_dataframe(bucket_name, file_name, data_format, backend)
+
+    if backend == "local":
+        source = open(os.path.join(bucket_name, file_name), "rb")
+    else:
+        source = _S3ReadFile(bucket_name, file_name)
+    with source:
+        parquet_file = pq.ParquetFile(source)
+        schema = parquet_file.schema_arrow
+        column = schema.get_field_index(period_column)
+        if column < 0:
+            raise KeyError(period_column)
+        keys = [key for key in period_keys(
+            periods, pa.types.is_integer(schema.field(column).type))
+            if key is not None]
+
+        row_groups = []
+        for row_group in range(0, parquet_file.metadata.num_row_groups):
+            statistics = parquet_file.metadata.row_group(row_group).column(column)\
+                .statistics
+            if statistics is None or not statistics.has_min_max or \
+                    any(statistics.min <= key <= statistics.max for key in keys):
+                row_groups.append(row_group)
+
+        if len(row_groups) == 0:
+            return schema.empty_table().to_pandas()
+        return parquet_file.read_row_groups(row_groups).to_pandas()
+
+
+def period_keys(periods, integer=False):
+    """
+    Matches periods, given as strings, to the type of a period column, so the
+    column is compared without being converted.
+    :param periods: The periods. - Type: List
+    :param integer: Whether the period column holds integers. - Type: Bool
+    :return: The periods as the column's type. Periods which cannot be held in an
+             integer column are None, as they match nothing in it. - Type: List
+    """
+    if integer:
+        return [int(period) if str(period).isdigit() and
+                str(int(period)) == str(period) else None for period in periods]
+
+    return [str(period) for period in periods]
+
+
+def save_periods(bucket_name, file_name, dataframe, period_column, data_format=None,
+                 backend="s3", partitioned=False):
+    """
+    Saves data of many periods laid out so read_periods can read only some of them:
+    with partitioned, a file per period, named by period_file_name, otherwise a
+    single file. Parquet files get a row group per period.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file of every period. - Type: String
+    :param dataframe: The data. - Type: DataFrame
+    :param period_column: Name of the period column. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :param partitioned: Whether to save each period as its own file. - Type: Bool
+    :return: None
+    """
+    period_data = dataframe.groupby(period_column, sort=True)
+    if partitioned:
+        for period, data in period_data:
+            save_dataframe(bucket_name, period_file_name(file_name, period), data,
+                           data_format, backend)
+    elif data_format_of(file_name, data_format) == "parquet":
+        with open_dataframe_writer(bucket_name, file_name, data_format,
+                                   backend) as writer:
+            for _, data in period_data:
+                writer.write(data)
+    else:
+        save_dataframe(bucket_name, file_name, dataframe, data_format, backend)
+
+
+def save_dataframe(bucket_name, file_name, dataframe, data_format=None, backend="s3"):
+    """
+    Saves a DataFrame as an intermediate file.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param dataframe: The data. - Type: DataFrame
+    :param data_format: The run's data format, if set. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :return: None
+    """
+    if data_format_of(file_name, data_format) == "parquet":
+        _save_bytes(bucket_name, file_name, _parquet_bytes(dataframe), backend)
+    else:
+        save_json(bucket_name, file_name, dataframe.to_json(orient="records"), backend)
+
+
+def open_dataframe_writer(bucket_name, file_name, data_format=None, backend="s3",
+                          schema_data=None):
+    """
+    Opens an intermediate file to be written one DataFrame at a time, so the
+    whole of the data never has to be held in memory. Once closed, the file
+    matches what save_dataframe would save for the DataFrames joined together.
+    Data is written as it arrives, to a local file or as the parts of an S3
+    multipart upload. Used as a context manager, the file is closed at the end,
+    or discarded if there was an error.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :param schema_data: Data with the column types of every DataFrame to be
+                        written, such as the data they are taken from. Sets the
+                        parquet schema, which is otherwise taken from the first
+                        DataFrame written. - Type: DataFrame
+    :return: The writer. - Type: DataFrameWriter
+    """
+    data_format = data_format_of(file_name, data_format)
+
+    if backend == "local":
+        output = open(os.path.join(bucket_name, file_name), "wb")
+    elif data_format == "json" and not file_name.endswith(".json"):
+        # aws_functions adds the extension to JSON files in S3.
+        output = _S3MultipartFile(bucket_name, file_name + ".json")
+    else:
+        output = _S3MultipartFile(bucket_name, file_name)
+
+    return DataFrameWriter(output, data_format, schema_data)
+
+
+def save_json(bucket_name, file_name, data, backend="s3"):
+    """
+    Saves JSON records which are already a string as an intermediate file.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param data: JSON records. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :return: None
+    """
+    if backend == "local":
+        with open(os.path.join(bucket_name, file_name), "w") as file:
+            file.write(data)
+    else:
+        aws_functions.save_to_s3(bucket_name, file_name, data)
+
+
+def delete_data(bucket_name, file_name, backend="s3"):
+    """
+    Deletes an intermediate file.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param backend: One of BACKENDS. - Type: String
+    :return: Message describing the deletion. - Type: String
+    """
+    if backend == "local":
+        os.remove(os.path.join(bucket_name, file_name))
+        return f"Deleted {file_name} from {bucket_name}."
+
+    return aws_functions.delete_data(bucket_name, file_name)
+
+
+class DataFrameWriter:
+    """
+    Writes DataFrames with the same columns to a file one at a time. JSON records
+    are joined into one list. With parquet each DataFrame becomes a row group,
+    cast to the types of schema_data, or of the first one written. Columns with
+    no values there are stored as floats.
+    """
+
+    def __init__(self, output, data_format, schema_data=None):
+        if data_format == "parquet" and pa is None:
+            raise ImportError("pyarrow is required for the parquet data format.")
+
+        self.output = output
+        self.data_format = data_format
+        self.empty_dataframe = None
+        self.parquet_writer = None
+        self.schema = None
+        if data_format == "parquet" and schema_data is not None:
+            self.schema = _parquet_schema(schema_data)
+        self.rows = 0
+        if data_format == "json":
+            self.output.write(b"[")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, dataframe):
+        if len(dataframe.index) == 0:
+            # Empty object columns have no type, so they cannot set the schema.
+            if self.empty_dataframe is None:
+                self.empty_dataframe = dataframe
+            return
+
+        if self.data_format == "parquet":
+            dataframe = dataframe.reset_index(drop=True)
+            if self.schema is None:
+                self.schema = _parquet_schema(dataframe)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.output, self.schema)
+            self.parquet_writer.write_table(pa.Table.from_pandas(
+                dataframe, preserve_index=False, schema=self.schema))
+        else:
+            records = dataframe.to_json(orient="records")[1:-1]
+            self.output.write((b"," if self.rows else b"") + records.encode("UTF-8"))
+
+        self.rows += len(dataframe.index)
+
+    def close(self):
+        if self.data_format == "json":
+            self.output.write(b"]")
+        elif self.parquet_writer is not None:
+            self.parquet_writer.close()
+        else:
+            self.output.write(_parquet_bytes(
+                self.empty_dataframe if self.empty_dataframe is not None
+                else pd.DataFrame()))
+        self.output.close()
+
+    def abort(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        if isinstance(self.output, _S3MultipartFile):
+            self.output.abort()
+        else:
+            self.output.close()
+            os.remove(self.output.name)
+
+
+class _S3MultipartFile:
+    """
+    A write-only file which uploads to S3 in parts of PART_SIZE.
+    """
+
+    def __init__(self, bucket_name, file_name):
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.s3 = boto3.client("s3", region_name="eu-west-2")
+        self.buffer = io.BytesIO()
+        self.parts = []
+        self.upload_id = None
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= PART_SIZE:
+            self._upload_part()
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return sum(part["Size"] for part in self.parts) + self.buffer.tell()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.upload_id is None:
+            # Small enough for a single part, so it is saved in one request.
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.file_name,
+                               Body=self.buffer.getvalue())
+            return
+
+        if self.buffer.tell() > 0:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.file_name, UploadId=self.upload_id,
+            MultipartUpload={"Parts": [{"ETag": part["ETag"],
+                                        "PartNumber": part["PartNumber"]}
+                                       for part in self.parts]})
+
+    def abort(self):
+        self.closed = True
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name,
+                                           Key=self.file_name,
+                                           UploadId=self.upload_id)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.file_name)["UploadId"]
+
+        data = self.buffer.getvalue()
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.file_name,
+                                       UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=data)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number,
+                           "Size": len(data)})
+        self.buffer = io.BytesIO()
+
+
+class _S3ReadFile(io.RawIOBase):
+    """
+    A read-only file which reads an S3 object by range, so only the parts read
+    are downloaded.
+    """
+
+    def __init__(self, bucket_name, file_name):
+        self.bucket_name = bucket_name
+        self.file_name = file_name
+        self.s3 = boto3.client("s3", region_name="eu-west-2")
+        self.size = self.s3.head_object(Bucket=bucket_name,
+                                        Key=file_name)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+
+        data = self.s3.get_object(
+            Bucket=self.bucket_name, Key=self.file_name,
+            Range=f"bytes={self.position}-{end - 1}")["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+
+        return len(data)
+
+
+def _parquet_schema(dataframe):
+    # A column with no values has the null type, which nothing else can be cast to.
+    schema = pa.Schema.from_pandas(dataframe, preserve_index=False)
+    for index, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(index, field.with_type(pa.float64()))
+
+    return schema
+
+
+def _parquet_bytes(dataframe):
+    buffer = io.BytesIO()
+    dataframe.reset_index(drop=True).to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def _read_s3_bytes(bucket_name, file_name):
+    s3 = boto3.client("s3", region_name="eu-west-2")
+    return s3.get_object(Bucket=bucket_name, Key=file_name)["Body"].read()
+
+
+def _save_bytes(bucket_name, file_name, data, backend):
+    if backend == "local":
+        with open(os.path.join(bucket_name, file_name), "wb") as file:
+            file.write(data)
+    else:
+        s3 = boto3.client("s3", region_name="eu-west-2")
+        s3.put_object(Bucket=bucket_name, Key=file_name, Body=data)
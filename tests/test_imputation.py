@@ -1,10 +1,13 @@
+import io
 import json
 from copy import deepcopy
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import pytest
 from es_aws_functions import exception_classes, test_generic_library
+from marshmallow import ValidationError
 from moto import mock_s3
 from pandas.testing import assert_frame_equal
 
@@ -21,9 +24,14 @@ import calculate_means_wrangler as lambda_means_wrangler_function
 import calculate_movement_method as lambda_movement_method_function
 import calculate_movement_wrangler as lambda_movement_wrangler_function
 import imputation_functions as lambda_imputation_function
+import imputation_pipeline as lambda_pipeline_function
 import iqrs_method as lambda_iqrs_method_function
 import iqrs_wrangler as lambda_iqrs_wrangler_function
+import metrics_functions as lambda_metrics_function
 import recalculate_means_wrangler as lambda_recalc_wrangler_function
+import storage_functions as lambda_storage_function
+import transfer_functions as lambda_transfer_function
+from benchmarks import run_benchmarks, survey_generator
 
 factors_parameters = {
     "RuntimeVariables": {
@@ -198,7 +206,15 @@ method_movement_runtime_variables = {
         "previous_period": "201806",
         "questions_list": questions_list,
         "run_id": "bob",
-        "survey": "bmi_sg"
+        "survey": "bmi_sg",
+        "unique_identifier": ["responder_id"]
+    }
+}
+
+method_movement_aligned_runtime_variables = {
+    "RuntimeVariables": {
+        **method_movement_runtime_variables["RuntimeVariables"],
+        "aligned": True
     }
 }
 
@@ -767,9 +783,15 @@ def test_value_error(which_lambda, expected_message,
         (lambda_means_method_function, method_means_runtime_variables,
          "tests/fixtures/test_method_means_input.json",
          "tests/fixtures/test_method_means_prepared_output.json"),
+        (lambda_means_method_function, deepcopy(method_means_runtime_variables),
+         "tests/fixtures/test_method_recalc_input.json",
+         "tests/fixtures/test_method_recalc_prepared_output.json"),
         (lambda_movement_method_function, method_movement_runtime_variables,
          "tests/fixtures/test_method_movement_input.json",
          "tests/fixtures/test_method_movement_prepared_output.json"),
+        (lambda_movement_method_function, method_movement_aligned_runtime_variables,
+         "tests/fixtures/test_method_movement_aligned_input.json",
+         "tests/fixtures/test_method_movement_prepared_output.json"),
         (lambda_iqrs_method_function, method_iqrs_runtime_variables,
          "tests/fixtures/test_method_iqrs_input.json",
          "tests/fixtures/test_method_iqrs_prepared_output.json")
@@ -802,6 +824,84 @@ def test_method_success(which_lambda, which_runtime_variables, input_data, prepa
 
     assert output["success"]
     assert_frame_equal(produced_data, prepared_data)
+    assert [stage["stage"] for stage in output["metrics"]["stages"]] == \
+        ["read", "compute", "serialise"]
+
+
+@pytest.mark.parametrize("encoding", ["columnar", "arrow"])
+def test_method_success_encoded(encoding):
+    """
+    Runs the IQRS method with an encoded payload and compares it with records.
+    :param encoding: Payload encoding. - String.
+    :return Test Pass/Fail
+    """
+    if encoding == "arrow":
+        pytest.importorskip("pyarrow")
+
+    with open("tests/fixtures/test_method_iqrs_input.json", "r") as file_1:
+        test_data = json.loads(file_1.read())
+
+    records_variables = deepcopy(method_iqrs_runtime_variables)
+    records_variables["RuntimeVariables"]["data"] = test_data
+    records_output = lambda_iqrs_method_function.lambda_handler(
+        records_variables, test_generic_library.context_object)
+
+    encoded_variables = deepcopy(method_iqrs_runtime_variables)
+    encoded_variables["RuntimeVariables"].pop("data")
+    encoded_variables["RuntimeVariables"].update(
+        lambda_transfer_function.data_payload(pd.DataFrame(test_data), encoding))
+    encoded_output = lambda_iqrs_method_function.lambda_handler(
+        encoded_variables, test_generic_library.context_object)
+
+    assert encoded_output["success"]
+    produced_data = lambda_transfer_function.decode_dataframe(
+        encoded_output["data"], encoding)
+    prepared_data = pd.read_json(records_output["data"], dtype=False)
+
+    assert_frame_equal(produced_data.astype(float, errors="ignore"),
+                       prepared_data.astype(float, errors="ignore"),
+                       check_dtype=False)
+
+
+def test_method_success_by_reference(tmp_path):
+    """
+    Runs the IQRS method with its data passed by reference and compares it with
+    records.
+    :param tmp_path: Directory used by the local storage backend. - Path.
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_method_iqrs_input.json", "r") as file_1:
+        test_data = json.loads(file_1.read())
+
+    records_variables = deepcopy(method_iqrs_runtime_variables)
+    records_variables["RuntimeVariables"]["data"] = test_data
+    records_output = lambda_iqrs_method_function.lambda_handler(
+        records_variables, test_generic_library.context_object)
+
+    reference = lambda_transfer_function.reference_payload(
+        str(tmp_path), "test_iqrs_output.json", storage_backend="local")
+    reference_variables = deepcopy(method_iqrs_runtime_variables)
+    reference_variables["RuntimeVariables"].pop("data")
+    reference_variables["RuntimeVariables"].update(
+        lambda_transfer_function.data_payload(pd.DataFrame(test_data),
+                                              reference=reference))
+    reference_output = lambda_iqrs_method_function.lambda_handler(
+        reference_variables, test_generic_library.context_object)
+
+    assert reference_output["success"]
+    assert "data" not in reference_output
+    assert reference_output["data_location"] == reference["result_location"]
+
+    produced_data = lambda_transfer_function.method_dataframe(reference_output)
+    prepared_data = pd.read_json(records_output["data"], dtype=False)
+
+    assert_frame_equal(produced_data.astype(float, errors="ignore"),
+                       prepared_data.astype(float, errors="ignore"),
+                       check_dtype=False)
+
+    lambda_transfer_function.delete_reference(reference)
+    assert not (tmp_path / "test_iqrs_output_method_input.json").exists()
+    assert (tmp_path / "test_iqrs_output.json").exists()
 
 
 @mock_s3
@@ -941,8 +1041,8 @@ def test_movement_no_data_left(mock_put_s3, which_lambda, which_environment_vari
         (lambda_movement_wrangler_function, generic_environment_variables,
          wrangler_movement_runtime_variables, "calculate_movement_wrangler",
          ["test_wrangler_movement_input.json"],
-         "tests/fixtures/test_method_movement_input.json",
-         method_movement_runtime_variables),
+         "tests/fixtures/test_method_movement_aligned_input.json",
+         method_movement_aligned_runtime_variables),
         (lambda_iqrs_wrangler_function, generic_environment_variables,
          wrangler_iqrs_runtime_variables, "iqrs_wrangler",
          ["test_wrangler_iqrs_input.json"],
@@ -1170,6 +1270,143 @@ def test_factors_calculation_a(input_file, output_file, parameters):
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_factors_lookup():
+    factors = pd.DataFrame({
+        "imputation_factor_question_1": [1.5, 2.5, 9.0],
+        "region": [14, 14, 14],
+        "strata": ["A", "B", "A"]
+    })
+    lookup = lambda_imputation_function.FactorsLookup(
+        factors, ["question_1"], ["region", "strata"], "region")
+    regional = pd.DataFrame({"region": [1, 2, 3], "strata": ["B", "A", "C"]},
+                            index=[10, 11, 12])
+
+    assert lookup.factor({"region": 5, "strata": "A"}, "question_1") == 1.5
+    with pytest.raises(ValueError):
+        lookup.factor({"region": 5, "strata": "C"}, "question_1")
+    assert list(lookup.positions(regional)) == [1, 0, -1]
+    assert_frame_equal(
+        lookup.lookup(regional),
+        pd.DataFrame({"imputation_factor_question_1": [2.5, 1.5, np.nan]},
+                     index=[10, 11, 12]))
+    assert lambda_imputation_function.FactorsLookup.from_factors(
+        lookup, ["question_1"], ["region", "strata"], "region") is lookup
+
+    regionless = lambda_imputation_function.FactorsLookup(
+        factors, ["question_1"], ["region"], "region")
+    assert regionless.factor({"region": 5}, "question_1") == 1.5
+    assert list(regionless.lookup(regional)["imputation_factor_question_1"]) == \
+        [1.5, 1.5, 1.5]
+
+
+def test_calculate_means_copies_data():
+    data = pd.DataFrame({
+        "movement_question_1": [1.0, 3.0, 4.0],
+        "region": [1, 1, np.nan],
+        "strata": ["A", "A", "B"]
+    })
+    original = data.copy()
+
+    produced_data = lambda_means_method_function.calculate_means(
+        data, ["question_1"], ["region", "strata"])
+    assert_frame_equal(data, original)
+    assert list(produced_data["mean_question_1"]) == [2.0, 2.0, 0]
+    produced_data = lambda_means_method_function.calculate_means(
+        data.iloc[2:], ["question_1"], ["region", "strata"])
+    assert list(produced_data["mean_question_1"]) == [0]
+
+    # A row missing a group value has a mean of 0, whatever else is in the data.
+    unmatched_data = data.assign(region=np.nan)
+    produced_data = lambda_means_method_function.calculate_means(
+        unmatched_data, ["question_1"], ["region", "strata"])
+    assert list(produced_data["mean_question_1"]) == [0, 0, 0]
+    assert list(produced_data["movement_question_1_count"]) == [0, 0, 0]
+    produced_data = lambda_means_method_function.calculate_means(
+        unmatched_data, ["question_1"], ["region", "strata"],
+        statistics=lambda_imputation_function.CellStatistics.from_data(
+            unmatched_data, ["question_1"], ["region", "strata"]))
+    assert list(produced_data["mean_question_1"]) == [0, 0, 0]
+
+
+def test_cell_statistics():
+    data = pd.DataFrame({
+        "movement_question_1": [1.0, 3.0, np.nan, 4.0, 10.0],
+        "region": [1, 1, 1, 2, 2],
+        "strata": ["A", "A", "A", "B", "B"]
+    })
+    statistics = lambda_imputation_function.CellStatistics.from_data(
+        data, ["question_1"], ["region", "strata"])
+    rows = pd.DataFrame({"region": [2, 1, 3], "strata": ["B", "A", "A"]})
+
+    assert list(statistics.positions(rows)) == [1, 0, -1]
+    sums, counts, means = statistics.results(rows)[0]
+    assert list(counts) == [2, 2, 0]
+    assert list(means) == [7.0, 2.0, 0]
+    assert np.isnan(sums[2])
+
+    # Removing the atypical 10.0 and adding a row in a new cell.
+    statistics.update(data.iloc[[4]], [[10.0]], sign=-1)
+    statistics.update(rows.iloc[[2]], [[6.0]])
+    sums, counts, means = statistics.results(rows)[0]
+    assert list(counts) == [1, 2, 1]
+    assert list(means) == [4.0, 2.0, 6.0]
+
+    saved = lambda_imputation_function.CellStatistics.from_frame(
+        statistics.to_frame(), ["question_1"], ["region", "strata"])
+    assert_frame_equal(saved.to_frame(), statistics.to_frame())
+
+    # Means from the statistics match those found by grouping the data.
+    expected_data = lambda_means_method_function.calculate_means(
+        data.copy(), ["question_1"], ["region", "strata"])
+    produced_data = lambda_means_method_function.calculate_means(
+        data.copy(), ["question_1"], ["region", "strata"],
+        statistics=lambda_imputation_function.CellStatistics.from_data(
+            data, ["question_1"], ["region", "strata"]))
+    assert_frame_equal(produced_data, expected_data)
+
+
+@pytest.mark.parametrize(
+    "input_file,output_file,distinct_values",
+    [
+        ("tests/fixtures/test_imputation_functions_factors_a_region_input.json",
+         "tests/fixtures/test_imputation_functions_factors_a_region_prepared_output.json",
+         ["region"]),
+        ("tests/fixtures/test_imputation_functions_factors_a_input.json",
+         "tests/fixtures/test_imputation_functions_factors_a_prepared_output.json",
+         ["region"]),
+        ("tests/fixtures/test_imputation_functions_factors_a_input.json",
+         "tests/fixtures/test_imputation_functions_factors_a_prepared_output.json",
+         ["region", "strata_A", "strata_B"])
+    ])
+def test_factors_calculation_a_frame(input_file, output_file, distinct_values):
+    """
+    Runs the factors_calculation_a_frame function.
+    :param input_file
+    :param output_file
+    :param distinct_values
+    :return Test Pass/Fail
+    """
+    parameters = deepcopy(imputation_functions)
+    parameters["distinct_values"] = distinct_values
+
+    with open(input_file, "r") as file_1:
+        test_data_in = file_1.read()
+    input_data = pd.DataFrame(json.loads(test_data_in))
+
+    input_data = lambda_imputation_function.factors_calculation_a_frame(
+        input_data, ["question_1"], **parameters)
+
+    # This is for Int, Float mismatch correction.
+    json_data = input_data.to_json(orient="records")
+    produced_data = pd.DataFrame(json.loads(json_data), dtype=float).sort_index(axis=1)
+
+    with open(output_file, "r") as file_2:
+        test_data_out = file_2.read()
+    prepared_data = pd.DataFrame(json.loads(test_data_out), dtype=float)
+
+    assert_frame_equal(produced_data, prepared_data)
+
+
 def test_factors_calculation_b():
     """
     Runs the factors_calculation_b function.
@@ -1196,6 +1433,31 @@ def test_factors_calculation_b():
     assert_frame_equal(produced_data, prepared_data)
 
 
+def test_factors_calculation_b_frame():
+    """
+    Runs the factors_calculation_b_frame function.
+    :param None
+    :return Test Pass/Fail
+    """
+    with open("tests/fixtures/test_imputation_functions_factors_b_input.json", "r")\
+            as file_1:
+        test_data_in = file_1.read()
+    input_data = pd.DataFrame(json.loads(test_data_in))
+
+    factors = {"threshold": 2}
+
+    produced_data = lambda_imputation_function.factors_calculation_b_frame(
+        input_data, ["question_1"], **factors)
+    produced_data = produced_data.astype(float).sort_index(axis=1)
+
+    with open("tests/fixtures/test_imputation_functions_factors_b_prepared_output.json",
+              "r") as file_2:
+        test_data_out = file_2.read()
+    prepared_data = pd.DataFrame(json.loads(test_data_out), dtype=float)
+
+    assert_frame_equal(produced_data, prepared_data)
+
+
 def test_calc_iqrs():
     with open("tests/fixtures/test_calc_iqrs_input.json", "r") as file_1:
         test_data_in = file_1.read()
@@ -1222,6 +1484,75 @@ def test_calc_iqrs():
     assert_frame_equal(produced_data, prepared_data)
 
 
+@pytest.mark.parametrize("key_type", [str, int])
+def test_calc_iqrs_engine_parity(key_type):
+    with open("tests/fixtures/test_calc_iqrs_input.json", "r") as file_1:
+        test_data_in = file_1.read()
+    input_data = pd.DataFrame(json.loads(test_data_in))
+    input_data["region"] = input_data["region"].astype(key_type)
+    # The query engine matches on quoted values, so is given the keys as strings.
+    query_input = input_data.copy()
+    query_input[["region", "strata"]] = query_input[["region", "strata"]].astype(str)
+
+    q_list = method_iqrs_runtime_variables["RuntimeVariables"]["questions_list"]
+    distinct_values = method_iqrs_runtime_variables["RuntimeVariables"]["distinct_values"]
+
+    movement_columns = lambda_imputation_function.produce_columns("movement_",
+                                                                  q_list)
+    iqrs_columns = lambda_imputation_function.produce_columns("iqrs_", q_list)
+
+    groupby_data = lambda_iqrs_method_function.calc_iqrs(
+        input_data.copy(), movement_columns, iqrs_columns, distinct_values)
+    query_data = lambda_iqrs_method_function.calc_iqrs(
+        query_input, movement_columns, iqrs_columns, distinct_values,
+        engine="query")
+
+    assert_frame_equal(groupby_data[iqrs_columns].astype(float),
+                       query_data[iqrs_columns].astype(float))
+
+    if key_type is int:
+        # Given integer keys, the query engine finds no rows, so every IQRS is left
+        # at 0. The groupby engine fixes that.
+        unmatched_data = lambda_iqrs_method_function.calc_iqrs(
+            input_data.copy(), movement_columns, iqrs_columns, distinct_values,
+            engine="query")
+        assert (unmatched_data[iqrs_columns].astype(float) == 0).all().all()
+        assert (groupby_data[iqrs_columns].astype(float) != 0).any().any()
+
+
+@pytest.mark.parametrize(
+    "values,answer",
+    [
+        ([4.0, 1.0, 3.0, 2.0], 2.0),
+        ([5.0, 1.0, 4.0, 2.0, 3.0], 2.0),
+        ([1.0, np.nan, 3.0, 4.0], 2.0),
+        ([5.0], 0.0),
+        ([np.nan, np.nan], np.nan)
+    ])
+def test_iqr_array(values, answer):
+    produced_iqr = lambda_iqrs_method_function.iqr_array(np.array(values))
+
+    assert produced_iqr == answer or (np.isnan(produced_iqr) and np.isnan(answer))
+    assert produced_iqr == lambda_iqrs_method_function.iqr_series(pd.Series(values)) \
+        or np.isnan(produced_iqr)
+
+
+def test_iqr_groups():
+    generator = np.random.default_rng(0)
+    group_numbers = generator.integers(0, 40, 500)
+    values = generator.normal(size=500)
+    values[generator.random(500) < 0.1] = np.nan
+
+    produced_iqrs = lambda_iqrs_method_function.iqr_groups(values, group_numbers, 41)
+
+    assert np.isnan(produced_iqrs[40])
+    for group in range(40):
+        expected_iqr = lambda_iqrs_method_function.iqr_array(
+            values[group_numbers == group])
+        assert produced_iqrs[group] == expected_iqr or \
+            (np.isnan(produced_iqrs[group]) and np.isnan(expected_iqr))
+
+
 @pytest.mark.parametrize(
     "input_file,quest,prepared_data",
     [
@@ -1264,6 +1595,42 @@ def test_sum_data_columns(columns, prepared_data):
     assert produced_data == prepared_data
 
 
+@pytest.mark.parametrize(
+    "columns,prepared_data",
+    [
+        ([{"column_name": "D", "data": {"A": "+", "B": "+", "C": "+"}}], [9]),
+        ([{"column_name": "D", "data": {"A": "+", "B": "+", "C": "-"}}], [1]),
+        ([{"column_name": "D", "data": {"A": "+", "B": "-"}},
+          {"column_name": "E", "data": {"D": "+", "C": "+"}}], [-1, 3])
+    ])
+def test_sum_data_columns_frame(columns, prepared_data):
+
+    working_dataframe = pd.DataFrame(
+        [
+            {"A": 2, "B": 3, "C": 4, "D": 0, "E": 0}
+        ]
+    )
+
+    working_dataframe = lambda_apply_method_function.sum_data_columns_frame(
+        working_dataframe, columns)
+
+    produced_data = [working_dataframe[column["column_name"]][0] for column in columns]
+
+    assert produced_data == prepared_data
+
+
+@pytest.mark.parametrize(
+    "which_values,answer",
+    [
+        ([2.5, -2.5, 1.49, -1.51, 0.0], [3, -3, 1, -2, 0]),
+        ([0.5, None], [1.0, None])
+    ])
+def test_sas_round_array(which_values, answer):
+    output = lambda_imputation_function.sas_round_array(
+        pd.Series(which_values, dtype=float))
+    assert pd.Series(output).equals(pd.Series(answer, dtype=output.dtype))
+
+
 def test_calc_atypicals():
 
     with open("tests/fixtures/test_calc_atypicals_input.json", "r") as file_1:
@@ -1324,6 +1691,600 @@ def test_movement_calculation_b(which_current, which_previous, answer):
     assert output == answer
 
 
+def test_calculate_movements():
+    current = pd.DataFrame({"ref": [1, 2, 3], "Q1": [6, 100, 4], "Q2": [3, 0, 5]})
+    # Previous rows deliberately out of order, matched by reference not position.
+    previous = pd.DataFrame({"ref": [3, 1, 2], "Q1": [0, 5, 10], "Q2": [5, 2, 0]})
+
+    produced_data = lambda_movement_method_function.calculate_movements(
+        current, previous, ["Q1", "Q2"], "ref",
+        lambda_imputation_function.movement_calculation_a)
+
+    prepared_data = pd.DataFrame({"Q1": [0.2, 9.0, 0.0], "Q2": [0.5, 0.0, 0.0]})
+
+    assert_frame_equal(produced_data, prepared_data)
+
+
+@pytest.mark.parametrize("encoding", ["records", "columnar", "arrow"])
+def test_encode_dataframe(encoding):
+    if encoding == "arrow":
+        pytest.importorskip("pyarrow")
+
+    dataframe = pd.DataFrame({
+        "responder_id": [1, 2, 3],
+        "movement_Q601_asphalting_sand": [0.5, None, -1.25],
+        "strata": ["A", "B", None],
+        "survey": ["066", "066", "076"]
+    })
+
+    encoded = lambda_transfer_function.encode_dataframe(dataframe, encoding)
+    produced_data = lambda_transfer_function.decode_dataframe(encoded, encoding)
+
+    assert isinstance(encoded, str)
+    assert_frame_equal(produced_data, dataframe)
+
+
+def test_check_data():
+    records = [{"movement_Q1": 0.5, "movement_Q2": None, "region": 1},
+               {"movement_Q1": 1.5, "movement_Q2": None, "region": 2}]
+    runtime_variables = lambda_transfer_function.DataSchema().load({"data": records})
+    dataframe = lambda_transfer_function.load_data(runtime_variables)
+
+    lambda_transfer_function.check_data(
+        dataframe, ["movement_Q1", "movement_Q2"], ["region"])
+    with pytest.raises(ValueError, match="missing columns \\['strata'\\]"):
+        lambda_transfer_function.check_data(dataframe, ["movement_Q1"], ["strata"])
+    with pytest.raises(ValueError, match="are not numeric"):
+        lambda_transfer_function.check_data(
+            dataframe.assign(movement_Q1=["a", "b"]), ["movement_Q1"])
+    with pytest.raises(ValidationError):
+        lambda_transfer_function.DataSchema().load({"data": records + [1]})
+
+
+@pytest.mark.parametrize(
+    "file_name,data_format,expected_format",
+    [
+        ("test_output", None, "json"),
+        ("test_output", "parquet", "parquet"),
+        ("test_output.json", "parquet", "json"),
+        ("test_output.parquet", None, "parquet")
+    ])
+def test_data_format_of(file_name, data_format, expected_format):
+    assert lambda_storage_function.data_format_of(file_name, data_format) == \
+        expected_format
+
+
+@pytest.mark.parametrize(
+    "file_name,data_format",
+    [
+        ("test_storage.json", None),
+        ("test_storage.parquet", None),
+        ("test_storage", "parquet")
+    ])
+def test_storage_local(tmp_path, file_name, data_format):
+    if lambda_storage_function.data_format_of(file_name, data_format) == "parquet":
+        pytest.importorskip("pyarrow")
+
+    dataframe = pd.DataFrame({
+        "responder_id": [1, 2, 3],
+        "movement_Q601_asphalting_sand": [0.5, None, -1.25],
+        "survey": ["066", "066", "076"]
+    })
+
+    lambda_storage_function.save_dataframe(str(tmp_path), file_name, dataframe,
+                                           data_format, "local")
+    produced_data = lambda_storage_function.read_dataframe(str(tmp_path), file_name,
+                                                           data_format, "local")
+    assert_frame_equal(produced_data, dataframe)
+
+    lambda_transfer_function.save_method_data(
+        str(tmp_path), file_name,
+        {"data": lambda_transfer_function.encode_dataframe(dataframe, "columnar")},
+        "columnar", data_format, "local")
+    produced_data = lambda_storage_function.read_dataframe(str(tmp_path), file_name,
+                                                           data_format, "local")
+    assert_frame_equal(produced_data, dataframe)
+
+    lambda_storage_function.delete_data(str(tmp_path), file_name, "local")
+    assert not (tmp_path / file_name).exists()
+
+
+@mock_s3
+def test_storage_s3_parquet():
+    pytest.importorskip("pyarrow")
+
+    bucket_name = generic_environment_variables["bucket_name"]
+    client = test_generic_library.create_bucket(bucket_name)
+    dataframe = pd.DataFrame({
+        "responder_id": [1, 2, 3],
+        "survey": ["066", "066", "076"]
+    })
+
+    lambda_storage_function.save_dataframe(bucket_name, "test_storage.parquet",
+                                           dataframe)
+    produced_data = lambda_storage_function.read_dataframe(bucket_name,
+                                                           "test_storage.parquet")
+
+    assert client.list_objects_v2(Bucket=bucket_name)["KeyCount"] == 1
+    assert_frame_equal(produced_data, dataframe)
+
+
+@pytest.mark.parametrize(
+    "file_name,partitioned,periods_read",
+    [
+        ("test_periods.json", False, 3),
+        ("test_periods.json", True, 2),
+        ("test_periods.parquet", False, 2),
+        ("test_periods.parquet", True, 2)
+    ])
+def test_read_periods(tmp_path, file_name, partitioned, periods_read):
+    if file_name.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+
+    dataframe = pd.DataFrame({
+        "period": [201803, 201806, 201809, 201806, 201809, 201803],
+        "responder_id": [1, 1, 1, 2, 2, 2],
+        "Q1": [10, 20, 30, 40, 50, 60]
+    })
+
+    lambda_storage_function.save_periods(str(tmp_path), file_name, dataframe,
+                                         "period", backend="local",
+                                         partitioned=partitioned)
+    produced_data = lambda_storage_function.read_periods(
+        str(tmp_path), file_name, "period", ["201809", "201806"], backend="local",
+        partitioned=partitioned)
+    current_data, previous_period_data = \
+        lambda_movement_wrangler_function.split_periods(
+            produced_data, "period", "201809", "201806")
+
+    assert produced_data["period"].nunique() == periods_read
+    assert list(current_data["Q1"]) == [30, 50]
+    assert list(previous_period_data["Q1"]) == [20, 40]
+
+
+@mock_s3
+def test_read_periods_s3_parquet():
+    pytest.importorskip("pyarrow")
+
+    bucket_name = generic_environment_variables["bucket_name"]
+    test_generic_library.create_bucket(bucket_name)
+    dataframe = pd.DataFrame({
+        "period": ["201806", "201806", "201809", "201812"],
+        "Q1": [1, 2, 3, 4]
+    })
+
+    lambda_storage_function.save_periods(bucket_name, "test_periods.parquet",
+                                         dataframe, "period")
+    produced_data = lambda_storage_function.read_periods(
+        bucket_name, "test_periods.parquet", "period", ["201809", "201806"])
+
+    assert_frame_equal(produced_data, dataframe.iloc[:3])
+
+
+@pytest.mark.parametrize(
+    "period_values,answer",
+    [
+        ([201806, 201809, 201812], [1, 0, -1]),
+        (["201806", "201809", "201812"], [1, 0, -1]),
+        # Periods match as strings, so float periods never match.
+        ([201806.0, 201809.0, 201812.0], [-1, -1, -1])
+    ])
+def test_period_codes(period_values, answer):
+    codes = lambda_movement_wrangler_function.period_codes(
+        pd.Series(period_values), ["201809", "201806"])
+
+    assert list(codes) == answer
+
+
+@pytest.mark.parametrize(
+    "max_rows,answer",
+    [
+        (1, [[0, 3], [2], [1], [4]]),
+        (3, [[0, 2, 3], [1, 4]]),
+        (10, [[0, 1, 2, 3, 4]])
+    ])
+def test_partition_groups(max_rows, answer):
+    dataframe = pd.DataFrame({
+        "region": [1, 2, 1, 1, 3],
+        "strata": ["A", "A", "B", "A", "A"]
+    })
+
+    partitions = lambda_imputation_function.partition_groups(
+        dataframe, ["region", "strata"], max_rows)
+
+    assert [list(partition.index) for partition in partitions] == answer
+
+
+@pytest.mark.parametrize("data_format,null_column",
+                         [("json", False), ("parquet", False), ("parquet", True)])
+def test_wrangler_apply_chunked(tmp_path, data_format, null_column):
+    if data_format == "parquet":
+        pytest.importorskip("pyarrow")
+
+    runtime_variables = deepcopy(wrangler_apply_runtime_variables_1)
+    runtime_variables["RuntimeVariables"]["data_format"] = data_format
+    for file_name in ["in_file_name", "current_data", "previous_data"]:
+        file_name = runtime_variables["RuntimeVariables"][file_name]
+        with open("tests/fixtures/" + file_name + ".json", "r") as file:
+            data = pd.DataFrame(json.loads(file.read()))
+        if null_column and "county_name" in data.columns:
+            # Missing for every responder, which are written first.
+            data.loc[data["response_type"] == 2, "county_name"] = None
+        lambda_storage_function.save_dataframe(str(tmp_path), file_name, data,
+                                               data_format, "local")
+
+    def invoke_method(FunctionName, Payload):
+        response = lambda_apply_method_function.lambda_handler(json.loads(Payload),
+                                                               None)
+        return {"Payload": io.BytesIO(json.dumps(response).encode("UTF-8"))}
+
+    produced_data = {}
+    for chunk_size in [None, 1]:
+        runtime_variables["RuntimeVariables"]["chunk_size"] = chunk_size
+        runtime_variables["RuntimeVariables"]["out_file_name"] = \
+            f"test_apply_output_{chunk_size}"
+
+        with mock.patch.dict(lambda_apply_wrangler_function.os.environ, {
+            **generic_environment_variables,
+            "bucket_name": str(tmp_path),
+            "run_environment": "development",
+            "storage_backend": "local"
+        }):
+            with mock.patch("apply_factors_wrangler.boto3.client") as mock_client:
+                mock_client.return_value.invoke.side_effect = invoke_method
+                with mock.patch("apply_factors_wrangler.aws_functions"):
+                    output = lambda_apply_wrangler_function.lambda_handler(
+                        runtime_variables, test_generic_library.context_object)
+
+        assert output["success"]
+        produced_data[chunk_size] = lambda_storage_function.read_dataframe(
+            str(tmp_path), f"test_apply_output_{chunk_size}", data_format, "local")\
+            .sort_values("responder_id").reset_index(drop=True)
+
+    assert_frame_equal(produced_data[1], produced_data[None], check_dtype=False)
+
+
+@pytest.mark.parametrize(
+    "wrangler,method,runtime_variables",
+    [
+        (lambda_factors_wrangler_function, lambda_factors_method_function,
+         wrangler_factors_runtime_variables),
+        (lambda_iqrs_wrangler_function, lambda_iqrs_method_function,
+         wrangler_iqrs_runtime_variables),
+        (lambda_means_wrangler_function, lambda_means_method_function,
+         wrangler_means_runtime_variables)
+    ])
+def test_wrangler_partitions(tmp_path, wrangler, method, runtime_variables):
+    runtime_variables = deepcopy(runtime_variables)
+    runtime_variables["RuntimeVariables"]["data_format"] = "json"
+    file_name = runtime_variables["RuntimeVariables"]["in_file_name"]
+    with open("tests/fixtures/" + file_name + ".json", "r") as file:
+        lambda_storage_function.save_dataframe(
+            str(tmp_path), file_name, pd.DataFrame(json.loads(file.read())), "json",
+            "local")
+
+    invoked = []
+
+    def invoke_method(FunctionName, Payload):
+        invoked.append(FunctionName)
+        response = method.lambda_handler(json.loads(Payload), None)
+        return {"Payload": io.BytesIO(json.dumps(response).encode("UTF-8"))}
+
+    invocations = {}
+    produced_data = {}
+    for partitions in [1, 3]:
+        invoked.clear()
+        runtime_variables["RuntimeVariables"]["partitions"] = partitions
+        runtime_variables["RuntimeVariables"]["out_file_name"] = \
+            f"test_partitions_output_{partitions}"
+
+        with mock.patch.dict(wrangler.os.environ, {
+            **generic_environment_variables,
+            "bucket_name": str(tmp_path),
+            "run_environment": "development",
+            "storage_backend": "local"
+        }):
+            with mock.patch(wrangler.__name__ + ".boto3.client") as mock_client:
+                mock_client.return_value.invoke.side_effect = invoke_method
+                with mock.patch(wrangler.__name__ + ".aws_functions"):
+                    output = wrangler.lambda_handler(
+                        runtime_variables, test_generic_library.context_object)
+
+        assert output["success"]
+        serialised = [stage for stage in output["metrics"]["stages"]
+                      if stage["stage"] == "serialise"]
+        assert len(serialised) == 1
+        assert serialised[0]["payload_bytes"] > 0
+        invocations[partitions] = len(invoked)
+        produced_data[partitions] = lambda_storage_function.read_dataframe(
+            str(tmp_path), f"test_partitions_output_{partitions}", "json", "local")
+
+    assert invocations[1] == 1
+    assert invocations[3] > 1
+    sort_columns = list(produced_data[1].columns)
+    assert_frame_equal(
+        produced_data[3].sort_values(sort_columns).reset_index(drop=True),
+        produced_data[1].sort_values(sort_columns).reset_index(drop=True),
+        check_dtype=False)
+
+
+@pytest.mark.parametrize("partitions", [1, 3])
+def test_wrangler_local_execution(tmp_path, partitions):
+    runtime_variables = deepcopy(wrangler_means_runtime_variables)
+    runtime_variables["RuntimeVariables"]["data_format"] = "json"
+    runtime_variables["RuntimeVariables"]["partitions"] = partitions
+    file_name = runtime_variables["RuntimeVariables"]["in_file_name"]
+    out_file_name = runtime_variables["RuntimeVariables"]["out_file_name"]
+    with open("tests/fixtures/" + file_name + ".json", "r") as file:
+        input_data = pd.DataFrame(json.loads(file.read()))
+    lambda_storage_function.save_dataframe(str(tmp_path), file_name, input_data,
+                                           "json", "local")
+
+    with mock.patch.dict(lambda_means_wrangler_function.os.environ, {
+        **generic_environment_variables,
+        "bucket_name": str(tmp_path),
+        "execution_backend": "local",
+        "method_name": "es-imputation-calculate-means-method",
+        "run_environment": "development",
+        "storage_backend": "local"
+    }):
+        with mock.patch("calculate_means_wrangler.boto3.client") as mock_client:
+            with mock.patch("calculate_means_wrangler.aws_functions"):
+                output = lambda_means_wrangler_function.lambda_handler(
+                    runtime_variables, test_generic_library.context_object)
+
+    assert output["success"]
+    mock_client.assert_not_called()
+
+    produced_data = lambda_storage_function.read_dataframe(
+        str(tmp_path), out_file_name, "json", "local")
+    for column in lambda_imputation_function.produce_columns("mean_", questions_list):
+        input_data[column] = 0.0
+    expected_data = lambda_means_method_function.calculate_means(
+        input_data, questions_list, ["region", "strata"])
+
+    sort_columns = list(produced_data.columns)
+    assert_frame_equal(
+        produced_data.sort_values(sort_columns).reset_index(drop=True),
+        expected_data[sort_columns].sort_values(sort_columns).reset_index(drop=True),
+        check_dtype=False)
+
+
+@pytest.mark.parametrize(
+    "input_data,prepared_data,to_be_imputed",
+    [
+        ("tests/fixtures/test_wrangler_movement_input.json",
+         "tests/fixtures/test_pipeline_prepared_output.json", True),
+        ("tests/fixtures/test_wrangler_movement_skip_input.json",
+         "tests/fixtures/test_wrangler_movement_skip_prepared_output.json", False)
+    ])
+@pytest.mark.parametrize("rollup", [False, True])
+@pytest.mark.parametrize("prune", [False, True])
+def test_run_imputation(input_data, prepared_data, to_be_imputed, rollup, prune):
+    runtime_variables = {
+        **deepcopy(wrangler_movement_runtime_variables["RuntimeVariables"]),
+        "distinct_values": ["region", "strata"],
+        "factors_parameters": factors_parameters,
+        "iqrs_engine": "groupby",
+        "prune": prune,
+        "rollup": rollup,
+        "sum_columns": method_apply_runtime_variables["RuntimeVariables"]["sum_columns"]
+    }
+
+    with open(input_data, "r") as file_1:
+        test_data = pd.DataFrame(json.loads(file_1.read()))
+    with open(prepared_data, "r") as file_2:
+        prepared_data = pd.DataFrame(json.loads(file_2.read()))
+
+    produced_data, imputed = lambda_pipeline_function.run_imputation(
+        test_data, runtime_variables, "response_type")
+
+    assert imputed == to_be_imputed
+    assert_frame_equal(
+        produced_data[prepared_data.columns].sort_values("responder_id")
+        .reset_index(drop=True),
+        prepared_data.sort_values("responder_id").reset_index(drop=True),
+        check_dtype=False)
+
+
+@pytest.mark.parametrize("survey_type", ["bricks_blocks", "sand_gravel"])
+def test_run_imputation_rollup(survey_type):
+    data = survey_generator.generate_survey(survey_type, references=1000, seed=2)
+    runtime_variables = survey_generator.runtime_variables(survey_type)
+
+    expected_data, _ = lambda_pipeline_function.run_imputation(
+        data, runtime_variables, "response_type")
+    produced_data, imputed = lambda_pipeline_function.run_imputation(
+        data, {**runtime_variables, "rollup": True}, "response_type")
+
+    assert imputed
+    assert_frame_equal(produced_data, expected_data)
+
+
+def test_rollup_recalculated_means_regionless_rows():
+    random = np.random.RandomState(2)
+    questions_list = ["601", "602"]
+    distinct_values = ["region", "strata"]
+    data = pd.DataFrame({"responder_id": np.arange(300),
+                         "region": random.randint(1, 4, 300),
+                         "strata": random.choice(["A", "B"], 300)})
+    for question in questions_list:
+        data["movement_" + question] = random.normal(0, 1, 300)
+    # Outliers in one region only, so the all-GB atypicals differ from the regional.
+    data.loc[data["region"] == 1, "movement_601"] *= 4
+    movement_columns = lambda_imputation_function.produce_columns(
+        "movement_", questions_list)
+    atypical_columns = lambda_imputation_function.produce_columns(
+        "atyp_", questions_list)
+    iqrs_columns = lambda_imputation_function.produce_columns("iqrs_", questions_list)
+    mean_columns = lambda_imputation_function.produce_columns("mean_", questions_list)
+
+    def run_steps(df, rollup):
+        for column in mean_columns + iqrs_columns + atypical_columns:
+            df[column] = 0.0
+        df = lambda_means_method_function.calculate_means(
+            df, questions_list, distinct_values, rollup)
+        df = lambda_iqrs_method_function.calc_iqrs(
+            df, movement_columns, iqrs_columns, distinct_values, rollup=rollup)
+        df = lambda_atypicals_method_function.calc_atypicals(
+            df, atypical_columns, movement_columns, iqrs_columns, mean_columns,
+            rollup)
+        if rollup is not None:
+            rollup = {**rollup, "emit_regionless": True}
+        return lambda_means_method_function.calculate_means(
+            df, questions_list, distinct_values, rollup)
+
+    expected_data = run_steps(lambda_regionless_method_function.add_regionless(
+        data.copy(), "region", 14), None)
+    produced_data = run_steps(
+        data.copy(), {"region_column": "region", "regionless_code": 14})
+
+    columns = ["responder_id", "region"] + atypical_columns + iqrs_columns + \
+        movement_columns + mean_columns
+    assert (produced_data["region"] == 14).any()
+    assert_frame_equal(
+        produced_data[columns].astype({"region": int})
+        .sort_values(["responder_id", "region"]).reset_index(drop=True),
+        expected_data[columns].astype({"region": int})
+        .sort_values(["responder_id", "region"]).reset_index(drop=True),
+        check_dtype=False)
+
+
+@pytest.mark.parametrize("survey_type", ["bricks_blocks", "sand_gravel"])
+@pytest.mark.parametrize("rollup", [False, True])
+def test_run_imputation_prune(survey_type, rollup):
+    data = survey_generator.generate_survey(survey_type, references=2000,
+                                            non_response_rate=0.005, seed=2)
+    runtime_variables = {**survey_generator.runtime_variables(survey_type),
+                         "rollup": rollup}
+    metrics = lambda_metrics_function.StageMetrics("Imputation Pipeline.")
+
+    expected_data, _ = lambda_pipeline_function.run_imputation(
+        data, runtime_variables, "response_type")
+    produced_data, imputed = lambda_pipeline_function.run_imputation(
+        data, {**runtime_variables, "prune": True}, "response_type", metrics)
+
+    assert imputed
+    assert_frame_equal(produced_data, expected_data)
+    assert sum(stage["skipped_rows"] for stage in metrics.stages
+               if stage["stage"] == "prune") > 0
+
+
+@pytest.mark.parametrize("survey_type", ["bricks_blocks", "sand_gravel"])
+@pytest.mark.parametrize("moved_references", [0, 40])
+@pytest.mark.parametrize("changes", ["late_returns", "new_cell"])
+def test_run_incremental_imputation(survey_type, moved_references, changes):
+    data = survey_generator.generate_survey(survey_type, references=2000, seed=2)
+    runtime_variables = survey_generator.runtime_variables(survey_type)
+    # References whose previous period rows are in another strata.
+    moved = data[data["period"] == 201806].index[:moved_references]
+    data.loc[moved, "strata"] = \
+        data.loc[moved, "strata"].map({"A": "B"}).fillna("A")
+    # The last references only take part from the current period.
+    new_references = data.loc[data[data["period"] == 201809].index[-3:],
+                              "responder_id"]
+    data = data[~((data["period"] == 201806) &
+                  data["responder_id"].isin(new_references))].copy()
+    previous_output, _ = lambda_pipeline_function.run_imputation(
+        data[~data["responder_id"].isin(new_references)], runtime_variables,
+        "response_type")
+
+    changed = data[data["responder_id"].isin(new_references)].index
+    if changes == "late_returns":
+        # Two late returns, one of which has also moved strata.
+        late_returns = data[(data["period"] == 201809) &
+                            (data["response_type"] == 1)].index[:2]
+        data.loc[late_returns, "response_type"] = 2
+        data.loc[late_returns, runtime_variables["questions_list"]] = 100
+        data.loc[late_returns[0], "strata"] = \
+            "A" if data.loc[late_returns[0], "strata"] != "A" else "B"
+        changed = changed.append(late_returns)
+    else:
+        # The new references are in a strata of their own, with no movements, so
+        # it gets no factors and its non-responder is left out.
+        data.loc[changed, "strata"] = "Z"
+        data.loc[changed[0], "response_type"] = 1
+    metrics = lambda_metrics_function.StageMetrics("Imputation Pipeline.")
+
+    expected_data, _ = lambda_pipeline_function.run_imputation(
+        data, runtime_variables, "response_type")
+    produced_data, imputed = lambda_pipeline_function.run_incremental_imputation(
+        data, previous_output, list(data.loc[changed, "responder_id"]),
+        runtime_variables, "response_type", metrics)
+
+    assert imputed
+    assert_frame_equal(
+        produced_data.sort_values("responder_id").reset_index(drop=True),
+        expected_data.sort_values("responder_id").reset_index(drop=True),
+        check_dtype=False)
+    assert metrics.stages[0]["skipped_rows"] > 0
+
+
+def test_prune_cells():
+    data = pd.DataFrame({
+        "region": [1, 1, 2, 2, 14, 14, 14, 14],
+        "strata": ["A", "B", "A", "B", "A", "B", "A", "B"],
+        "value": range(8)
+    })
+    cells = pd.DataFrame({"region": [1], "strata": ["A"]})
+
+    pruned, report = lambda_imputation_function.prune_cells(
+        data.iloc[:4], cells, ["region", "strata"], "region", 14,
+        regionless_added=False)
+    assert list(pruned["value"]) == [0, 2]
+
+    pruned, report = lambda_imputation_function.prune_cells(
+        data, cells, ["region", "strata"], "region", 14)
+    assert list(pruned["value"]) == [0, 4, 6]
+    assert report == {"input_cells": 6, "input_rows": 8, "skipped_cells": 4,
+                      "skipped_rows": 5}
+
+
+@pytest.mark.parametrize("survey_type", ["bricks_blocks", "sand_gravel"])
+def test_benchmark_suite(survey_type, tmp_path):
+    first = survey_generator.generate_survey(survey_type, references=200, seed=1)
+    second = survey_generator.generate_survey(survey_type, references=200, seed=1)
+    assert_frame_equal(first, second)
+    assert len(first.index) == 400
+
+    output = str(tmp_path / "results.json")
+    report = run_benchmarks.main(["--survey-type", survey_type, "--references", "200",
+                                  "--repeats", "1", "--output", output])
+
+    with open(output, "r") as file:
+        saved = json.loads(file.read())
+    assert saved == json.loads(json.dumps(report))
+    assert "pipeline" in [result["name"] for result in saved["results"]]
+    assert all(result["rows_per_second"] > 0 for result in saved["results"])
+    assert list(run_benchmarks.compare_results(saved, report).values()) == \
+        [0] * len(saved["results"])
+
+
+def test_stage_metrics(capsys):
+    metrics = lambda_metrics_function.StageMetrics("Test Module.")
+    metrics.record("read", pd.DataFrame({"a": [1, 2, 3]}))
+    metrics.record("serialise", payload="{\"a\": \"\u00a3\"}")
+    metrics.record("serialise", payload=b"12345")
+    metrics.record_method({"success": True, "metrics": {"seconds": 1}})
+
+    summary = metrics.summary()
+    assert [stage["rows"] for stage in summary["stages"]] == [3, None, None]
+    assert [stage["payload_bytes"] for stage in summary["stages"]] == [None, 11, 5]
+    assert set(summary["stage_seconds"]) == {"read", "serialise"}
+    assert summary["method"] == {"seconds": 1}
+
+    lines = metrics.emit("run-1", "066")
+    assert capsys.readouterr().out.splitlines() == lines
+    read_metric = json.loads(lines[0])
+    assert read_metric["Module"] == "Test Module."
+    assert read_metric["Stage"] == "read"
+    assert read_metric["Rows"] == 3
+    assert "PayloadBytes" not in read_metric
+    assert [metric["Name"] for metric in
+            read_metric["_aws"]["CloudWatchMetrics"][0]["Metrics"]][:2] == \
+        ["Duration", "Rows"]
+
+
 @pytest.mark.parametrize(
     "which_prefix,which_columns,which_additional,which_suffix,answer",
     [
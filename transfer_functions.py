@@ -0,0 +1,391 @@
+import base64
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+from marshmallow import Schema, ValidationError, fields, validates_schema
+from marshmallow.validate import OneOf
+
+import storage_functions
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+ENCODINGS = ["records", "columnar", "arrow"]
+# Arrow needs pyarrow, which the deployed Lambdas only have from a layer.
+AVAILABLE_ENCODINGS = ENCODINGS if pa is not None else ["records", "columnar"]
+
+
+class LocationSchema(Schema):
+    """
+    Where a DataFrame passed by reference is stored.
+    """
+    bucket_name = fields.Str(required=True)
+    data_format = fields.Str(missing=None, allow_none=True,
+                             validate=OneOf(storage_functions.AVAILABLE_FORMATS))
+    file_name = fields.Str(required=True)
+    storage_backend = fields.Str(
+        missing="s3", validate=OneOf(storage_functions.BACKENDS))
+
+
+class Records(fields.Field):
+    """
+    A list of records. Only the list is checked here, in one pass, rather than
+    each record being loaded by marshmallow. Their columns are checked once they
+    are a DataFrame, by check_data.
+    """
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if not isinstance(value, list) or \
+                not all(isinstance(record, dict) for record in value):
+            raise ValidationError("Not a valid list of records.")
+
+        return value
+
+
+class DataSchema(Schema):
+    """
+    Data fields shared by every method. The data arrives either as a list of
+    records in 'data', as a string in 'encoded_data' for the columnar and arrow
+    encodings, or by reference in 'data_location'. When 'result_location' is
+    given the method saves its output there instead of returning it.
+    """
+    data = Records()
+    data_location = fields.Nested(LocationSchema)
+    encoded_data = fields.Str()
+    payload_encoding = fields.Str(missing="records",
+                                  validate=OneOf(AVAILABLE_ENCODINGS))
+    result_location = fields.Nested(LocationSchema)
+
+    @validates_schema
+    def validate_data(self, data, **kwargs):
+        if not {"data", "data_location", "encoded_data"} & set(data):
+            raise ValidationError(
+                "One of data, data_location or encoded_data is required.")
+
+
+def data_payload(dataframe, encoding="records", reference=None):
+    """
+    Produces the data entries of a method's RuntimeVariables.
+    Records are sent exactly as before so older methods can still read them.
+    :param dataframe: Data to be sent to the method. - Type: DataFrame
+    :param encoding: One of ENCODINGS. - Type: String
+    :param reference: Locations from reference_payload. When given the data is
+                      saved to its data_location rather than sent. - Type: Dict
+    :return: RuntimeVariables entries. - Type: Dict
+    """
+    if reference is not None:
+        save_location(reference["data_location"], dataframe)
+        return dict(reference)
+
+    if encoding == "records":
+        return {"data": json.loads(dataframe.to_json(orient="records"))}
+
+    return {
+        "encoded_data": encode_dataframe(dataframe, encoding),
+        "payload_encoding": encoding
+    }
+
+
+def reference_payload(bucket_name, file_name, data_format=None, storage_backend="s3",
+                      result_suffix=""):
+    """
+    Produces the locations used to pass data to a method by reference. Both are
+    named after the wrangler's output file: the method's input gets the suffix
+    '_method_input', its result gets result_suffix.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: The wrangler's output file name. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param storage_backend: One of storage_functions.BACKENDS. - Type: String
+    :param result_suffix: Suffix for the result. Empty when the method's result is
+                          the wrangler's output. - Type: String
+    :return: data_location and result_location. - Type: Dict
+    """
+    stem, extension = os.path.splitext(file_name)
+
+    return {
+        "data_location": location(bucket_name, stem + "_method_input" + extension,
+                                  data_format, storage_backend),
+        "result_location": location(bucket_name, stem + result_suffix + extension,
+                                    data_format, storage_backend)
+    }
+
+
+def part_reference(reference, part):
+    """
+    Produces the locations used to pass one part of the data to a method by
+    reference, named after the locations for the whole of the data with the
+    suffix '_part_<part>'.
+    :param reference: Locations from reference_payload, or None. - Type: Dict
+    :param part: Number of the part. - Type: Int
+    :return: data_location and result_location, or None. - Type: Dict
+    """
+    if reference is None:
+        return None
+
+    part_locations = {}
+    for name, data_location in reference.items():
+        stem, extension = os.path.splitext(data_location["file_name"])
+        part_locations[name] = {**data_location,
+                                "file_name": f"{stem}_part_{part}{extension}"}
+
+    return part_locations
+
+
+def location(bucket_name, file_name, data_format=None, storage_backend="s3"):
+    """
+    Produces a location in the form described by LocationSchema.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param storage_backend: One of storage_functions.BACKENDS. - Type: String
+    :return: The location. - Type: Dict
+    """
+    return {
+        "bucket_name": bucket_name,
+        "data_format": data_format,
+        "file_name": file_name,
+        "storage_backend": storage_backend
+    }
+
+
+def read_location(data_location):
+    """
+    Reads the DataFrame stored at a location.
+    :param data_location: The location. - Type: Dict
+    :return: The data. - Type: DataFrame
+    """
+    return storage_functions.read_dataframe(
+        data_location["bucket_name"], data_location["file_name"],
+        data_location["data_format"], data_location["storage_backend"])
+
+
+def save_location(data_location, dataframe):
+    """
+    Saves a DataFrame to a location.
+    :param data_location: The location. - Type: Dict
+    :param dataframe: The data. - Type: DataFrame
+    :return: None
+    """
+    storage_functions.save_dataframe(
+        data_location["bucket_name"], data_location["file_name"], dataframe,
+        data_location["data_format"], data_location["storage_backend"])
+
+
+def delete_reference(reference, delete_result=False):
+    """
+    Deletes the method's input saved by data_payload and, optionally, its result.
+    :param reference: Locations from reference_payload, or None. - Type: Dict
+    :param delete_result: Whether to delete the result as well. - Type: Boolean
+    :return: None
+    """
+    if reference is None:
+        return
+
+    locations = [reference["data_location"]]
+    if delete_result:
+        locations.append(reference["result_location"])
+    for data_location in locations:
+        storage_functions.delete_data(data_location["bucket_name"],
+                                      data_location["file_name"],
+                                      data_location["storage_backend"])
+
+
+def load_data(runtime_variables):
+    """
+    Builds a method's input DataFrame from its validated RuntimeVariables.
+    :param runtime_variables: Loaded RuntimeVariables. - Type: Dict
+    :return: Input data. - Type: DataFrame
+    """
+    if "data_location" in runtime_variables:
+        return read_location(runtime_variables["data_location"])
+    if "encoded_data" in runtime_variables:
+        return decode_dataframe(runtime_variables["encoded_data"],
+                                runtime_variables["payload_encoding"])
+
+    return pd.DataFrame(runtime_variables["data"])
+
+
+def check_data(dataframe, numeric_columns=[], columns=[]):
+    """
+    Checks a method's input DataFrame has the columns its calculation needs, on
+    the whole DataFrame at once.
+    :param dataframe: Input data from load_data. - Type: DataFrame
+    :param numeric_columns: Columns which must be numeric. Columns with no values
+                            at all are allowed, as they have no numeric type.
+                            - Type: List
+    :param columns: Other columns which must be present. - Type: List
+    :return: None
+    """
+    missing_columns = [column for column in list(columns) + list(numeric_columns)
+                       if column not in dataframe.columns]
+    if missing_columns:
+        raise ValueError(f"Error validating data: missing columns {missing_columns}")
+
+    other_columns = [column for column in numeric_columns
+                     if not pd.api.types.is_numeric_dtype(dataframe[column]) and
+                     dataframe[column].notnull().any()]
+    if other_columns:
+        raise ValueError(f"Error validating data: columns {other_columns} "
+                         "are not numeric")
+
+
+def method_output(dataframe, runtime_variables):
+    """
+    Produces the data entry of a method's response. If a result_location was
+    given the data is saved there and only the location is returned.
+    :param dataframe: The method's output. - Type: DataFrame
+    :param runtime_variables: Loaded RuntimeVariables. - Type: Dict
+    :return: Response entries. - Type: Dict
+    """
+    if "result_location" in runtime_variables:
+        save_location(runtime_variables["result_location"], dataframe)
+        return {"data_location": runtime_variables["result_location"]}
+
+    return {"data": encode_dataframe(dataframe, runtime_variables["payload_encoding"])}
+
+
+def method_dataframe(response, encoding="records"):
+    """
+    Reads the data out of a method's response.
+    :param response: The method's response. - Type: Dict
+    :param encoding: One of ENCODINGS. - Type: String
+    :return: The method's output. - Type: DataFrame
+    """
+    if "data_location" in response:
+        return read_location(response["data_location"])
+
+    return decode_dataframe(response["data"], encoding)
+
+
+def save_method_data(bucket_name, file_name, response, encoding="records",
+                     data_format=None, storage_backend="s3"):
+    """
+    Saves the data out of a method's response as an intermediate file. JSON
+    records are saved as they are, without being parsed, and data the method
+    has already saved to the file is left alone.
+    :param bucket_name: S3 bucket, or directory for the local backend. - Type: String
+    :param file_name: Name of the file. - Type: String
+    :param response: The method's response. - Type: Dict
+    :param encoding: One of ENCODINGS. - Type: String
+    :param data_format: The run's data format, if set. - Type: String
+    :param storage_backend: One of storage_functions.BACKENDS. - Type: String
+    :return: None
+    """
+    target = location(bucket_name, file_name, data_format, storage_backend)
+    if response.get("data_location") == target:
+        return
+
+    if "data_location" not in response and encoding == "records" and \
+            storage_functions.data_format_of(file_name, data_format) == "json":
+        storage_functions.save_json(bucket_name, file_name, response["data"],
+                                    storage_backend)
+    else:
+        save_location(target, method_dataframe(response, encoding))
+
+
+def encode_dataframe(dataframe, encoding="records"):
+    """
+    Encodes a DataFrame as a string which can be sent in a Lambda payload.
+    :param dataframe: Data to encode. - Type: DataFrame
+    :param encoding: One of ENCODINGS. - Type: String
+    :return: Encoded data. - Type: String
+    """
+    if encoding == "records":
+        return dataframe.to_json(orient="records")
+    if encoding == "columnar":
+        return _pack(_columnar_bytes(dataframe))
+    if encoding == "arrow":
+        return _pack(_arrow_bytes(dataframe))
+
+    raise ValueError(f"Unknown payload encoding: {encoding}")
+
+
+def decode_dataframe(data, encoding="records"):
+    """
+    Decodes data produced by encode_dataframe.
+    :param data: Encoded data, or a list of records. - Type: String/List
+    :param encoding: One of ENCODINGS. - Type: String
+    :return: Decoded data. - Type: DataFrame
+    """
+    if encoding == "records":
+        if isinstance(data, list):
+            return pd.DataFrame(data)
+        return pd.read_json(data, dtype=False)
+    if encoding == "columnar":
+        return _columnar_dataframe(_unpack(data))
+    if encoding == "arrow":
+        return _arrow_dataframe(_unpack(data))
+
+    raise ValueError(f"Unknown payload encoding: {encoding}")
+
+
+def _pack(raw):
+    return base64.b64encode(zlib.compress(raw)).decode("ascii")
+
+
+def _unpack(data):
+    return zlib.decompress(base64.b64decode(data))
+
+
+def _columnar_bytes(dataframe):
+    # Numeric columns are stored as their raw buffers, anything else as a JSON list.
+    header = {"columns": []}
+    buffers = []
+    for column in dataframe.columns:
+        values = dataframe[column]
+        if values.dtype.kind in "biuf":
+            buffer = np.ascontiguousarray(values.to_numpy()).tobytes()
+            dtype = values.dtype.str
+        else:
+            buffer = values.to_json(orient="values").encode("utf-8")
+            dtype = "json"
+        header["columns"].append({"name": column, "dtype": dtype, "size": len(buffer)})
+        buffers.append(buffer)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    return struct.pack("<I", len(header_bytes)) + header_bytes + b"".join(buffers)
+
+
+def _columnar_dataframe(raw):
+    header_size = struct.unpack("<I", raw[:4])[0]
+    header = json.loads(raw[4:4 + header_size].decode("utf-8"))
+
+    columns = {}
+    offset = 4 + header_size
+    for column in header["columns"]:
+        buffer = raw[offset:offset + column["size"]]
+        offset += column["size"]
+        if column["dtype"] == "json":
+            columns[column["name"]] = pd.Series(json.loads(buffer.decode("utf-8")))
+        else:
+            columns[column["name"]] = np.frombuffer(buffer, dtype=column["dtype"]).copy()
+
+    return pd.DataFrame(columns, columns=[column["name"]
+                                          for column in header["columns"]])
+
+
+def _arrow_bytes(dataframe):
+    if pa is None:
+        raise ImportError("pyarrow is required for the arrow payload encoding.")
+
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    writer = pa.RecordBatchStreamWriter(sink, table.schema)
+    writer.write_table(table)
+    writer.close()
+
+    return sink.getvalue().to_pybytes()
+
+
+def _arrow_dataframe(raw):
+    if pa is None:
+        raise ImportError("pyarrow is required for the arrow payload encoding.")
+
+    return pa.ipc.open_stream(raw).read_all().to_pandas()